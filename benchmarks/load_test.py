@@ -0,0 +1,92 @@
+"""Load test of serve.py: `concurrency` clients, each on a keep-alive connection, send single-tweet
+requests back to back. Reports throughput and latency seen by clients, and the server's metrics,
+which are reset before each run.
+Run from the repository root, while serve.py runs:
+    python -m benchmarks.load_test --concurrency 32 --requests 2000"""
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import numpy as np
+
+from benchmarks.suite import synthetic_tweet, read_tweets
+
+
+async def request(reader, writer, host, method, path, payload=None):
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers['content-length'])))
+
+async def client(host, port, tweets, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for tweet in tweets:
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, host, 'POST', '/predict', {'tweet': tweet})
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(status)
+    finally:
+        writer.close()
+
+async def server_metrics(host, port, method='GET', path='/metrics'):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return (await request(reader, writer, host, method, path))[1]
+    finally:
+        writer.close()
+
+async def run(host, port, tweets, concurrency):
+    latencies, errors = [], []
+    await server_metrics(host, port, 'POST', '/metrics/reset')
+    start = time.perf_counter()
+    await asyncio.gather(*[client(host, port, tweets[i::concurrency], latencies, errors)
+                           for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1e3
+    return {'concurrency': concurrency, 'requests': len(latencies), 'errors': len(errors),
+            'seconds': elapsed, 'requests_per_sec': len(latencies) / elapsed,
+            'latency_ms': {f'p{q}': float(np.percentile(latencies, q)) for q in (50, 90, 99)},
+            'server': await server_metrics(host, port)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32],
+                        help='Numbers of concurrent clients, each of which is a run')
+    parser.add_argument('--requests', type=int, default=1000, help='Requests per run')
+    parser.add_argument('--data', default=None, help='tsv file with a tweet column. Synthetic tweets if not given')
+    parser.add_argument('--json', default=None, help='File to write results to')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    pool = read_tweets(args.data) if args.data else [synthetic_tweet(rng) for _ in range(1000)]
+    tweets = [pool[i % len(pool)] for i in range(args.requests)]
+
+    results = []
+    print('concurrency\trequests/sec\tp50_ms\tp99_ms\terrors\tserver_batch_size_mean\tserver_p99_ms')
+    for concurrency in args.concurrency:
+        r = asyncio.run(run(args.host, args.port, tweets, concurrency))
+        results.append(r)
+        server = r['server']
+        print(f"{concurrency}\t{r['requests_per_sec']:.1f}\t{r['latency_ms']['p50']:.2f}\t"
+              f"{r['latency_ms']['p99']:.2f}\t{r['errors']}\t"
+              f"{server.get('batch_size', {}).get('mean', 0):.2f}\t"
+              f"{server.get('latency_ms', {}).get('p99', 0):.2f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,70 @@
+"""Times optimizer steps of build_optimizer_scheduler and of the previous optimizer, which had a group
+per parameter, frozen ones included, and stepped AdamW of transformers, on a randomly initialized BERT.
+tests/test_optimizer.py defines the previous optimizer, and checks that both update parameters the same.
+Run from the repository root: python -m benchmarks.optimizer"""
+import copy
+import json
+import argparse
+
+import torch
+from torch.utils.benchmark import Timer
+from transformers import BertConfig, BertModel
+
+from model import build_model
+from optimizer import build_optimizer_scheduler
+from tests.test_optimizer import reference_optimizer, set_grads
+
+
+def compare(base_model, steps, min_run_time, **kwargs):
+    """Steps both optimizers with the same gradients, and times a step"""
+    model = build_model(model='mbert', time_pooling='max_avg', layer_pooling='cat', layer=[12],
+                        new_num_tokens=base_model.config.vocab_size, device='cpu', base_model=base_model)
+    reference_model = copy.deepcopy(model)
+    optimizer, _ = build_optimizer_scheduler(model=model, warmup_ratio=0.0, train_step=steps, **kwargs)
+    reference = reference_optimizer(reference_model, **kwargs)
+
+    for step in range(steps):
+        set_grads(model, step)
+        set_grads(reference_model, step)
+        optimizer.step()
+        reference.step()
+
+    env = {'optimizer': optimizer, 'reference': reference}
+    reference_ms = Timer('reference.step()', globals=env).blocked_autorange(min_run_time=min_run_time).median * 1e3
+    multi_tensor_ms = Timer('optimizer.step()', globals=env).blocked_autorange(min_run_time=min_run_time).median * 1e3
+    return {'reference_groups': len(reference.param_groups), 'groups': len(optimizer.param_groups),
+            'reference_ms': reference_ms, 'multi_tensor_ms': multi_tensor_ms,
+            'speedup': reference_ms / multi_tensor_ms}
+
+def run(base_model, configs, steps, min_run_time):
+    results = []
+    for weight_decay, layer_decrease, freeze_upto in configs:
+        r = compare(base_model, steps, min_run_time, lr=0.001, betas=(0.9, 0.999), eps=1e-6,
+                    weight_decay=weight_decay, layer_decrease=layer_decrease, freeze_upto=freeze_upto)
+        results.append({'weight_decay': weight_decay, 'layer_decrease': layer_decrease,
+                        'freeze_upto': freeze_upto, **r})
+        print(f"{weight_decay}\t{layer_decrease}\t{freeze_upto}\t{r['reference_groups']}\t{r['groups']}\t"
+              f"{r['reference_ms']:.3f}\t{r['multi_tensor_ms']:.3f}\t{r['speedup']:.2f}x")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hidden_size', type=int, default=768)
+    parser.add_argument('--vocab_size', type=int, default=30000)
+    parser.add_argument('--steps', type=int, default=5, help='Steps of both optimizers before timing')
+    parser.add_argument('--min_run_time', type=float, default=1.0)
+    parser.add_argument('--json', default=None, help='File to write results to')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=args.vocab_size, hidden_size=args.hidden_size, num_hidden_layers=12,
+                        num_attention_heads=args.hidden_size // 64, intermediate_size=args.hidden_size * 4)
+    base_model = BertModel(config)
+    # weight decay, layer-wise lr decrease, and layers frozen up to
+    configs = [(0.0, 1.0, -1), (0.01, 1.0, -1), (0.01, 0.95, -1), (0.01, 0.95, 5)]
+
+    print('weight_decay\tlayer_decrease\tfreeze_upto\treference_groups\tgroups\treference_ms\tmulti_tensor_ms\tspeedup')
+    results = run(base_model, configs, args.steps, args.min_run_time)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,101 @@
+"""Micro-benchmark of TimePooler and LayerPooler against the previous implementation,
+which filled a masked copy of each layer twice for max_avg pooling and stacked layers to pool them.
+Run from the repository root: python -m benchmarks.pooling"""
+import json
+import argparse
+from itertools import product
+
+import torch
+from torch.utils.benchmark import Timer
+
+from model import TimePooler, LayerPooler
+from utils import sequence_mask
+
+
+def reference_time_pool(method, x, length):
+    def avg_pool(x, length):
+        x = x.masked_fill(sequence_mask(length, pad=1, max_len=x.size(1)).unsqueeze(-1), 0.0)
+        x = torch.sum(x, dim=1)
+        x = x.squeeze()
+        return x / length.unsqueeze(-1).float()
+
+    def max_pool(x, length):
+        x = x.masked_fill(sequence_mask(length, pad=1, max_len=x.size(1)).unsqueeze(-1), 0.0)
+        return torch.max(x, dim=1).values
+
+    if method == 'avg':
+        return avg_pool(x, length)
+    if method == 'max':
+        return max_pool(x, length)
+    return torch.cat([avg_pool(x, length), max_pool(x, length)], dim=1)
+
+def reference_pool(hidden_states, length, time_pooling, layer_pooling):
+    pooled = [reference_time_pool(time_pooling, h, length) for h in hidden_states]
+    if len(pooled) == 1:
+        return pooled[0]
+    if layer_pooling == 'avg':
+        return torch.stack(pooled).mean(dim=0)
+    if layer_pooling == 'max':
+        return torch.stack(pooled).max(dim=0).values
+    return torch.cat(pooled, dim=1)
+
+def fused_pool(hidden_states, length, time_pooler, layer_pooler):
+    """As PoolClassifier.forward pools, with the mask made once"""
+    x_mask = sequence_mask(length, dtype=torch.float, max_len=hidden_states[0].size(1))
+    pooled = [time_pooler(None, h, length, x_mask) for h in hidden_states]
+    if len(pooled) == 1:
+        return pooled[0]
+    return layer_pooler(pooled)
+
+
+def run(batch_sizes, seq_lens, num_layers, time_poolings, layer_poolings, hidden_size, min_run_time):
+    results = []
+    for batch_size, seq_len, n, time_pooling, layer_pooling in product(
+            batch_sizes, seq_lens, num_layers, time_poolings, layer_poolings):
+        if n == 1 and layer_pooling != layer_poolings[0]:
+            continue
+        torch.manual_seed(0)
+        hidden_states = [torch.randn(batch_size, seq_len, hidden_size) for _ in range(n)]
+        length = torch.randint(1, seq_len + 1, (batch_size,))
+        length[0] = seq_len
+        time_pooler, layer_pooler = TimePooler(time_pooling), LayerPooler(layer_pooling)
+
+        expected = reference_pool(hidden_states, length, time_pooling, layer_pooling)
+        actual = fused_pool(hidden_states, length, time_pooler, layer_pooler)
+        assert torch.allclose(expected, actual, rtol=1e-5, atol=1e-5), \
+            f'Mismatch for {batch_size}, {seq_len}, {n}, {time_pooling}, {layer_pooling}'
+
+        env = {'hidden_states': hidden_states, 'length': length, 'time_pooling': time_pooling,
+               'layer_pooling': layer_pooling, 'time_pooler': time_pooler, 'layer_pooler': layer_pooler,
+               'reference_pool': reference_pool, 'fused_pool': fused_pool}
+        reference = Timer('reference_pool(hidden_states, length, time_pooling, layer_pooling)',
+                          globals=env).blocked_autorange(min_run_time=min_run_time).median
+        fused = Timer('fused_pool(hidden_states, length, time_pooler, layer_pooler)',
+                      globals=env).blocked_autorange(min_run_time=min_run_time).median
+        results.append({'batch_size': batch_size, 'seq_len': seq_len, 'layers': n,
+                        'time_pooling': time_pooling, 'layer_pooling': layer_pooling if n > 1 else '-',
+                        'reference_ms': reference * 1e3, 'fused_ms': fused * 1e3,
+                        'speedup': reference / fused})
+        r = results[-1]
+        print(f"{batch_size}\t{seq_len}\t{n}\t{time_pooling}\t{r['layer_pooling']}\t"
+              f"{r['reference_ms']:.3f}\t{r['fused_ms']:.3f}\t{r['speedup']:.2f}x")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 32, 128])
+    parser.add_argument('--seq_lens', type=int, nargs='+', default=[32, 128, 512])
+    parser.add_argument('--num_layers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--time_poolings', nargs='+', default=['avg', 'max', 'max_avg'])
+    parser.add_argument('--layer_poolings', nargs='+', default=['cat', 'avg', 'max'])
+    parser.add_argument('--hidden_size', type=int, default=768)
+    parser.add_argument('--min_run_time', type=float, default=0.2)
+    parser.add_argument('--json', default=None, help='File to write results to')
+    args = parser.parse_args()
+
+    print('batch\tseq_len\tlayers\ttime\tlayer\treference_ms\tfused_ms\tspeedup')
+    results = run(args.batch_sizes, args.seq_lens, args.num_layers, args.time_poolings,
+                  args.layer_poolings, args.hidden_size, args.min_run_time)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,223 @@
+"""Benchmark suite which runs offline, on a synthetic tweet dataset, a vocab made from it,
+and a small randomly initialized BERT. Results are written to JSON to compare them across commits.
+Run from the repository root:
+    python -m benchmarks.suite --json before.json
+    python -m benchmarks.suite --json after.json --compare before.json"""
+import os
+import sys
+import json
+import re
+import random
+import argparse
+import tempfile
+import subprocess
+from collections import Counter
+from functools import partial
+
+import torch
+from torch.utils.benchmark import Timer
+from transformers import BertConfig, BertModel
+
+import preprocessing
+from preprocessing import build_preprocess, build_tokenizer
+from dataloading import build_data
+from model import build_model, TimePooler, LayerPooler
+from optimizer import build_optimizer_scheduler
+from trainer import build_trainer, evaluate_all
+from utils import sequence_mask
+
+WORDS = ['you', 'are', 'the', 'best', 'worst', 'idiot', 'love', 'this', 'so', 'much', 'never', 'again',
+         'people', 'like', 'that', 'should', 'go', 'home', 'what', 'a', 'joke', 'great', 'game', 'today',
+         'hate', 'stupid', 'thanks', 'friend', 'politicians', 'lie', 'always', 'vote', 'for', 'him',
+         'bu', 've', 'og', 'det', 'er', 'και', 'το', 'هذا', 'في']
+HASHTAGS = ['#MakeAmericaGreatAgain', '#StopTheHate', '#LoveWins', '#FakeNews', '#MondayMotivation']
+EMOJIS = ['😂', '🔥', '👍', '😡', '❤️', '🙄']
+PREPROCESS_CONFIG = dict(demojize=True, textify_emoji=True, mention_limit=3, punc_limit=3,
+                         lower_hashtag=True, segment_hashtag=True, add_cap_sign=True)
+
+
+def synthetic_tweet(rng):
+    tokens = []
+    for _ in range(rng.randint(3, 40)):
+        r = rng.random()
+        if r < 0.08:
+            tokens.append(' '.join(['@USER'] * rng.randint(1, 6)))
+        elif r < 0.13:
+            tokens.append(rng.choice(HASHTAGS))
+        elif r < 0.20:
+            tokens.append(''.join(rng.choice(EMOJIS) for _ in range(rng.randint(1, 3))))
+        elif r < 0.25:
+            tokens.append(rng.choice('!?.') * rng.randint(1, 6))
+        elif r < 0.28:
+            tokens.append('URL')
+        elif r < 0.35:
+            tokens.append(rng.choice(WORDS).upper())
+        else:
+            tokens.append(rng.choice(WORDS).capitalize() if rng.random() < 0.1 else rng.choice(WORDS))
+    return ' '.join(tokens)
+
+def write_tsv(path, n, rng):
+    with open(path, 'w') as f:
+        print('id\ttweet\tlabel', file=f)
+        for i in range(n):
+            print(f'{i}\t{synthetic_tweet(rng)}\t{rng.choice(["OFF", "NOT"])}', file=f)
+
+def read_tweets(path):
+    with open(path) as f:
+        next(f)
+        return [line.rstrip('\n').split('\t')[1] for line in f]
+
+def write_vocab(tokenizer_dir, tweets, preprocess, size=3000):
+    """A wordpiece vocab of frequent words and all characters of the preprocessed tweets"""
+    words = Counter(w for tweet in tweets for w in re.findall(r'\w+|[^\w\s]', preprocess(tweet).lower()))
+    chars = sorted({c for w in words for c in w})
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + chars + ['##' + c for c in chars]
+    vocab += [w for w, _ in words.most_common(size) if w not in set(vocab)]
+    os.makedirs(tokenizer_dir, exist_ok=True)
+    with open(os.path.join(tokenizer_dir, 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(vocab) + '\n')
+
+
+def measure(fn, min_run_time):
+    """Median seconds per call"""
+    return Timer('fn()', globals={'fn': fn}).blocked_autorange(min_run_time=min_run_time).median
+
+def bench_preprocessing(tweets, min_run_time):
+    funcs = {'replace_urls': preprocessing.replace_urls,
+             'replace_emojis': preprocessing.replace_emojis,
+             'textify_emojis': preprocessing.textify_emojis,
+             'limit_mentions': partial(preprocessing.limit_mentions, keep_num=3),
+             'limit_punctuations': partial(preprocessing.limit_punctuations, keep_num=3),
+             'lower_hashtags': preprocessing.lower_hashtags,
+             'segment_hashtags': preprocessing.segment_hashtags,
+             'add_capital_signs': preprocessing.add_capital_signs,
+             'build_preprocess': build_preprocess(**PREPROCESS_CONFIG)}
+    return {f'preprocessing/{name}': measure(lambda: [func(t) for t in tweets], min_run_time) / len(tweets)
+            for name, func in funcs.items()}
+
+def bench_field(data, batch_size, min_run_time):
+    field = dict(data.fields)['tweet']
+    examples = data.train.examples
+    results = {}
+    for size in (batch_size, batch_size * 4):
+        batch = [examples[i % len(examples)].tweet for i in range(size)]
+        results[f'TransformersField.process/batch{size}'] = measure(lambda: field.process(batch, 'cpu'),
+                                                                    min_run_time)
+    return results
+
+def bench_sequence_mask(min_run_time):
+    results = {}
+    for batch_size, max_len in [(32, 64), (128, 512)]:
+        lengths = torch.randint(1, max_len + 1, (batch_size,))
+        results[f'sequence_mask/{batch_size}x{max_len}'] = \
+            measure(lambda: sequence_mask(lengths, max_len=max_len), min_run_time)
+    return results
+
+def bench_pooling(hidden_size, min_run_time):
+    results = {}
+    for batch_size, max_len, time_pooling, layer_pooling, n in [
+            (32, 64, 'max_avg', 'cat', 1), (32, 64, 'max_avg', 'avg', 4), (128, 128, 'max_avg', 'max', 4)]:
+        hidden_states = [torch.randn(batch_size, max_len, hidden_size) for _ in range(n)]
+        length = torch.randint(1, max_len + 1, (batch_size,))
+        time_pooler, layer_pooler = TimePooler(time_pooling), LayerPooler(layer_pooling)
+
+        def pool():
+            x_mask = sequence_mask(length, dtype=torch.float, max_len=max_len)
+            pooled = [time_pooler(None, h, length, x_mask) for h in hidden_states]
+            return pooled[0] if n == 1 else layer_pooler(pooled)
+        results[f'pooling/{time_pooling}_{layer_pooling}_{n}layers_{batch_size}x{max_len}'] = \
+            measure(pool, min_run_time)
+    return results
+
+def bench_training(data, tokenizer, args, work_dir):
+    """Seconds per train step and its stages, and per evaluation pass over the validation data"""
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(tokenizer), hidden_size=args.hidden_size,
+                        num_hidden_layers=12, num_attention_heads=2,
+                        intermediate_size=args.hidden_size * 4)
+    model = build_model(model='mbert', time_pooling='max_avg', layer_pooling='cat', layer=[11, 12],
+                        new_num_tokens=len(tokenizer), device='cpu', base_model=BertModel(config))
+    optimizer, scheduler = build_optimizer_scheduler(model=model, lr=0.00002, betas=(0.9, 0.999), eps=1e-6,
+                                                     warmup_ratio=0.1, weight_decay=0.0, layer_decrease=1.0,
+                                                     freeze_upto=-1, train_step=args.train_steps)
+    trainer = build_trainer(model=model, data=data, optimizer=optimizer, scheduler=scheduler,
+                            max_grad_norm=1.0, record_every=args.train_steps, patience=20,
+                            exp_name=os.path.join(work_dir, 'runs'), checkpoint='memory')
+    trainer.verbose = False
+    trainer.train(args.train_steps)
+
+    steps = trainer.total_steps
+    results = {f'train_step/{name}': elapsed / steps for name, elapsed in trainer.timer.totals.items()
+               if name not in ('eval', 'checkpoint')}
+    results['train_step/total'] = sum(results.values())
+    results['evaluation/val_pass'] = measure(lambda: evaluate_all(model, data.val_iter, trainer.criterion),
+                                             args.min_run_time)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    print(f"\nCompared to {baseline_file} (commit {baseline['meta'].get('commit')}):")
+    print('benchmark\tbaseline_ms\tcurrent_ms\tratio')
+    for name, seconds in results.items():
+        if name in baseline['results']:
+            before = baseline['results'][name]
+            print(f'{name}\t{before * 1e3:.4f}\t{seconds * 1e3:.4f}\t{seconds / before:.2f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_examples', type=int, default=2000)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--hidden_size', type=int, default=64)
+    parser.add_argument('--train_steps', type=int, default=20)
+    parser.add_argument('--min_run_time', type=float, default=0.5)
+    parser.add_argument('--threads', type=int, default=None, help='Number of torch threads')
+    parser.add_argument('--json', default=None, help='File to write results to')
+    parser.add_argument('--compare', default=None, help='Results of a previous run to compare to')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as work_dir:
+        paths = {split: os.path.join(work_dir, f'{split}.tsv') for split in ('train', 'val', 'test')}
+        for split, path in paths.items():
+            write_tsv(path, args.num_examples if split == 'train' else args.num_examples // 4, rng)
+        tweets = read_tweets(paths['train'])
+
+        preprocess = build_preprocess(**PREPROCESS_CONFIG)
+        tokenizer_dir = os.path.join(work_dir, 'tokenizer')
+        write_vocab(tokenizer_dir, tweets, preprocess)
+        tokenizer = build_tokenizer(model='mbert', add_cap_sign=True, textify_emoji=True,
+                                    segment_hashtag=True, preprocess=preprocess, name_or_path=tokenizer_dir)
+        data = build_data(preprocessing=lambda x: x[:509], tokenizer=tokenizer, batch_size=args.batch_size,
+                          device='cpu', train_path=paths['train'], val_path=paths['val'],
+                          test_path=paths['test'])
+
+        results = {}
+        for name, bench in [('preprocessing', lambda: bench_preprocessing(tweets[:500], args.min_run_time)),
+                            ('field', lambda: bench_field(data, args.batch_size, args.min_run_time)),
+                            ('sequence_mask', lambda: bench_sequence_mask(args.min_run_time)),
+                            ('pooling', lambda: bench_pooling(args.hidden_size, args.min_run_time)),
+                            ('training', lambda: bench_training(data, tokenizer, args, work_dir))]:
+            print(f'Running {name} benchmarks', file=sys.stderr)
+            results.update(bench())
+
+    print('benchmark\tms')
+    for name, seconds in results.items():
+        print(f'{name}\t{seconds * 1e3:.4f}')
+    if args.json:
+        meta = {'commit': git_commit(), 'torch': torch.__version__, 'threads': torch.get_num_threads(),
+                'args': vars(args)}
+        with open(args.json, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
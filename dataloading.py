@@ -1,99 +1,646 @@
+import io
+import os
+import json
+import queue
+import shutil
+import hashlib
 import logging
+import threading
+import multiprocessing
 
 import random
-from functools import partial
+from itertools import islice
 
+import numpy as np
 import torch
-from torchtext.data import RawField, Field, TabularDataset, BucketIterator
+from torchtext.data import RawField, Field, Example, Dataset, TabularDataset, BucketIterator, Batch, batch
+from torchtext.utils import unicode_csv_reader
+
+from preprocessing import segment_cache
 
 
 logger = logging.getLogger(__name__)
 
+# Buffers that TransformersField.process pads batches in, set per prefetching thread
+_buffers = threading.local()
+
 
 class TransformersField(Field):
-    """ Overrides torchtext.data.Field.process to use Tokenizer.encode as a numericalization function"""
-    def __init__(self, tokenizer, *args, **kwargs):
+    """ Overrides torchtext.data.Field to numericalize with the tokenizer of Transformers models.
+    Tokens are mapped to ids once when examples are made, and batches are padded with numpy."""
+    def __init__(self, tokenizer, *args, pad_to_multiple_of=1, **kwargs):
         super().__init__(*args, **kwargs)
-        self.numericalize_func = partial(tokenizer.encode, add_special_tokens=True)
+        self.convert_tokens_to_ids = tokenizer.convert_tokens_to_ids
+        self.token_ids = {}  # token -> id lookup, filled as tokens are seen
+        # Special tokens surrounding a sequence, e.g. [CLS] ... [SEP]
+        with_special = tokenizer.build_inputs_with_special_tokens([-1])
+        self.prefix_ids = with_special[:with_special.index(-1)]
+        self.suffix_ids = with_special[with_special.index(-1) + 1:]
+        self.num_special_tokens = len(self.prefix_ids) + len(self.suffix_ids)
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def preprocess(self, x):
+        """Maps tokens to ids right after tokenization, so that examples hold
+        token ids (without special tokens) and can be cached as they are."""
+        token_ids = self.token_ids
+        ids = []
+        for token in super().preprocess(x):
+            if token not in token_ids:
+                token_ids[token] = self.convert_tokens_to_ids(token)
+            ids.append(token_ids[token])
+        return np.array(ids, dtype=np.int64)
 
     def process(self, batch, device=None):
-        """Overrides to use numericalize_func first and then pad.
-        Note that numericalize_func is used instead of numericalize"""
-        ids_list = [self.numericalize_func(ex, device=device) for ex in batch]
-        padded, lengths = self.pad(ids_list)
-        padded = torch.tensor(padded, device=device)
-        lengths = torch.tensor(lengths, device=device)
-        if self.sequential:
-            padded = padded.contiguous()
+        """Overrides to add special tokens and pad token ids of a batch in a single array.
+        Returns the same tensors as Tokenizer.encode followed by Field.pad would."""
+        n_prefix = len(self.prefix_ids)
+        counts = np.fromiter(map(len, batch), dtype=np.int64, count=len(batch))
+        lengths = counts + self.num_special_tokens
+        max_len = int(lengths.max())
+        max_len += -max_len % self.pad_to_multiple_of
+
+        ring = getattr(_buffers, 'ring', None)
+        if ring is not None:
+            padded = ring.take((len(batch), max_len))
+            padded.fill(self.pad_token)
+        else:
+            padded = np.full((len(batch), max_len), self.pad_token, dtype=np.int64)
+        flat = np.concatenate(batch)
+        starts = np.cumsum(counts) - counts
+        rows = np.repeat(np.arange(len(batch)), counts)
+        cols = np.arange(len(flat)) - np.repeat(starts, counts) + n_prefix
+        padded[rows, cols] = flat
+        padded[:, :n_prefix] = self.prefix_ids
+        suffix_cols = (lengths - len(self.suffix_ids))[:, None] + np.arange(len(self.suffix_ids))
+        padded[np.arange(len(batch))[:, None], suffix_cols] = self.suffix_ids
+
+        padded = torch.from_numpy(padded).to(device)
+        lengths = torch.from_numpy(lengths).to(device)
         return padded, lengths
 
 
+def token_batch_size_fn(max_tokens, num_special_tokens, pad_to_multiple_of=1):
+    """Makes a `batch_size_fn` for torchtext iterators with `batch_size=max_tokens`,
+    which packs examples up to `max_tokens` tokens per padded batch."""
+    def batch_size_fn(new, count, size_so_far):
+        length = len(new.tweet) + num_special_tokens
+        length += -length % pad_to_multiple_of
+        if count == 1:
+            # An example longer than the budget makes a batch on its own
+            return min(length, max_tokens)
+        padded_length = max(length, size_so_far // (count - 1))
+        return count * padded_length
+    return batch_size_fn
+
+
+class TokenCache:
+    """On-disk cache of encoded datasets.
+    Token ids of all examples are stored in a flat array with an offsets index,
+    which are memory-mapped when loaded. Ids and labels are stored alongside.
+    Each entry is keyed by a hash of the input file, the tokenizer vocab
+    (including added tokens) and settings, e.g. do_lower_case, and the preprocessing config."""
+    def __init__(self, cache_dir, tokenizer, config=None):
+        self.cache_dir = cache_dir
+        self.fingerprint = self.tokenizer_fingerprint(tokenizer, config)
+
+    @staticmethod
+    def tokenizer_fingerprint(tokenizer, config):
+        h = hashlib.sha1()
+        h.update(type(tokenizer).__name__.encode())
+        vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        h.update('\n'.join(map(str, vocab)).encode('utf-8'))
+        h.update(json.dumps(sorted(tokenizer.added_tokens_encoder.items())).encode('utf-8'))
+        # Settings the tokenizer was made with, without paths of its files
+        settings = {k: str(v) for k, v in tokenizer.init_kwargs.items()
+                    if not k.endswith('_file') and k != 'name_or_path'}
+        h.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+        h.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def key(self, path):
+        h = hashlib.sha1(self.fingerprint.encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def path(self, data_path):
+        return os.path.join(self.cache_dir, self.key(data_path))
+
+    def load(self, cache_path, fields):
+        input_ids = np.load(os.path.join(cache_path, 'input_ids.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(cache_path, 'offsets.npy'), mmap_mode='r')
+        with open(os.path.join(cache_path, 'meta.json')) as f:
+            meta = json.load(f)
+        examples = []
+        for i, (id_, label) in enumerate(zip(meta['id'], meta['label'])):
+            ex = Example()
+            ex.id = id_
+            ex.tweet = input_ids[offsets[i]:offsets[i+1]]
+            ex.label = label
+            examples.append(ex)
+        return Dataset(examples, fields)
+
+    def save(self, cache_path, dataset):
+        lengths = [len(ex.tweet) for ex in dataset.examples]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        input_ids = np.empty(offsets[-1], dtype=np.int32)
+        for ex, start, end in zip(dataset.examples, offsets[:-1], offsets[1:]):
+            input_ids[start:end] = ex.tweet
+        meta = {'id': [ex.id for ex in dataset.examples],
+                'label': [ex.label for ex in dataset.examples]}
+
+        # Write to a temporary directory first, so that a crash never leaves a partial entry
+        tmp_path = cache_path + f'.tmp{os.getpid()}'
+        os.makedirs(tmp_path, exist_ok=True)
+        np.save(os.path.join(tmp_path, 'input_ids.npy'), input_ids)
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:  # written concurrently by another run
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class FeatureField(RawField):
+    """Pads float features of examples, shaped (length, hidden_size), to the padded length of tokens"""
+    def __init__(self, pad_to_multiple_of=1):
+        super().__init__()
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def process(self, batch, device=None):
+        max_len = max(len(f) for f in batch)
+        max_len += -max_len % self.pad_to_multiple_of
+        padded = np.zeros((len(batch), max_len, batch[0].shape[1]), dtype=np.float32)
+        for i, f in enumerate(batch):
+            padded[i, :len(f)] = f
+        return torch.from_numpy(padded).to(device)
+
+
+class FeatureCache:
+    """On-disk cache of outputs of frozen layers, computed once per example of a dataset.
+    Features of all tokens are stored in a flat float32 array with an offsets index, like TokenCache,
+    and memory-mapped when loaded. Each entry is keyed by a hash of the token ids of the dataset
+    and a fingerprint of the frozen weights."""
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.join(cache_dir, 'features')
+
+    def path(self, dataset, fingerprint):
+        h = hashlib.sha1(fingerprint.encode())
+        for ex in dataset.examples:
+            h.update(np.asarray(ex.tweet, dtype=np.int64).tobytes())
+            h.update(b'|')
+        return os.path.join(self.cache_dir, h.hexdigest())
+
+    def attach(self, dataset, cache_path, pad_to_multiple_of=1):
+        """Adds features to examples of the dataset, which then are given to models by batch.features"""
+        features = np.load(os.path.join(cache_path, 'features.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(cache_path, 'offsets.npy'), mmap_mode='r')
+        for i, ex in enumerate(dataset.examples):
+            ex.features = features[offsets[i]:offsets[i+1]]
+        dataset.fields['features'] = FeatureField(pad_to_multiple_of)
+
+    def save(self, cache_path, dataset, tweet_field, compute, batch_size, device):
+        """Writes features of all examples, computed by `compute` on padded batches sorted by length"""
+        lengths = np.array([len(ex.tweet) + tweet_field.num_special_tokens
+                            for ex in dataset.examples], dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        order = np.argsort(lengths, kind='stable')
+
+        tmp_path = cache_path + f'.tmp{os.getpid()}'
+        os.makedirs(tmp_path, exist_ok=True)
+        features = None
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            x, length = tweet_field.process([dataset.examples[i].tweet for i in indices], device)
+            hidden = compute(x, length).cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(os.path.join(tmp_path, 'features.npy'), mode='w+',
+                                                     dtype=np.float32, shape=(int(offsets[-1]), hidden.shape[-1]))
+            for row, i in enumerate(indices):
+                features[offsets[i]:offsets[i+1]] = hidden[row, :lengths[i]]
+        features.flush()
+        del features
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:  # written concurrently by another run
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+# Set before forking workers, so that they inherit the fields and the tokenizer attached to them
+_worker_fields = None
+
+def _init_worker():
+    # As in DataLoader workers, forked after torch may have started its OpenMP threads, which the
+    # child does not have, so torch ops there must not use the inherited thread pool
+    torch.set_num_threads(1)
+    segment_cache.track()
+
+def _make_examples(rows):
+    """Examples of rows, and the hashtag segmentations made for them"""
+    return [Example.fromlist(row, _worker_fields) for row in rows], segment_cache.take_updates()
+
+def read_tsv_parallel(path, fields, num_workers, chunk_size=500):
+    """Equivalent to TabularDataset(path, 'tsv', fields, skip_header=True), but examples are
+    preprocessed and tokenized by a pool of forked processes. Chunks of rows are gathered back
+    in the original order, along with new hashtag segmentations, which are merged into segment_cache.
+    Workers are forked, as fields may hold unpicklable preprocessing functions. They run no parallel
+    torch ops, so that forking after torch is initialized, e.g. with a model built, cannot deadlock."""
+    global _worker_fields
+    with io.open(os.path.expanduser(path), encoding='utf8') as f:
+        reader = unicode_csv_reader(f, delimiter='\t')
+        next(reader) # skip header
+        rows = list(reader)
+    chunks = [rows[i:i+chunk_size] for i in range(0, len(rows), chunk_size)]
+
+    _worker_fields = fields
+    examples = []
+    with multiprocessing.get_context('fork').Pool(num_workers, initializer=_init_worker) as pool:
+        for chunk_examples, segment_updates in pool.imap(_make_examples, chunks):
+            examples += chunk_examples
+            segment_cache.merge(segment_updates)
+    _worker_fields = None
+    return Dataset(examples, fields)
+
+
+class StreamingTabularDataset:
+    """Reads examples of a tsv file lazily, so that memory does not grow with the file size.
+    With `world_size` > 1, only every `world_size`-th example from `rank` is read."""
+    def __init__(self, path, fields, skip_header=True, rank=0, world_size=1):
+        self.path = path
+        self.field_list = fields
+        self.fields = dict(fields)
+        self.skip_header = skip_header
+        self.rank = rank
+        self.world_size = world_size
+
+    def rows(self):
+        with io.open(os.path.expanduser(self.path), encoding='utf8') as f:
+            reader = unicode_csv_reader(f, delimiter='\t')
+            if self.skip_header:
+                next(reader)
+            for row in reader:
+                yield row
+
+    def __iter__(self):
+        for row in islice(self.rows(), self.rank, None, self.world_size):
+            yield Example.fromlist(row, self.field_list)
+
+    def column(self, name):
+        """Yields values of a single field without processing the others, e.g. to build a vocab"""
+        idx = [n for n, _ in self.field_list].index(name)
+        field = self.fields[name]
+        for row in self.rows():
+            yield field.preprocess(row[idx].rstrip('\n'))
+
+
+class StreamingIterator:
+    """Batches a StreamingTabularDataset with bounded memory.
+    Examples are shuffled within a buffer of `shuffle_buffer` examples, and bucketed by length within
+    a window of `bucket_window` batches, which is sorted, split into batches and yielded in random order.
+    Has the same interface as BucketIterator for the Trainer."""
+    def __init__(self, dataset, batch_size, device=None, shuffle_buffer=10000,
+                 bucket_window=100, repeat=True, seed=0, batch_size_fn=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.batch_size_fn = batch_size_fn
+        self.device = device
+        self.shuffle_buffer = shuffle_buffer
+        self.bucket_window = bucket_window
+        self.repeat = repeat
+        self.random = random.Random(seed)
+
+    def shuffled(self):
+        buffer = []
+        for ex in self.dataset:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(ex)
+                continue
+            idx = self.random.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = ex
+        self.random.shuffle(buffer)
+        yield from buffer
+
+    def bucket(self, window):
+        window.sort(key=lambda x: len(x.tweet))
+        minibatches = list(batch(window, self.batch_size, self.batch_size_fn))
+        self.random.shuffle(minibatches)
+        for minibatch in minibatches:
+            minibatch.sort(key=lambda x: len(x.tweet), reverse=True)
+            yield minibatch
+
+    def minibatches(self):
+        window, window_size = [], 0
+        for ex in self.shuffled():
+            window.append(ex)
+            # in tokens when batch_size is a token budget
+            window_size += 1 if self.batch_size_fn is None else len(ex.tweet)
+            if window_size >= self.batch_size * self.bucket_window:
+                yield from self.bucket(window)
+                window, window_size = [], 0
+        if window:
+            yield from self.bucket(window)
+
+    def __iter__(self):
+        while True:
+            for minibatch in self.minibatches():
+                yield Batch(minibatch, self.dataset, self.device)
+            if not self.repeat:
+                return
+
+
+class BufferRing:
+    """Preallocated int64 buffers that are reused in turn for padded batches.
+    A buffer is handed out again after `size` batches, so `size` must exceed
+    the number of batches alive at once."""
+    def __init__(self, size):
+        self.buffers = [np.empty(0, dtype=np.int64) for _ in range(size)]
+        self.idx = 0
+
+    def take(self, shape):
+        numel = shape[0] * shape[1]
+        if self.buffers[self.idx].size < numel:
+            self.buffers[self.idx] = np.empty(numel, dtype=np.int64)
+        buf = self.buffers[self.idx][:numel].reshape(shape)
+        self.idx = (self.idx + 1) % len(self.buffers)
+        return buf
+
+
+class PrefetchIterator:
+    """Prepares the next `prefetch` batches of an iterator on a background thread.
+    On CPU, token ids of batches are padded in reusable preallocated buffers: the tensors of a batch
+    stay valid only until `batches_in_use` more batches are taken after it, so the consumer must hold
+    at most that many batches at once, e.g. the micro-batches of an accumulation step, and clone
+    tensors it keeps longer. On GPU, the wrapped iterator makes batches on CPU, whose tensors are pinned
+    and copied to `device` asynchronously. Other attributes are delegated to the wrapped iterator."""
+    _end = object()
+
+    def __init__(self, iterator, prefetch, device, batches_in_use=1):
+        self.iterator = iterator
+        self.prefetch = prefetch
+        self.batches_in_use = batches_in_use
+        self.device = torch.device(device)
+        self.pin_memory = self.device.type == 'cuda'
+        self.repeat = iterator.repeat
+        self.lock = threading.Lock()  # guards the wrapped iterator
+        self.rings = []  # free buffer rings, one is used per running producer
+
+    def __getattr__(self, name):
+        return getattr(self.iterator, name)
+
+    @staticmethod
+    def put(q, item, stop):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def pin(self, batch):
+        for name in batch.fields:
+            value = getattr(batch, name)
+            if isinstance(value, torch.Tensor):
+                setattr(batch, name, value.pin_memory())
+            elif isinstance(value, tuple):
+                setattr(batch, name, tuple(v.pin_memory() for v in value))
+        return batch
+
+    def to_device(self, batch):
+        for name in batch.fields:
+            value = getattr(batch, name)
+            if isinstance(value, torch.Tensor):
+                setattr(batch, name, value.to(self.device, non_blocking=True))
+            elif isinstance(value, tuple):
+                setattr(batch, name, tuple(v.to(self.device, non_blocking=True) for v in value))
+        return batch
+
+    def produce(self, q, repeat, ring, stop):
+        """Runs passes over the wrapped iterator, which is set to a single pass each time."""
+        _buffers.ring = ring
+        try:
+            while not stop.is_set():
+                with self.lock:
+                    self.iterator.repeat = False
+                    batches = iter(self.iterator)
+                while not stop.is_set():
+                    with self.lock:
+                        batch = next(batches, None)
+                    if batch is None:
+                        break
+                    self.put(q, self.pin(batch) if self.pin_memory else batch, stop)
+                if not repeat:
+                    break
+        except Exception as e:
+            self.put(q, e, stop)
+        self.put(q, self._end, stop)
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        # Alive at once: queued batches, the one being made, the one being handed over and those in use
+        ring = None if self.pin_memory else \
+            (self.rings.pop() if self.rings else BufferRing(self.prefetch + self.batches_in_use + 2))
+        thread = threading.Thread(target=self.produce, args=(q, self.repeat, ring, stop),
+                                  daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = q.get()
+                if batch is self._end:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield self.to_device(batch) if self.pin_memory else batch
+        finally:
+            stop.set()
+            thread.join()
+            if ring is not None:
+                self.rings.append(ring)
+
+
+def build_tweet_field(tokenizer, preprocessing, pad_to_multiple_of=1):
+    return TransformersField(tokenizer, include_lengths=True,
+                             use_vocab=False, batch_first=True,
+                             preprocessing=preprocessing,
+                             tokenize=tokenizer.tokenize,
+                             pad_token=tokenizer.pad_token_id, # id
+                             pad_to_multiple_of=pad_to_multiple_of)
+
+
 class TransformersData:
     """Data format for Transformers model. """
     def __init__(self, preprocessing, tokenizer, batch_size, device,
-                 train_path=None, val_path=None, test_path=None):
+                 train_path=None, val_path=None, test_path=None,
+                 cache_dir=None, cache_config=None, num_workers=1,
+                 stream=False, shuffle_buffer=10000, bucket_window=100,
+                 max_tokens=None, pad_to_multiple_of=1, prefetch=0,
+                 batches_in_use=1, rank=0, world_size=1):
         self.device = device
+        self.rank = rank
+        self.world_size = world_size
+        self.prefetch = prefetch
+        self.batches_in_use = batches_in_use
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.num_workers = num_workers
+        self.stream = stream
+        self.shuffle_buffer = shuffle_buffer
+        self.bucket_window = bucket_window
         self.fields = self.build_field(tokenizer, preprocessing)
+        self.cache_dir = cache_dir
+        self.cache = TokenCache(cache_dir, tokenizer, cache_config) \
+            if cache_dir is not None else None
+        self.batch_size = batch_size
         self.train, self.val, self.test =\
             self.build_dataset(train_path, val_path, test_path)
+        self.build_vocab()  # on the entire data, so that all processes share the label ids
+        self.train = self.shard(self.train)
         self.train_iter, self.val_iter, self.test_iter =\
-            self.build_iterator(batch_size, device)
-        self.build_vocab()
+            self.build_iterator(batch_size, device, max_tokens)
 
     def build_field(self, tokenizer, preprocessing):
         """Use custom defined TransformerField which is an extension of torchtext.Field"""
         ID = RawField()
-        TWEET = TransformersField(tokenizer, include_lengths=True,
-                                  use_vocab=False, batch_first=True,
-                                  preprocessing=preprocessing,
-                                  tokenize=tokenizer.tokenize,
-                                  pad_token=tokenizer.pad_token_id) # id
+        TWEET = build_tweet_field(tokenizer, preprocessing, self.pad_to_multiple_of)
         LABEL = Field(sequential=False, unk_token=None, pad_token=None)
         fields = [('id', ID), ('tweet', TWEET), ('label', LABEL)]
         return fields
 
+    def read_tsv(self, path):
+        if self.num_workers > 1:
+            return read_tsv_parallel(path, self.fields, self.num_workers)
+        return TabularDataset(path, 'tsv', self.fields, skip_header=True)
+
+    def load_dataset(self, path):
+        """Reads a tsv file, or its encoded version from the cache if available."""
+        if self.cache is None:
+            return self.read_tsv(path)
+
+        cache_path = self.cache.path(path)
+        if os.path.isdir(cache_path):
+            logger.info(f'Loading encoded {path} from cache {cache_path}')
+            return self.cache.load(cache_path, self.fields)
+
+        dataset = self.read_tsv(path)
+        os.makedirs(self.cache.cache_dir, exist_ok=True)
+        self.cache.save(cache_path, dataset)
+        logger.info(f'Encoded {path} is cached in {cache_path}')
+        return dataset
+
     def build_dataset(self, train_path, val_path, test_path):
         train = val = test = None
-        if train_path is not None:
-            train = TabularDataset(train_path, 'tsv', self.fields,
-                                   skip_header=True)
+        if train_path is not None and self.stream:
+            if val_path is None:
+                raise Exception("Streaming the training data needs val_path, "
+                                "as it cannot be split for validation")
+            if self.cache is not None:
+                logger.warning(f'Streamed training data {train_path} is not cached, '
+                               f'only validation and test data are cached in {self.cache_dir}')
+            train = StreamingTabularDataset(train_path, self.fields)
+        elif train_path is not None:
+            train = self.load_dataset(train_path)
 
-        if val_path is None:
+        if val_path is None and train is not None:
             random.seed(0)
             state = random.getstate()
             train, val = train.split(split_ratio=0.9, stratified=True,
                                        random_state=state)
-        else:
-            val = TabularDataset(val_path, 'tsv', self.fields,
-                                   skip_header=True)
+        elif val_path is not None:
+            val = self.load_dataset(val_path)
 
         if test_path is not None:
-            test = TabularDataset(test_path, 'tsv', self.fields,
-                                  skip_header=True)
+            test = self.load_dataset(test_path)
         return train, val, test
 
-    def build_iterator(self, batch_size, device):
+    def shard(self, dataset):
+        """Keeps every `world_size`-th training example for this process in distributed training.
+        Validation and test data are not sharded, as evaluation shards them by batch."""
+        if self.world_size == 1 or dataset is None:
+            return dataset
+        if isinstance(dataset, StreamingTabularDataset):
+            dataset.rank, dataset.world_size = self.rank, self.world_size
+            return dataset
+        return Dataset(dataset.examples[self.rank::self.world_size], dataset.fields)
+
+    def build_iterator(self, batch_size, device, max_tokens=None):
+        """Batches `batch_size` examples, or if `max_tokens` is given,
+        as many length-sorted examples as fit in `max_tokens` padded tokens.
+        With `prefetch`, the next batches are prepared in the background."""
+        target_device = device
+        if self.prefetch > 0 and torch.device(device).type == 'cuda':
+            device = torch.device('cpu') # PrefetchIterator copies batches to target_device
+
+        batch_size_fn = None
+        if max_tokens is not None:
+            tweet_field = dict(self.fields)['tweet']
+            batch_size_fn = token_batch_size_fn(max_tokens, tweet_field.num_special_tokens,
+                                                tweet_field.pad_to_multiple_of)
+            batch_size = max_tokens
+
         train_iter = val_iter = test_iter = None
-        if self.train is not None:
+        if isinstance(self.train, StreamingTabularDataset):
+            train_iter = StreamingIterator(self.train, batch_size, device,
+                                           shuffle_buffer=self.shuffle_buffer,
+                                           bucket_window=self.bucket_window,
+                                           batch_size_fn=batch_size_fn)
+        elif self.train is not None:
             train_iter = BucketIterator(self.train, batch_size=batch_size,
+                                        batch_size_fn=batch_size_fn,
                                         sort_key=lambda x: len(x.tweet),
                                         sort_within_batch=True, repeat=True,
                                         device=device)
         if self.val is not None:
             val_iter = BucketIterator(self.val, batch_size=batch_size,
+                                      batch_size_fn=batch_size_fn,
                                       sort_key=lambda x: len(x.tweet),
                                       sort_within_batch=True, repeat=True,
                                       device=device, train=False)
         if self.test is not None:
             test_iter = BucketIterator(self.test, batch_size=batch_size,
+                                      batch_size_fn=batch_size_fn,
                                       sort_key=lambda x: len(x.tweet),
                                       sort_within_batch=True, repeat=True,
                                       device=device, train=False)
+
+        if self.prefetch > 0:
+            train_iter, val_iter, test_iter = [
+                PrefetchIterator(it, self.prefetch, target_device, self.batches_in_use) if it is not None else None
+                for it in (train_iter, val_iter, test_iter)]
         return train_iter, val_iter, test_iter
 
+    def cache_features(self, model):
+        """Computes the output of frozen layers of `model` once per example, which is cached under
+        `cache_dir` and given to the model in place of token ids, so that only the upper layers run"""
+        if self.cache_dir is None:
+            raise Exception('Caching frozen features needs cache_dir')
+        if isinstance(self.train, StreamingTabularDataset):
+            raise Exception('Frozen features cannot be cached for streamed training data')
+        feature_cache = FeatureCache(self.cache_dir)
+        fingerprint = model.frozen_fingerprint()
+        tweet_field = dict(self.fields)['tweet']
+        model.eval()
+        for dataset in (self.train, self.val, self.test):
+            if dataset is None:
+                continue
+            cache_path = feature_cache.path(dataset, fingerprint)
+            if not os.path.isdir(cache_path):
+                os.makedirs(feature_cache.cache_dir, exist_ok=True)
+                with torch.no_grad():
+                    feature_cache.save(cache_path, dataset, tweet_field, model.frozen_features,
+                                       self.batch_size, self.device)
+                logger.info(f'Frozen features are cached in {cache_path}')
+            feature_cache.attach(dataset, cache_path, self.pad_to_multiple_of)
+
     def build_vocab(self):
         """Does not make vocab for TWEET field as it is given by Transformers models"""
-        if self.train is not None and self.val is not None:
+        if isinstance(self.train, StreamingTabularDataset):
+            self.val.fields['label'].build_vocab(self.train.column('label'), self.val)
+        elif self.train is not None and self.val is not None:
             self.train.fields['label'].build_vocab(self.train, self.val)
         elif self.test is not None:
             self.test.fields['label'].build_vocab(self.test)
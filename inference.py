@@ -7,10 +7,9 @@ from setproctitle import setproctitle
 
 from dataloading import build_data
 from model import build_model
-from trainer import evaluate
 from utils import *
 from optimizer import build_optimizer_scheduler
-from preprocessing import build_preprocess, build_tokenizer
+from preprocessing import build_preprocess, build_tokenizer, PREPROCESS_OPTIONS
 
 # torch.manual_seed(0)
 # torch.backends.cudnn.deterministic = True
@@ -24,12 +23,15 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--exp_note')
     parser.add_argument('--test_path', default='../data/olid/da/offenseval-da-training-v1-test.tsv')
+    parser.add_argument('--save_probs', action='store_true',
+                        help='Also save predictions with float32 probabilities to a .npz file')
 
     # Load from saved args
     args = parser.parse_args()
     saved_args = load_args_from_file(args.exp_note)
     saved_args.exp_note = args.exp_note
     saved_args.test_path = args.test_path
+    saved_args.save_probs = args.save_probs
     return saved_args
 
 def generate_exp_name(args):
@@ -47,20 +49,30 @@ if __name__ == "__main__":
                                   punc_limit=args.punc_limit,
                                   lower_hashtag=args.lower_hashtag,
                                   segment_hashtag=args.segment_hashtag,
-                                  add_cap_sign=args.add_cap_sign)
+                                  add_cap_sign=args.add_cap_sign,
+                                  segment_cache_size=getattr(args, 'segment_cache_size', 100000),
+                                  segment_cache_path=getattr(args, 'segment_cache_path', None))
     tokenizer = build_tokenizer(model=args.model,
                                 add_cap_sign=args.add_cap_sign,
                                 textify_emoji=args.textify_emoji,
                                 segment_hashtag=args.segment_hashtag,
                                 preprocess=preprocess)
-    preproc = lambda x: x[:509]
-    olid_data = build_data(model=args.model,
-                           preprocessing=preproc,
+    max_length = 509
+    preproc = lambda x: x[:max_length]
+    cache_config = {opt: getattr(args, opt) for opt in PREPROCESS_OPTIONS}
+    cache_config['max_length'] = max_length
+    olid_data = build_data(preprocessing=preproc,
                            tokenizer=tokenizer,
                            batch_size=args.batch_size,
                            device=args.device,
                            train_path=None,
-                           test_path=args.test_path)
+                           test_path=args.test_path,
+                           cache_dir=getattr(args, 'cache_dir', None),
+                           cache_config=cache_config,
+                           num_workers=getattr(args, 'num_workers', 1),
+                           max_tokens=getattr(args, 'max_tokens', None),
+                           pad_to_multiple_of=getattr(args, 'pad_to_multiple_of', 1),
+                           prefetch=getattr(args, 'prefetch', 0))
     model = build_model(model=args.model,
                         time_pooling=args.time_pooling,
                         layer_pooling=args.layer_pooling,
@@ -68,7 +80,8 @@ if __name__ == "__main__":
                         new_num_tokens=len(tokenizer),
                         hidden_dropout_prob=args.hidden_dropout_prob,
                         attention_probs_dropout_prob=args.attention_probs_dropout_prob,
-                        device=args.device)
+                        device=args.device,
+                        precision=getattr(args, 'precision', 'fp32'))
     model = load_model(model, args.exp_note)
     optimizer, scheduler = build_optimizer_scheduler(model=model,
                                                      lr=args.lr,
@@ -79,7 +92,11 @@ if __name__ == "__main__":
                                                      layer_decrease=args.layer_decrease,
                                                      freeze_upto=args.freeze_upto,
                                                      train_step=args.train_step)
-    f1, prec, rec, acc = evaluate(model, olid_data.test_iter)
+    pred_file = os.path.join('preds/', exp_name + '_prediction.tsv')
+    probs_file = os.path.join('preds/', exp_name + '_prediction.npz') if args.save_probs else None
+    preds, golds = write_pred_to_file(model, olid_data.test_iter, tokenizer, pred_file, probs_file)
+    f1, prec, rec, acc = (calc_f1(preds, golds), calc_prec(preds, golds),
+                          calc_rec(preds, golds), calc_acc(preds, golds))
     print()
     print('*'*80)
     print(f'Model loaded from: {args.exp_note}')
@@ -89,6 +106,3 @@ if __name__ == "__main__":
     print(f'accuracy: {acc}')
     print('*'*80)
     print()
-
-    pred_file = os.path.join('preds/', exp_name + '_prediction.tsv')
-    write_pred_to_file(model, olid_data.test_iter, tokenizer, pred_file)
@@ -1,42 +1,49 @@
+import copy
+import hashlib
+from functools import partial, reduce
+
 import torch
 
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from transformers import BertModel, RobertaModel, XLMModel, XLNetModel
-from utils import sequence_mask
+from utils import sequence_mask, autocast
 
 
 class TimePooler(nn.Module):
+    """Pools hidden states over time, with pad tokens counted as 0.
+    The mask of real tokens, x_mask, may be given to share it between layers,
+    and is made from length otherwise."""
     def __init__(self, method):
         super().__init__()
         pool_dict = {'avg': self.avg_pool, 'max': self.max_pool, 'max_avg': self.max_avg_pool, 'cls': None}
         self.method = method
         self.pooler = pool_dict[method]
 
-    def avg_pool(self, x, length):
-        x = x.masked_fill(sequence_mask(length, pad=1).unsqueeze(-1), 0.0)
-        x = torch.sum(x, dim=1)  # (batch_size, 1, hidden_size)
-        x = x.squeeze()  # (batch_size, hidden_size)
-        x = x / length.unsqueeze(-1).float()
-        return x
+    def avg_pool(self, x, length, x_mask=None):
+        if x_mask is None:
+            x_mask = sequence_mask(length, dtype=torch.float, max_len=x.size(1))
+        # Masked sum as a matmul, which does not fill a copy of x
+        x = torch.bmm(x_mask.unsqueeze(1).to(x.dtype), x).squeeze(1)  # (batch_size, hidden_size)
+        return x / length.unsqueeze(-1).float()
 
-    def max_pool(self, x, length):
-        x = x.masked_fill(sequence_mask(length, pad=1).unsqueeze(-1), 0.0)
-        x = torch.max(x, dim=1).values
-        return x
+    def max_pool(self, x, length, x_mask=None):
+        if x_mask is None:
+            x_mask = sequence_mask(length, dtype=torch.float, max_len=x.size(1))
+        return x.masked_fill(x_mask.unsqueeze(-1) == 0, 0.0).amax(dim=1)
 
-    def max_avg_pool(self, x, length):
-        x_mean = self.avg_pool(x, length)
-        x_max = self.max_pool(x, length)
-        return torch.cat([x_mean, x_max], dim=1)
+    def max_avg_pool(self, x, length, x_mask=None):
+        return torch.cat([self.avg_pool(x, length, x_mask), self.max_pool(x, length, x_mask)], dim=1)
 
-    def __call__(self, cls, x, length):
+    def __call__(self, cls, x, length, x_mask=None):
         if self.method == 'cls':
             return cls
         else:
-            return self.pooler(x, length)
+            return self.pooler(x, length, x_mask)
 
 
 class LayerPooler(nn.Module):
+    """Pools time-pooled vectors of layers, which are reduced pairwise instead of stacked"""
     def __init__(self, method):
         super().__init__()
         pool_dict = {'avg': self.avg_pool, 'max': self.max_pool,
@@ -44,12 +51,10 @@ class LayerPooler(nn.Module):
         self.pooler = pool_dict[method]
 
     def avg_pool(self, hiddens):
-        avg_h = torch.stack(hiddens).mean(dim=0)
-        return avg_h
+        return reduce(torch.add, hiddens) / len(hiddens)
 
     def max_pool(self, hiddens):
-        max_h = torch.stack(hiddens).max(dim=0).values
-        return max_h
+        return reduce(torch.maximum, hiddens)
 
     def concat(self, hiddens):
         return torch.cat(hiddens, dim=1)
@@ -59,10 +64,12 @@ class LayerPooler(nn.Module):
 
 
 class PoolClassifier(nn.Module):
-    def __init__(self, transformer_model, n_class, time_pooling, layer_pooling, layer):
+    def __init__(self, transformer_model, n_class, time_pooling, layer_pooling, layer,
+                 precision='fp32', cached_layers=0):
         super().__init__()
         self.model = transformer_model
         self.layer = layer
+        self.precision = precision
         self.time_pooling = TimePooler(time_pooling)
         self.layer_pooling = LayerPooler(layer_pooling)
         self.hidden_weights = nn.Linear(len(layer), 1)
@@ -71,49 +78,150 @@ class PoolClassifier(nn.Module):
         self.hidden_size = self.single_hidden_size * len(layer) if layer_pooling == 'cat' \
             else self.single_hidden_size
         self.out = nn.Linear(self.hidden_size, n_class)
+        # Layers above the highest pooled one are not computed, unless cls pooling needs the last
+        self.top_layer = self.model.config.num_hidden_layers if time_pooling == 'cls' else max(layer)
+        self.pooled_layers = set() if time_pooling == 'cls' else set(layer)
+        # Inputs may be the cached output of the embeddings and the first `cached_layers` layers
+        self.cached_layers = cached_layers
+        if cached_layers and not hasattr(self.model, 'encoder'):
+            raise Exception('Caching frozen layers is only supported for bert')
+        if self.pooled_layers and cached_layers > min(self.pooled_layers):
+            raise Exception(f'Layers up to {cached_layers} are cached, so cannot pool {min(self.pooled_layers)}')
+
+    def run_layers(self, hidden, x_mask, start, end):
+        """Yields the index and output of bert layers from `start` + 1 to `end`"""
+        extended_mask = (1.0 - x_mask[:, None, None, :]) * -10000.0
+        for i, layer_module in enumerate(self.model.encoder.layer[start:end], start + 1):
+            hidden = layer_module(hidden, extended_mask)[0]
+            yield i, hidden
+
+    def encode(self, x, x_mask):
+        """Runs bert up to `top_layer`, keeping hidden states of pooled layers only.
+        If x is float, it is the output of layer `cached_layers` and lower layers are skipped.
+        Returns:
+            cls (torch.FloatTensor): pooler_output if time_pooling is 'cls', otherwise None
+            hidden_states (dict): pooled layer to its hidden state (batch_size, max_length, hidden_size)
+        """
+        if x.is_floating_point():
+            start, hidden = self.cached_layers, x
+        else:
+            start, hidden = 0, self.model.embeddings(x)
+        hidden_states = {start: hidden} if start in self.pooled_layers else {}
+        for i, hidden in self.run_layers(hidden, x_mask, start, self.top_layer):
+            if i in self.pooled_layers:
+                hidden_states[i] = hidden
+        cls = self.model.pooler(hidden) if self.time_pooling.method == 'cls' else None
+        return cls, hidden_states
+
+    def frozen_features(self, x, length):
+        """Output of the embeddings and the first `cached_layers` layers, to be cached
+        and given to forward in place of x"""
+        with autocast(self.precision, x.device):
+            x_mask = sequence_mask(length, pad=0, dtype=torch.float, max_len=x.size(1))
+            hidden = self.model.embeddings(x)
+            for _, hidden in self.run_layers(hidden, x_mask, 0, self.cached_layers):
+                pass
+        return hidden.float()
+
+    def frozen_fingerprint(self):
+        """Hash of the weights of cached layers, including embeddings of added tokens,
+        which are the same across runs as init_added_embeddings makes them"""
+        h = hashlib.sha1(f'{type(self.model).__name__}-{self.cached_layers}-{self.precision}'.encode())
+        modules = [self.model.embeddings] + list(self.model.encoder.layer[:self.cached_layers])
+        for module in modules:
+            for name, p in module.state_dict().items():
+                h.update(name.encode())
+                h.update(p.detach().cpu().numpy().tobytes())
+        return h.hexdigest()
 
     def forward(self, x, length):
         """Maps input to last hidden state, to pooler_output, to prediction
         Args:
-            x (torch.LongTensor): input of shape (batch_size, seq_length)
+            x (torch.LongTensor): input of shape (batch_size, seq_length), or
+                (torch.FloatTensor): frozen_features of shape (batch_size, seq_length, hidden_size)
             length (torch.LongTensor): input of shape (batch_size, )
 
         Returns:
             x (torch.FloatTensor): logits of shape (batch_size, NUM_CLASS)
+            which are float32 also when computed in bfloat16
 
         """
-        x_mask = sequence_mask(length, pad=0, dtype=torch.float)  # (batch_size, max_length)
-        # TODO: clean this hack
-        try:  # bert, roberta
-            _, cls, hidden_states = self.model(x, attention_mask=x_mask)
-            # hidden_states : length 13 tuple of tensors (batch_size, max_length, hidden_size)
-            if len(self.layer) == 1:
-                x = self.time_pooling(cls, hidden_states[self.layer[0]], length)
-            else:
-                x = self.layer_pooling([self.time_pooling(cls, hidden_states[layer], length)
-                                        for layer in self.layer])
-        except:  # xlm, xlnet
-            x = self.model(x, attention_mask=x_mask)  # (batch_size, seq_length, hidden_size)
-            x = x[0]
-        x = self.out(x)  # (batch_size, NUM_CLASS)
-        return x
+        with autocast(self.precision, x.device):
+            x_mask = sequence_mask(length, pad=0, dtype=torch.float, max_len=x.size(1))  # (batch_size, max_length)
+            # TODO: clean this hack
+            if hasattr(self.model, 'encoder'):  # bert
+                cls, hidden_states = self.encode(x, x_mask)
+                if len(self.layer) == 1:
+                    x = self.time_pooling(cls, hidden_states.get(self.layer[0]), length, x_mask)
+                else:
+                    x = self.layer_pooling([self.time_pooling(cls, hidden_states.get(layer), length, x_mask)
+                                            for layer in self.layer])
+            else:  # xlm, xlnet
+                x = self.model(x, attention_mask=x_mask)  # (batch_size, seq_length, hidden_size)
+                x = x[0]
+            x = self.out(x)  # (batch_size, NUM_CLASS)
+        return x.float()
 
     def predict(self, x, length):
         logits = self(x, length)
         return logits.argmax(1)
 
 
+def checkpointed_forward(module, forward, *args, **kwargs):
+    if module.training and torch.is_grad_enabled():
+        return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+    return forward(*args, **kwargs)
+
+def enable_gradient_checkpointing(base_model):
+    """Recomputes activations of each encoder layer in the backward pass instead of storing them.
+    Forwards are wrapped in place, so that parameter names and checkpoints are unchanged."""
+    if hasattr(base_model, 'encoder'):  # bert
+        layers = list(base_model.encoder.layer)
+    else:  # xlm
+        layers = list(base_model.attentions) + list(base_model.ffns)
+    for layer in layers:
+        layer.forward = partial(checkpointed_forward, layer, layer.forward)
+
+
 # TODO: fix hardcoding of model names(need to be compatible with preprocessing)
-def build_model(model, time_pooling, layer_pooling, layer, new_num_tokens,
-                device, **kwargs):
-    n_class = 2
+def load_pretrained(model, new_num_tokens, **kwargs):
     if model == 'mbert':
-        base_model = BertModel.from_pretrained('bert-base-multilingual-uncased',
-                                               output_hidden_states=True, **kwargs)
+        # Hidden states are collected by PoolClassifier.encode
+        base_model = BertModel.from_pretrained('bert-base-multilingual-uncased', **kwargs)
     elif model == 'xlm':
         base_model = XLMModel.from_pretrained('xlm-mlm-100-1280',
                                               output_hidden_states=True, **kwargs)
+    old_num_tokens = base_model.get_input_embeddings().num_embeddings
     base_model.resize_token_embeddings(new_num_tokens) # All transformers models
+    init_added_embeddings(base_model, old_num_tokens)
+    return base_model
+
+def init_added_embeddings(base_model, old_num_tokens, seed=0):
+    """Initializes embeddings of tokens added to the vocab from a fixed generator instead of the
+    global one, so that they are the same in every run and process, as frozen_fingerprint needs"""
+    weight = base_model.get_input_embeddings().weight
+    if weight.size(0) <= old_num_tokens:
+        return
+    config = base_model.config
+    std = getattr(config, 'embed_init_std', None) or getattr(config, 'initializer_range', 0.02)
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        added = torch.normal(0.0, std, (weight.size(0) - old_num_tokens, weight.size(1)), generator=generator)
+        weight[old_num_tokens:] = added.to(weight.dtype)
 
-    model = PoolClassifier(base_model, n_class, time_pooling, layer_pooling, layer)
+def build_model(model, time_pooling, layer_pooling, layer, new_num_tokens,
+                device, precision='fp32', gradient_checkpointing=False, base_model=None,
+                cached_layers=0, **kwargs):
+    """Builds a classifier on pretrained weights, which are copied from `base_model`
+    if it is given instead of being loaded, e.g. to build many models in a sweep"""
+    n_class = 2
+    if base_model is not None:
+        base_model = copy.deepcopy(base_model)
+    else:
+        base_model = load_pretrained(model, new_num_tokens, **kwargs)
+    if gradient_checkpointing:
+        enable_gradient_checkpointing(base_model)
+
+    model = PoolClassifier(base_model, n_class, time_pooling, layer_pooling, layer, precision,
+                           cached_layers)
     return model.to(device)
@@ -1,10 +1,82 @@
 import re
+import math
 import logging
 
-from transformers import AdamW, get_linear_schedule_with_warmup, get_constant_schedule
+import torch
+from torch.optim import Optimizer
+from transformers import get_linear_schedule_with_warmup, get_constant_schedule
 
 logger = logging.getLogger(__name__)
 
+class MultiTensorAdamW(Optimizer):
+    """Same updates as AdamW of transformers, where weight decay follows the Adam update,
+    computed for many parameters at once with torch._foreach ops"""
+    # On CPU, parameters are updated in chunks of this many elements, which stay in cache between ops
+    cpu_chunk_numel = 2 ** 16
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-6, weight_decay=0.0, correct_bias=True):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=correct_bias)
+        super().__init__(params, defaults)
+
+    def chunks(self, params):
+        """All parameters at once on GPU, which launches the fewest kernels, and chunks on CPU"""
+        if params[0].is_cuda:
+            return [params]
+        chunks, numel = [], self.cpu_chunk_numel
+        for p in params:
+            if numel + p.numel() > self.cpu_chunk_numel:
+                chunks.append([])
+                numel = 0
+            chunks[-1].append(p)
+            numel += p.numel()
+        return chunks
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+            for p in params:
+                if p.grad.is_sparse:
+                    raise Exception('MultiTensorAdamW does not support sparse gradients')
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+                state['step'] += 1
+            for chunk in self.chunks(params):
+                self.update(chunk, group)
+        return loss
+
+    def update(self, params, group):
+        grads = [p.grad for p in params]
+        exp_avgs = [self.state[p]['exp_avg'] for p in params]
+        exp_avg_sqs = [self.state[p]['exp_avg_sq'] for p in params]
+        beta1, beta2 = group['betas']
+
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1.0 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1.0 - beta2)
+        denoms = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_add_(denoms, group['eps'])
+        if group['correct_bias']:
+            steps = [self.state[p]['step'] for p in params]
+            step_sizes = [-group['lr'] * math.sqrt(1.0 - beta2 ** step) / (1.0 - beta1 ** step)
+                          for step in steps]
+            torch._foreach_addcdiv_(params, exp_avgs, denoms, step_sizes)
+        else:
+            torch._foreach_addcdiv_(params, exp_avgs, denoms, value=-group['lr'])
+        if group['weight_decay'] > 0.0:
+            torch._foreach_add_(params, params, alpha=-group['lr'] * group['weight_decay'])
+
 def apply_wd(dt, model, weight_decay):
     no_decay = ['bias', 'LayerNorm.weight']
     for n, p in model.named_parameters():
@@ -41,6 +113,18 @@ def apply_layer_freeze(dt, model, freeze_upto):
             layers_adjusted.add(m.group())
     return dt, sorted(layers_adjusted)
 
+def merge_groups(grouped_params):
+    """One group per pair of lr and weight decay, without frozen parameters"""
+    groups = {}
+    for param_dict in grouped_params.values():
+        p = param_dict['params']
+        if not p.requires_grad:
+            continue
+        lr, weight_decay = param_dict['lr'], param_dict.get('weight_decay', 0.0)
+        group = groups.setdefault((lr, weight_decay), {'params': [], 'lr': lr, 'weight_decay': weight_decay})
+        group['params'].append(p)
+    return list(groups.values())
+
 def build_optimizer_scheduler(model, lr, betas, eps, warmup_ratio, weight_decay,
                               layer_decrease, freeze_upto, train_step):
     grouped_params = {n: {'params': p, 'lr': lr} for n, p in model.named_parameters()}
@@ -54,9 +138,10 @@ def build_optimizer_scheduler(model, lr, betas, eps, warmup_ratio, weight_decay,
         grouped_params, freezed = apply_layer_freeze(grouped_params, model, freeze_upto)
         logger.info(f'The following layers are freezed: {freezed}')
 
-    optimizer_grouped_parameters= [param_dict for param_dict in grouped_params.values()]
+    optimizer_grouped_parameters = merge_groups(grouped_params)
+    logger.info(f'{len(optimizer_grouped_parameters)} parameter groups for {len(grouped_params)} parameters')
 
-    optimizer = AdamW(optimizer_grouped_parameters, lr, eps=eps, betas=betas, correct_bias=False)
+    optimizer = MultiTensorAdamW(optimizer_grouped_parameters, lr, eps=eps, betas=betas, correct_bias=False)
     warmup = train_step * warmup_ratio
     scheduler = get_linear_schedule_with_warmup(optimizer, warmup, train_step)
     #scheduler = get_constant_schedule(optimizer)
@@ -1,11 +1,22 @@
+import os
 import re
+import json
+import atexit
 import string
+import logging
+from collections import OrderedDict
 from functools import reduce, partial
 
 import emoji
 from wordsegment import load, segment
 from transformers import BertTokenizer, RobertaTokenizer, XLMTokenizer, XLNetTokenizer
 
+logger = logging.getLogger(__name__)
+
+# Options of `build_preprocess` changing its output, which together with the tokenizer determine the encoded data
+PREPROCESS_OPTIONS = ['demojize', 'textify_emoji', 'mention_limit', 'punc_limit',
+                      'lower_hashtag', 'segment_hashtag', 'add_cap_sign']
+
 
 def compose(*funcs):
     """" Compose functions so that they are applied in chain. """
@@ -54,45 +65,192 @@ def lower_hashtags(sent):
     """ e.g.  #MAGA -> #maga """
     return re.sub('#[\S]+', lambda match: match.group().lower(), sent)
 
+class SegmentCache:
+    """ Bounded LRU cache of hashtag segmentations, optionally persisted to disk.
+    The unigram/bigram tables of wordsegment are loaded on the first miss only.
+    Worker processes record their new segmentations with `track`, which the parent process
+    merges, as workers exit without saving."""
+    def __init__(self, maxsize=100000, path=None):
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.loaded = False
+        self.added = None  # new segmentations while tracking
+        self.path = None
+        self.configure(maxsize, path)
+
+    def configure(self, maxsize, path=None):
+        self.maxsize = maxsize
+        if path is not None and path != self.path:
+            if self.path is None:
+                atexit.register(self.save)
+            self.path = path
+            self.read()
+        self.evict()
+
+    def __call__(self, hashtag):
+        if hashtag in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(hashtag)
+            return self.cache[hashtag]
+        self.misses += 1
+        if not self.loaded:
+            load()
+            self.loaded = True
+        segmented = ' '.join(segment(hashtag))
+        if self.added is not None:
+            self.added[hashtag] = segmented
+        if self.maxsize > 0:
+            self.cache[hashtag] = segmented
+            self.evict()
+        return segmented
+
+    def evict(self):
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def track(self):
+        """Starts recording new segmentations and counting hits and misses anew"""
+        self.added, self.hits, self.misses = {}, 0, 0
+
+    def take_updates(self):
+        """New segmentations and counts of hits and misses since the last call, to be merged
+        into the cache of another process"""
+        updates = (self.added, self.hits, self.misses)
+        self.track()
+        return updates
+
+    def merge(self, updates):
+        added, hits, misses = updates
+        for hashtag, segmented in added.items():
+            self.cache[hashtag] = segmented
+            self.cache.move_to_end(hashtag)
+        self.hits += hits
+        self.misses += misses
+        self.evict()
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.cache), 'maxsize': self.maxsize}
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            self.cache.update(json.load(f))
+        logger.info(f'{len(self.cache)} hashtag segmentations loaded from {self.path}')
+
+    def save(self):
+        if self.path is None or self.misses == 0:
+            return
+        tmp_path = self.path + f'.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.cache, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        logger.info(f'Hashtag segmentation cache saved in {self.path} ({self.info()})')
+
+segment_cache = SegmentCache()
+
 def segment_hashtags(sent):
     """ e.g. #MakeAmericaGreatAgain -> make america great again"""
-    return re.sub('#[\S]+', lambda match: ' '.join(segment(match.group())), sent)
+    return re.sub('#[\S]+', lambda match: segment_cache(match.group()), sent)
     #ret = re.sub('#[\S]+', lambda match: ' '.join(segment(match.group())), sent)
     #return '<hashtag> ' + ret + ' </hashtag>'
 
 def replace_urls(sent):
     return sent.replace('URL', 'http')
 
-def build_preprocess(demojize, textify_emoji, mention_limit, punc_limit, lower_hashtag,
-                     segment_hashtag, add_cap_sign):
-    if textify_emoji and not demojize:
-        raise Exception("textify_emoji is meaningless without demojize")
+class Normalizer:
+    """ Applies the preprocessing functions above in order, with the same output as chaining them.
+    All patterns are compiled once, and the rewrites are fused into as few passes as possible:
+    mentions and punctuations are limited by a single regex, and hashtags are rewritten
+    in the same loop over tokens that adds capital signs."""
+    emoji_pattern = re.compile(':[\S]+:')
+    emoji_table = str.maketrans({'_': ' ', '-': ' ', ':': None})
+    hashtag_pattern = re.compile('#[\S]+')
+    cap_exceptions = frozenset(['@USER', 'URL'])
 
-    funcs = [replace_urls] # default
-    if demojize:
-        funcs.append(replace_emojis)
-    if textify_emoji:
-        funcs.append(textify_emojis)
-    if mention_limit > 0:
-        funcs.append(partial(limit_mentions, keep_num=mention_limit))
-    if punc_limit > 0:
-        funcs.append(partial(limit_punctuations, keep_num=punc_limit))
-    if lower_hashtag:
-        funcs.append(lower_hashtags)
+    def __init__(self, demojize, textify_emoji, mention_limit, punc_limit, lower_hashtag,
+                 segment_hashtag, add_cap_sign):
+        if textify_emoji and not demojize:
+            raise Exception("textify_emoji is meaningless without demojize")
+        self.demojize = demojize
+        self.textify_emoji = textify_emoji
+        self.add_cap_sign = add_cap_sign
+        self.limit_pattern = self.build_limit_pattern(mention_limit, punc_limit)
+        self.mention_sub = '@USER ' * mention_limit
+        self.punc_limit = punc_limit
+        self.rewrite_hashtag = self.build_hashtag_rewrite(lower_hashtag, segment_hashtag)
+
+    @staticmethod
+    def build_limit_pattern(mention_limit, punc_limit):
+        patterns = []
+        if mention_limit > 0:
+            patterns.append(f'(?P<mention>(?:@USER\\s*){{{mention_limit + 1},}})')
+        if punc_limit > 0:
+            patterns.append(f'(?P<punc>[!?.])(?P=punc){{{punc_limit},}}')
+        return re.compile('|'.join(patterns)) if patterns else None
+
+    @staticmethod
+    def build_hashtag_rewrite(lower_hashtag, segment_hashtag):
+        if lower_hashtag and segment_hashtag:
+            return lambda match: segment_cache(match.group().lower())
+        elif lower_hashtag:
+            return lambda match: match.group().lower()
+        elif segment_hashtag:
+            return lambda match: segment_cache(match.group())
+        return None
+
+    def limit(self, match):
+        if match.lastgroup == 'mention':
+            return self.mention_sub
+        return match.group('punc') * self.punc_limit
+
+    def cap_sign(self, token):
+        if token.lower() == token or token in self.cap_exceptions:
+            return token
+        return ('<all_cap> ' if token.upper() == token else '<has_cap> ') + token
+
+    def __call__(self, sent):
+        sent = sent.replace('URL', 'http')
+        if self.demojize:
+            sent = emoji.demojize(sent)
+        if self.textify_emoji:
+            sent = self.emoji_pattern.sub(lambda match: match.group().translate(self.emoji_table), sent)
+        if self.limit_pattern is not None:
+            sent = self.limit_pattern.sub(self.limit, sent)
+        if self.add_cap_sign:
+            # Hashtags never span whitespace, so they are rewritten token by token
+            tokens = []
+            for token in sent.split():
+                if self.rewrite_hashtag is not None and '#' in token:
+                    tokens += map(self.cap_sign, self.hashtag_pattern.sub(self.rewrite_hashtag, token).split())
+                else:
+                    tokens.append(self.cap_sign(token))
+            sent = ' '.join(tokens)
+        elif self.rewrite_hashtag is not None:
+            sent = self.hashtag_pattern.sub(self.rewrite_hashtag, sent)
+        return sent
+
+    def batch(self, sents):
+        return [self(sent) for sent in sents]
+
+def build_preprocess(demojize, textify_emoji, mention_limit, punc_limit, lower_hashtag,
+                     segment_hashtag, add_cap_sign, segment_cache_size=100000,
+                     segment_cache_path=None):
     if segment_hashtag:
-        load()
-        funcs.append(segment_hashtags)
-    if add_cap_sign:
-        funcs.append(add_capital_signs)
-    return compose(*funcs)
+        segment_cache.configure(segment_cache_size, segment_cache_path)
+    return Normalizer(demojize, textify_emoji, mention_limit, punc_limit,
+                      lower_hashtag, segment_hashtag, add_cap_sign)
 
 # TODO: consider using Config
 # TODO: Fix hard code of model names(also in build_model)
-def build_tokenizer(model, add_cap_sign, textify_emoji, segment_hashtag, preprocess):
+def build_tokenizer(model, add_cap_sign, textify_emoji, segment_hashtag, preprocess, name_or_path=None):
+    """name_or_path overrides the pretrained tokenizer, e.g. with a local directory"""
     if model == 'mbert':
-        tokenizer = BertTokenizer.from_pretrained('bert-base-multilingual-uncased')
+        tokenizer = BertTokenizer.from_pretrained(name_or_path or 'bert-base-multilingual-uncased')
     elif model =='xlm':
-        tokenizer = XLMTokenizer.from_pretrained('xlm-mlm-100-1280')
+        tokenizer = XLMTokenizer.from_pretrained(name_or_path or 'xlm-mlm-100-1280')
 
     tokenizer.add_tokens(['@USER']) # All Transformers models
 
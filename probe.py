@@ -0,0 +1,255 @@
+import os
+import json
+import shutil
+import logging
+from itertools import product
+
+import numpy as np
+import torch
+import torch.nn as nn
+from setproctitle import setproctitle
+
+from model import build_model, TimePooler, LayerPooler
+from utils import *
+from train import build_parser, parse_args, prepare_data
+from preprocessing import PREPROCESS_OPTIONS
+
+logger = logging.getLogger(__name__)
+
+NUM_LAYERS = 12
+SPLITS = ['train', 'val', 'test']
+
+def add_probe_args(parser):
+    probe = parser.add_argument_group('Probe options')
+    probe.add_argument('--probe_dir', default=None,
+                       help='Directory to store pooled features in. Defaults to runs/{note}_probe. '
+                            'Features are reused if it has them for the same model, precision, '
+                            'data and preprocessing, and extracted again otherwise.')
+    probe.add_argument('--probe_time_poolings', nargs='+', default=['cls', 'avg', 'max', 'max_avg'],
+                       choices=['cls', 'avg', 'max', 'max_avg'])
+    probe.add_argument('--probe_layer_poolings', nargs='+', default=['avg', 'max', 'cat'],
+                       choices=['avg', 'max', 'cat'])
+    probe.add_argument('--probe_layer_sets', nargs='+', default=None,
+                       help='Sets of layers to pool, e.g. 12 11,12 9-12. '
+                            'Defaults to each layer, and the top 2, 3, 4, 6 and 12 layers.')
+    probe.add_argument('--probe_epochs', type=int, default=20)
+    probe.add_argument('--probe_lr', type=float, default=0.001)
+    probe.add_argument('--probe_batch_size', type=int, default=64)
+    probe.add_argument('--results', default=None,
+                       help='Table of results. Defaults to runs/{note}_probe.tsv')
+    return parser
+
+def parse_layer_set(layer_set):
+    layers = []
+    for part in layer_set.split(','):
+        start, _, end = part.partition('-')
+        layers += range(int(start), int(end or start) + 1)
+    return sorted(set(layers))
+
+def default_layer_sets():
+    singles = [[layer] for layer in range(1, NUM_LAYERS + 1)]
+    tops = [list(range(NUM_LAYERS - k + 1, NUM_LAYERS + 1)) for k in (2, 3, 4, 6, 12)]
+    return singles + tops
+
+def probe_configs(time_poolings, layer_poolings, layer_sets):
+    """Pooling configurations, where layer pooling is only varied for multiple layers"""
+    configs = []
+    for time_pooling, layers in product(time_poolings, layer_sets):
+        for layer_pooling in (layer_poolings if len(layers) > 1 else layer_poolings[:1]):
+            configs.append((time_pooling, layer_pooling, layers))
+    return configs
+
+def probe_meta(args):
+    """Options that pooled features depend on, which must match for them to be reused"""
+    return {'model': args.model, 'precision': args.precision, 'train_path': args.train_path,
+            'val_path': args.val_path, 'test_path': args.test_path,
+            **{opt: getattr(args, opt) for opt in PREPROCESS_OPTIONS}}
+
+def load_meta(meta_file, args):
+    """Sizes of the splits of stored features, or None if there are none for args"""
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        meta = json.load(f)
+    sizes = meta.pop('sizes')
+    current = probe_meta(args)
+    changed = sorted(k for k in set(meta) | set(current) if meta.get(k) != current.get(k))
+    if changed:
+        logger.warning(f'Pooled features in {os.path.dirname(meta_file)} were extracted with other '
+                       f'options, so they are extracted again: '
+                       + ', '.join(f'{k}={meta.get(k)!r} (now {current.get(k)!r})' for k in changed))
+        return None
+    return sizes
+
+
+class NpyWriter:
+    """Writes a .npy file of rows whose number is only known at the end. Rows are appended
+    to a raw file, which is copied after the header on close."""
+    def __init__(self, file_name, row_shape, dtype):
+        self.file_name = file_name
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self.raw = open(file_name + '.raw', 'wb')
+
+    def append(self, rows):
+        np.ascontiguousarray(rows, dtype=self.dtype).tofile(self.raw)
+        self.rows += len(rows)
+
+    def close(self):
+        self.raw.close()
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False,
+                  'shape': (self.rows,) + self.row_shape}
+        with open(self.file_name, 'wb') as f, open(self.raw.name, 'rb') as raw:
+            np.lib.format.write_array_header_1_0(f, header)
+            shutil.copyfileobj(raw, f, 1 << 24)
+        os.remove(self.raw.name)
+
+
+class PooledFeatures:
+    """Time-pooled hidden states of all layers of a split, stored as .npy files in `path`:
+        cls: (num_examples, hidden_size) pooler output, which cls pooling uses for every layer
+        avg, max: (num_examples, NUM_LAYERS, hidden_size)
+        labels: (num_examples,)
+    """
+    def __init__(self, path, split):
+        self.arrays = {name: np.load(os.path.join(path, f'{split}_{name}.npy'), mmap_mode='r')
+                       for name in ['cls', 'avg', 'max', 'labels']}
+        self.labels = torch.from_numpy(np.array(self.arrays['labels']))
+
+    def layer(self, name, layer):
+        if name == 'cls':
+            return torch.from_numpy(np.array(self.arrays['cls']))
+        return torch.from_numpy(np.array(self.arrays[name][:, layer - 1]))
+
+    def pooled(self, time_pooling, layer_pooling, layers):
+        """Same as the input of PoolClassifier.out with the given pooling"""
+        if time_pooling == 'max_avg':
+            pooled = [torch.cat([self.layer('avg', l), self.layer('max', l)], dim=1) for l in layers]
+        else:
+            pooled = [self.layer(time_pooling, l) for l in layers]
+        if len(layers) == 1:
+            return pooled[0]
+        return LayerPooler(layer_pooling)(pooled)
+
+    @staticmethod
+    def extract(model, data_iter, path, split, precision='fp32'):
+        """Runs the encoder once over data_iter, and writes pooled features of all layers.
+        Returns the number of examples, which are counted as they come for streamed data."""
+        hidden_size = model.model.config.hidden_size
+        writers = {name: NpyWriter(os.path.join(path, f'{split}_{name}.npy'), shape, dtype)
+                   for name, shape, dtype in [('cls', (hidden_size,), np.float32),
+                                              ('avg', (NUM_LAYERS, hidden_size), np.float32),
+                                              ('max', (NUM_LAYERS, hidden_size), np.float32),
+                                              ('labels', (), np.int64)]}
+        avg_pooler, max_pooler = TimePooler('avg'), TimePooler('max')
+        model.eval()
+        repeat, data_iter.repeat = data_iter.repeat, False
+        try:
+            with torch.no_grad():
+                for batch in data_iter:
+                    x, length = model_inputs(batch)
+                    with autocast(precision, x.device):
+                        x_mask = sequence_mask(length, pad=0, dtype=torch.float, max_len=x.size(1))
+                        _, hidden_states = model.encode(x, x_mask)
+                        cls = model.model.pooler(hidden_states[NUM_LAYERS])
+                    writers['cls'].append(cls.float().cpu().numpy())
+                    for name, pooler in [('avg', avg_pooler), ('max', max_pooler)]:
+                        pooled = torch.stack([pooler(None, hidden_states[layer], length, x_mask)
+                                              for layer in range(1, NUM_LAYERS + 1)], dim=1)
+                        writers[name].append(pooled.float().cpu().numpy())
+                    writers['labels'].append(batch.label.cpu().numpy())
+        finally:
+            data_iter.repeat = repeat
+        for writer in writers.values():
+            writer.close()
+        return writers['labels'].rows
+
+def train_head(train, val, test, time_pooling, layer_pooling, layers, epochs, lr, batch_size):
+    """Trains a PoolClassifier.out head on pooled features, and evaluates it at the epoch
+    with the best validation F1"""
+    torch.manual_seed(0)
+    x_train = train.pooled(time_pooling, layer_pooling, layers)
+    x_val = val.pooled(time_pooling, layer_pooling, layers)
+    x_test = test.pooled(time_pooling, layer_pooling, layers) if test is not None else None
+    head = nn.Linear(x_train.size(1), 2)
+    optimizer = torch.optim.Adam(head.parameters(), lr=lr)
+    criterion = nn.CrossEntropyLoss()
+
+    best = {'val_f1': -1.0}
+    for epoch in range(1, epochs + 1):
+        head.train()
+        for idx in torch.randperm(len(x_train)).split(batch_size):
+            optimizer.zero_grad()
+            criterion(head(x_train[idx]), train.labels[idx]).backward()
+            optimizer.step()
+        head.eval()
+        with torch.no_grad():
+            val_f1 = calc_f1(head(x_val).argmax(1).tolist(), val.labels.tolist())
+            if val_f1 > best['val_f1']:
+                best = {'val_f1': val_f1, 'epoch': epoch}
+                if x_test is not None:
+                    best['test_f1'] = calc_f1(head(x_test).argmax(1).tolist(), test.labels.tolist())
+    return best
+
+def write_results(results, file_name):
+    header = ['time_pooling', 'layer_pooling', 'layers', 'epoch', 'val_f1', 'test_f1']
+    results = sorted(results, key=lambda r: r['val_f1'], reverse=True)
+    columns = [[','.join(map(str, r['layers'])) if k == 'layers' else
+                f'{r[k]:.4f}' if isinstance(r.get(k), float) else str(r.get(k))
+                for r in results] for k in header]
+    write_to_file(file_name, header, *columns)
+
+
+if __name__ == "__main__":
+    args = parse_args(add_probe_args(build_parser()))
+    setproctitle(args.note)
+    probe_dir = args.probe_dir or os.path.join('runs', f'{args.note}_probe')
+    meta_file = os.path.join(probe_dir, 'meta.json')
+
+    sizes = load_meta(meta_file, args)
+    if sizes is None:
+        if args.model != 'mbert':
+            raise Exception('Probing is only supported for bert')
+        tokenizer, olid_data = prepare_data(args)
+        # Pools all layers, so that encode keeps the hidden states of each
+        model = build_model(model=args.model,
+                            time_pooling='avg',
+                            layer_pooling='cat',
+                            layer=list(range(1, NUM_LAYERS + 1)),
+                            new_num_tokens=len(tokenizer),
+                            device=args.device,
+                            precision=args.precision)
+        os.makedirs(probe_dir, exist_ok=True)
+        if os.path.exists(meta_file):
+            os.remove(meta_file)  # so that partly overwritten features are not reused
+        sizes = {}
+        for split in SPLITS:
+            data_iter = getattr(olid_data, f'{split}_iter')
+            if data_iter is not None:
+                sizes[split] = PooledFeatures.extract(model, data_iter, probe_dir, split, args.precision)
+                logger.info(f'Pooled features of {sizes[split]} {split} examples are in {probe_dir}')
+        with open(meta_file, 'w') as f:
+            json.dump({'sizes': sizes, **probe_meta(args)}, f)
+
+    train, val, test = [PooledFeatures(probe_dir, split) if split in sizes else None
+                        for split in SPLITS]
+    layer_sets = [parse_layer_set(s) for s in args.probe_layer_sets] \
+        if args.probe_layer_sets else default_layer_sets()
+    configs = probe_configs(args.probe_time_poolings, args.probe_layer_poolings, layer_sets)
+
+    results = []
+    for i, (time_pooling, layer_pooling, layers) in enumerate(configs, 1):
+        best = train_head(train, val, test, time_pooling, layer_pooling, layers,
+                          args.probe_epochs, args.probe_lr, args.probe_batch_size)
+        results.append({'time_pooling': time_pooling, 'layer_pooling': layer_pooling,
+                        'layers': layers, **best})
+        logger.info(f'[{i}/{len(configs)}] {time_pooling} {layer_pooling} {layers}: {best}')
+
+    results_file = args.results or os.path.join('runs', f'{args.note}_probe.tsv')
+    os.makedirs(os.path.dirname(results_file) or '.', exist_ok=True)
+    write_results(results, results_file)
+    best = max(results, key=lambda r: r['val_f1'])
+    print(f'{len(results)} pooling configurations probed')
+    print(f'Best: {best}')
+    print(f'Results are written to {results_file}')
@@ -0,0 +1,42 @@
+#!/bin/bash
+# Trains on each language in fp32 and bf16, and prints F1 and throughput side by side
+train_data=(../data/2020/ar/offenseval-ar-training-v1-train.tsv\
+            ../data/2020/da/offenseval-da-training-v1-train.tsv\
+            ../data/2020/el/offenseval-greek-training-v1-train.tsv\
+            ../data/2020/en/olid-training-v1.0-train.tsv\
+            ../data/2020/tr/offenseval-tr-training-v1-train.tsv)
+
+test_data=(../data/2020/ar/offenseval-ar-training-v1-test.tsv\
+           ../data/2020/da/offenseval-da-training-v1-test.tsv\
+           ../data/2020/el/offenseval-greek-training-v1-test.tsv\
+           ../data/2020/en/olid-training-v1.0-test.tsv\
+           ../data/2020/tr/offenseval-tr-training-v1-test.tsv)
+
+langs=(ar da el en tr)
+precisions=(fp32 bf16)
+
+for ((i=0; i<${#test_data[@]}; i++));do
+    for precision in ${precisions[@]}; do
+        note=mBERT_${langs[$i]}_${precision}
+        echo train on ${train_data[$i]} and test on ${test_data[$i]}, with note $note
+
+        python train.py \
+         --train_path ${train_data[$i]} \
+         --test_path ${test_data[$i]} \
+         --demojize --lower_hashtag --segment_hashtag --textify_emoji \
+         --mention_limit 0 --punc_limit 0 \
+         --model mbert --time_pooling max_avg --layer 12 \
+         --attention_probs_dropout_prob 0.1 --hidden_dropout_prob 0.3 \
+         --lr 0.00002 --weight_decay 0.0 --layer_decrease 1.0 --freeze_upto -1 --warmup_ratio 0.1 \
+         --batch_size 16 --train_step 700 --patience 20 --precision $precision --note $note
+    done
+done
+
+for lang in ${langs[@]}; do
+    for precision in ${precisions[@]}; do
+        summary=$(ls -d runs/mBERT_${lang}_${precision}/*/ | tail -n 1)summary.txt
+        f1=$(grep -A1 'On test data' $summary | tail -n 1 | sed 's/.*f1-//')
+        throughput=$(grep 'Training throughput' $summary | sed 's/.*: //')
+        echo -e "$lang\t$precision\tf1: $f1\t$throughput"
+    done
+done
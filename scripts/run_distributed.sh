@@ -0,0 +1,9 @@
+#!/bin/bash
+# Trains with N data-parallel processes on this machine, e.g.
+#   scripts/run_distributed.sh 4 --train_path ... --batch_size 8 --note $NOTE
+# Cores are split evenly between processes unless OMP_NUM_THREADS is set.
+nproc_per_node=$1
+shift
+
+export OMP_NUM_THREADS=${OMP_NUM_THREADS:-$(( $(nproc) / nproc_per_node ))}
+torchrun --standalone --nproc_per_node $nproc_per_node train.py --distributed "$@"
@@ -0,0 +1,33 @@
+#!/bin/bash
+# Trains with 1, 2, 4 and 8 processes, and prints throughput and scaling efficiency,
+# which is the throughput relative to N times that of a single process
+train_path=../data/2020/da/offenseval-da-training-v1-train.tsv
+test_path=../data/2020/da/offenseval-da-training-v1-test.tsv
+num_procs=(1 2 4 8)
+
+for n in ${num_procs[@]}; do
+    note=mBERT_da_np${n}
+    echo train with $n processes, with note $note
+
+    scripts/run_distributed.sh $n \
+     --train_path $train_path \
+     --test_path $test_path \
+     --demojize --lower_hashtag --segment_hashtag --textify_emoji \
+     --mention_limit 0 --punc_limit 0 \
+     --model mbert --time_pooling max_avg --layer 12 \
+     --attention_probs_dropout_prob 0.1 --hidden_dropout_prob 0.3 \
+     --lr 0.00002 --weight_decay 0.0 --layer_decrease 1.0 --freeze_upto -1 --warmup_ratio 0.1 \
+     --batch_size 16 --train_step 200 --patience 20 --note $note
+done
+
+echo -e "processes\texamples/sec\tefficiency\tf1"
+for n in ${num_procs[@]}; do
+    summary=$(ls -d runs/mBERT_da_np${n}/*/ | tail -n 1)summary.txt
+    f1=$(grep -A1 'On test data' $summary | tail -n 1 | sed 's/.*f1-//')
+    throughput=$(grep 'Training throughput' $summary | sed 's/.*: \([0-9.]*\) examples.*/\1/')
+    if [ $n -eq 1 ]; then
+        base=$throughput
+    fi
+    efficiency=$(awk -v t=$throughput -v b=$base -v n=$n 'BEGIN {printf "%.3f", t / (n * b)}')
+    echo -e "$n\t$throughput\t$efficiency\t$f1"
+done
@@ -0,0 +1,35 @@
+#!/bin/bash
+# Trains on each OffensEval language with note $1_{lang}, passing the rest of the arguments
+# to train.py, e.g. to compare a feature with a baseline in time to a target F1:
+#   scripts/time_to_target.sh base
+#   scripts/time_to_target.sh bf16 --precision bf16
+#   python time_to_target.py base bf16
+declare -A train_data
+declare -A test_data
+
+train_data[ar]=../data/2020/ar/offenseval-ar-training-v1-train.tsv
+train_data[da]=../data/2020/da/offenseval-da-training-v1-train.tsv
+train_data[el]=../data/2020/el/offenseval-greek-training-v1-train.tsv
+train_data[en]=../data/2020/en/olid-training-v1.0-train.tsv
+train_data[tr]=../data/2020/tr/offenseval-tr-training-v1-train.tsv
+
+test_data[ar]=../data/2020/ar/offenseval-ar-training-v1-test.tsv
+test_data[da]=../data/2020/da/offenseval-da-training-v1-test.tsv
+test_data[el]=../data/2020/el/offenseval-greek-training-v1-test.tsv
+test_data[en]=../data/2020/en/olid-training-v1.0-test.tsv
+test_data[tr]=../data/2020/tr/offenseval-tr-training-v1-test.tsv
+
+for lang in ar da el en tr; do
+    note=$1_${lang}
+    echo train on ${train_data[$lang]}, with note $note
+
+    python train.py \
+     --train_path ${train_data[$lang]} \
+     --test_path ${test_data[$lang]} \
+     --demojize --lower_hashtag --segment_hashtag --textify_emoji \
+     --mention_limit 0 --punc_limit 0 \
+     --model mbert --time_pooling max_avg --layer 12 \
+     --attention_probs_dropout_prob 0.1 --hidden_dropout_prob 0.3 \
+     --lr 0.00002 --weight_decay 0.0 --layer_decrease 1.0 --freeze_upto -1 --warmup_ratio 0.1 \
+     --batch_size 16 --train_step 700 --patience 20 --cuda 1 --note $note "${@:2}"
+done
@@ -25,25 +25,21 @@ trn=${train_data[$1]}
 trn_size=${train_size[$1]}
 tst=${test_data[$1]}
 
-layers=(11 12)
-lrs=(0.00005 0.00001 0.0005)
-warmup_ratio=(0 0.1)
 batch_size=16
 epoch=3
 patience=1000
+trn_step=$(( $trn_size / $batch_size * $epoch))
 
-for i in {1..10}; do
-    l=${layers[$(( $RANDOM % ${#layers[@]} ))]}
-    lr=${lrs[$(( $RANDOM % ${#lrs[@]} ))]}
-    w_r=${warmup_ratio[$(( $RANDOM % ${#warmup_ratio[@]} ))]}
-    trn_step=$(( $trn_size / $batch_size * $epoch))
-
-    python train.py \
-     --train_path $trn --test_path $tst \
-     --demojize --lower_hashtag --segment_hashtag --textify_emoji \
-     --mention_limit 3 --punc_limit 3 \
-     --model mbert --time_pooling max_avg --layer $l \
-     --attention_probs_dropout_prob 0.1 --hidden_dropout_prob 0.3 \
-     --lr $lr --weight_decay 0.0 --layer_decrease 1.0 --freeze_upto -1 --warmup_ratio $w_r \
-     --batch_size $batch_size --train_step $trn_step --patience $patience --cuda 1 --note $1_tuning_$i
-done
+# Samples 10 of layers x lrs x warmup ratios, and trains them in one process which loads
+# the data and mBERT once. Results are written to runs/$1_tuning_sweep.tsv
+python tune.py \
+ --train_path $trn --test_path $tst \
+ --demojize --lower_hashtag --segment_hashtag --textify_emoji \
+ --mention_limit 3 --punc_limit 3 \
+ --model mbert --time_pooling max_avg \
+ --attention_probs_dropout_prob 0.1 --hidden_dropout_prob 0.3 \
+ --weight_decay 0.0 --layer_decrease 1.0 --freeze_upto -1 \
+ --batch_size $batch_size --train_step $trn_step --patience $patience --cuda 1 \
+ --trials 10 --concurrent_trials ${2:-2} \
+ --layers 11 12 --lrs 0.00005 0.00001 0.0005 --warmup_ratios 0 0.1 \
+ --note $1_tuning
@@ -0,0 +1,268 @@
+import os
+import time
+import json
+import asyncio
+import argparse
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from setproctitle import setproctitle
+
+from dataloading import build_tweet_field
+from model import build_model
+from utils import *
+from preprocessing import build_preprocess, build_tokenizer
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt = '%m/%d/%Y %H:%M:%S', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Serves predictions of a trained model over HTTP. POST /predict with {"tweet": "..."} '
+                    'returns the label and probabilities, GET /metrics latency and batch sizes, '
+                    'and POST /metrics/reset clears them.')
+    parser.add_argument('--exp_note', help='Note of the experiment, or its run directory')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=5.0,
+                        help='How long the first request of a batch waits for others to join it')
+    parser.add_argument('--metrics_window', type=int, default=10000,
+                        help='Number of the latest requests and batches that metrics are computed over')
+    parser.add_argument('--cpu', action='store_true', help='Runs on CPU even if the model was trained on GPU')
+    return parser.parse_args()
+
+
+class Predictor:
+    """Classifies a batch of tweets, which are preprocessed and encoded as in training"""
+    def __init__(self, model, field, labels, device):
+        self.model = model
+        self.field = field
+        self.labels = labels
+        self.device = device
+
+    def __call__(self, tweets):
+        x, length = self.field.process([self.field.preprocess(tweet) for tweet in tweets], device=self.device)
+        with torch.no_grad():
+            probs = self.model(x, length).float().softmax(1).tolist()
+        return [{'label': self.labels[p.index(max(p))],
+                 'probs': dict(zip(self.labels, p))} for p in probs]
+
+def build_predictor(exp_note, cpu=False):
+    exp_path = find_exp(exp_note)
+    args = load_args_from_file(exp_path)
+    device = torch.device('cpu') if cpu else args.device
+    preprocess = build_preprocess(demojize=args.demojize,
+                                  textify_emoji=args.textify_emoji,
+                                  mention_limit=args.mention_limit,
+                                  punc_limit=args.punc_limit,
+                                  lower_hashtag=args.lower_hashtag,
+                                  segment_hashtag=args.segment_hashtag,
+                                  add_cap_sign=args.add_cap_sign,
+                                  segment_cache_size=getattr(args, 'segment_cache_size', 100000),
+                                  segment_cache_path=getattr(args, 'segment_cache_path', None))
+    tokenizer = build_tokenizer(model=args.model,
+                                add_cap_sign=args.add_cap_sign,
+                                textify_emoji=args.textify_emoji,
+                                segment_hashtag=args.segment_hashtag,
+                                preprocess=preprocess,
+                                name_or_path=exp_path)
+    max_length = 509
+    field = build_tweet_field(tokenizer, lambda x: x[:max_length],
+                              getattr(args, 'pad_to_multiple_of', 1))
+    model = build_model(model=args.model,
+                        time_pooling=args.time_pooling,
+                        layer_pooling=args.layer_pooling,
+                        layer=args.layer,
+                        new_num_tokens=len(tokenizer),
+                        device=device,
+                        precision=getattr(args, 'precision', 'fp32'))
+    model.load_state_dict(torch.load(os.path.join(exp_path, 'best_model.pt'), map_location=device))
+    model.eval()
+    return Predictor(model, field, load_labels(exp_path), device)
+
+
+class Metrics:
+    """Latency of requests and sizes of batches, over the latest `window` of each"""
+    def __init__(self, window):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.latencies = deque(maxlen=self.window)
+        self.batch_sizes = deque(maxlen=self.window)
+        self.requests = self.batches = self.errors = 0
+        self.start = time.time()
+
+    def add_request(self, latency):
+        self.requests += 1
+        self.latencies.append(latency)
+
+    def add_batch(self, size):
+        self.batches += 1
+        self.batch_sizes.append(size)
+
+    def summary(self):
+        summary = {'requests': self.requests, 'batches': self.batches, 'errors': self.errors,
+                   'requests_per_sec': self.requests / (time.time() - self.start)}
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1e3
+            summary['latency_ms'] = {f'p{q}': float(np.percentile(latencies, q)) for q in (50, 90, 99)}
+            summary['latency_ms']['max'] = float(latencies.max())
+        if self.batch_sizes:
+            batch_sizes = np.array(self.batch_sizes)
+            summary['batch_size'] = {'mean': float(batch_sizes.mean()),
+                                     'p50': float(np.percentile(batch_sizes, 50)),
+                                     'p99': float(np.percentile(batch_sizes, 99)),
+                                     'max': int(batch_sizes.max())}
+        return summary
+
+
+class MicroBatcher:
+    """Collects concurrent requests into batches of up to max_batch_size. A batch is run when it is
+    full or max_wait seconds after its first request, in a thread so that requests keep arriving."""
+    def __init__(self, predict, max_batch_size, max_wait, metrics):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, tweet):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((tweet, future))
+        return await future
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        requests = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(requests) < self.max_batch_size:
+            if not self.queue.empty():
+                requests.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return requests
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self.next_batch()
+            tweets = [tweet for tweet, _ in requests]
+            try:
+                results = await loop.run_in_executor(self.executor, self.predict, tweets)
+            except Exception as e:
+                logger.exception(f'Failed to predict a batch of {len(tweets)}')
+                results = [e] * len(requests)
+            self.metrics.add_batch(len(requests))
+            for (_, future), result in zip(requests, results):
+                if future.done():  # the client is gone
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+STATUS_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  500: 'Internal Server Error'}
+
+class InferenceServer:
+    """HTTP/1.1 server with keep-alive connections, on asyncio streams"""
+    def __init__(self, batcher, metrics):
+        self.batcher = batcher
+        self.metrics = metrics
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics.summary()
+        if method == 'POST' and path == '/metrics/reset':
+            self.metrics.reset()
+            return 200, {'status': 'ok'}
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if path != '/predict':
+            return 404, {'error': f'No such path: {path}'}
+        if method != 'POST':
+            return 405, {'error': 'Use POST for /predict'}
+        try:
+            tweet = json.loads(body)['tweet']
+        except (ValueError, KeyError, TypeError):
+            return 400, {'error': 'Expected a JSON object with "tweet"'}
+        if not isinstance(tweet, str):
+            return 400, {'error': '"tweet" must be a string'}
+        start = time.perf_counter()
+        try:
+            result = await self.batcher.submit(tweet)
+        except Exception as e:
+            self.metrics.errors += 1
+            return 500, {'error': str(e)}
+        self.metrics.add_request(time.perf_counter() - start)
+        return 200, result
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, response = await self.route(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                payload = json.dumps(response).encode()
+                writer.write(f'HTTP/1.1 {status} {STATUS_REASONS[status]}\r\n'
+                             f'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(payload)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(predictor, host, port, max_batch_size, max_wait, metrics_window):
+    metrics = Metrics(metrics_window)
+    batcher = MicroBatcher(predictor, max_batch_size, max_wait, metrics)
+    server = InferenceServer(batcher, metrics)
+    batching = asyncio.create_task(batcher.run())
+    async with await asyncio.start_server(server.handle, host, port) as http_server:
+        logger.info(f'Serving on http://{host}:{port}, with batches of up to {max_batch_size} '
+                    f'and {max_wait * 1e3:.1f}ms of waiting')
+        try:
+            await http_server.serve_forever()
+        finally:
+            batching.cancel()
+            logger.info(f'Metrics: {metrics.summary()}')
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setproctitle(f'{args.exp_note}_serve')
+    predictor = build_predictor(args.exp_note, args.cpu)
+    try:
+        asyncio.run(serve(predictor, args.host, args.port, args.max_batch_size,
+                          args.max_wait_ms / 1e3, args.metrics_window))
+    except KeyboardInterrupt:
+        pass
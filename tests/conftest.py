@@ -0,0 +1,52 @@
+import os
+import sys
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ['you', 'are', 'the', 'best', 'worst', 'love', 'this', 'so', 'much', 'never', 'again', 'people',
+         'go', 'home', 'what', 'a', 'joke', 'great', 'game', 'today', 'hate', 'thanks', 'friend', 'vote']
+EXTRAS = ['@USER', '#LoveWins', '#FakeNews', 'URL', '!!!', '??', 'LOL', 'Great', 'unknownword', 'ça']
+
+
+def write_tsv(path, rows):
+    with open(path, 'w') as f:
+        print('id\ttweet\tlabel', file=f)
+        for row in rows:
+            print('\t'.join(row), file=f)
+    return str(path)
+
+def random_rows(n, seed=0, prefix=''):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        tokens = [rng.choice(WORDS) if rng.random() < 0.8 else rng.choice(EXTRAS)
+                  for _ in range(rng.randint(1, 30))]
+        rows.append((f'{prefix}{i}', ' '.join(tokens), rng.choice(['OFF', 'NOT'])))
+    return rows
+
+
+@pytest.fixture
+def tokenizer_dir(tmp_path):
+    """A wordpiece vocab of WORDS and their characters, which other tokens are split into or unknown"""
+    chars = sorted({c for w in WORDS for c in w})
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '!', '?', '#', '@'] + chars + \
+        ['##' + c for c in chars] + WORDS
+    path = tmp_path / 'tokenizer'
+    path.mkdir()
+    (path / 'vocab.txt').write_text('\n'.join(vocab) + '\n')
+    return str(path)
+
+@pytest.fixture
+def tokenizer(tokenizer_dir):
+    from preprocessing import build_tokenizer
+    return build_tokenizer(model='mbert', add_cap_sign=False, textify_emoji=False, segment_hashtag=False,
+                           preprocess=None, name_or_path=tokenizer_dir)
+
+@pytest.fixture
+def tsv_paths(tmp_path):
+    """Training, validation and test data of random tweets"""
+    return {split: write_tsv(tmp_path / f'{split}.tsv', random_rows(n, seed, prefix=split))
+            for split, n, seed in [('train', 60, 0), ('val', 23, 1), ('test', 17, 2)]}
@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import shutil
+import random
+import types
+from collections import OrderedDict
+from functools import partial
+from itertools import islice
+
+import numpy as np
+import pytest
+import torch
+from torchtext.data import Field, RawField, TabularDataset, batch
+from transformers import BertTokenizer
+
+from dataloading import (build_data, build_tweet_field, read_tsv_parallel, token_batch_size_fn, PrefetchIterator,
+                         StreamingIterator, StreamingTabularDataset, TokenCache, TransformersData)
+from preprocessing import segment_cache, segment_hashtags, PREPROCESS_OPTIONS
+from conftest import write_tsv, random_rows
+
+
+class Tokenizer:
+    """Whitespace tokenizer with ids of [CLS] and [SEP] around sequences, as of BERT"""
+    pad_token_id = 0
+
+    def tokenize(self, text):
+        return text.split()
+
+    def convert_tokens_to_ids(self, token):
+        return int(token)
+
+    def build_inputs_with_special_tokens(self, ids):
+        return [101] + ids + [102]
+
+class Batches:
+    """Batches of `tweet` only, padded by the field as BucketIterator would"""
+    def __init__(self, field, n, batch_size=3, seed=0):
+        rng = np.random.RandomState(seed)
+        self.field = field
+        self.examples = [[field.preprocess(' '.join(map(str, rng.randint(1000, 2000, rng.randint(1, 12)))))
+                          for _ in range(batch_size)] for _ in range(n)]
+        self.repeat = False
+
+    def __iter__(self):
+        for examples in self.examples:
+            yield types.SimpleNamespace(fields=['tweet'], tweet=self.field.process(examples))
+
+
+@pytest.mark.parametrize('accumulation_steps', [1, 3, 5])
+@pytest.mark.parametrize('prefetch', [1, 2])
+def test_prefetched_batches_are_not_overwritten_while_in_use(prefetch, accumulation_steps):
+    field = build_tweet_field(Tokenizer(), lambda x: x)
+    expected = [batch.tweet[0].clone() for batch in Batches(field, 30)]
+    batches = iter(PrefetchIterator(Batches(field, 30), prefetch, 'cpu', batches_in_use=accumulation_steps))
+    seen = []
+    while True:
+        group = list(islice(batches, accumulation_steps))
+        if not group:
+            break
+        time.sleep(0.02)  # lets the producer fill the queue while the group is in use
+        seen += [batch.tweet[0].clone() for batch in group]
+    assert len(seen) == len(expected)
+    for x, y in zip(seen, expected):
+        assert x.shape == y.shape and (x == y).all()
+
+
+HASHTAGS = ['#LoveWins', '#FakeNews', '#StopTheHate', '#MakeAmericaGreatAgain', '#MondayMotivation',
+            '#GameOfThrones', '#BlackLivesMatter']
+
+def segmenting_fields():
+    return [('id', RawField()),
+            ('tweet', Field(tokenize=lambda tweet: segment_hashtags(tweet).split())),
+            ('label', Field(sequential=False))]
+
+def test_parallel_reading_keeps_hashtag_segmentations(tmp_path, monkeypatch):
+    for name, value in [('cache', OrderedDict()), ('hits', 0), ('misses', 0), ('added', None),
+                        ('path', str(tmp_path / 'segments.json'))]:
+        monkeypatch.setattr(segment_cache, name, value)
+    rows = [(str(i), f'so {hashtag} today', 'OFF') for i, hashtag in enumerate(HASHTAGS)]
+    dataset = read_tsv_parallel(write_tsv(tmp_path / 'train.tsv', rows), segmenting_fields(),
+                                num_workers=2, chunk_size=2)
+    assert dataset.examples[0].tweet == ['so', 'love', 'wins', 'today']
+    assert segment_cache.info()['misses'] == len(HASHTAGS)
+    segment_cache.save()
+    with open(tmp_path / 'segments.json') as f:
+        assert sorted(json.load(f)) == sorted(HASHTAGS)
+
+
+def test_parallel_reading_is_the_same_as_tabular_dataset(tokenizer, tsv_paths):
+    fields = [('id', RawField()), ('tweet', build_tweet_field(tokenizer, lambda x: x[:509])),
+              ('label', Field(sequential=False, unk_token=None, pad_token=None))]
+    torch.randn(64, 64) @ torch.randn(64, 64)  # workers are forked after torch ops have run
+    expected = TabularDataset(tsv_paths['train'], 'tsv', fields, skip_header=True)
+    dataset = read_tsv_parallel(tsv_paths['train'], fields, num_workers=2, chunk_size=7)
+    assert len(dataset.examples) == len(expected.examples) == 60
+    for ex, expected_ex in zip(dataset.examples, expected.examples):
+        assert ex.id == expected_ex.id and ex.label == expected_ex.label
+        assert np.array_equal(ex.tweet, expected_ex.tweet)
+    assert dataset.fields == expected.fields
+
+def build_test_data(tokenizer, tsv_paths, **kwargs):
+    random.seed(0)  # of the shuffled order of training batches
+    return build_data(preprocessing=lambda x: x[:509], tokenizer=tokenizer, batch_size=8, device='cpu',
+                      train_path=tsv_paths['train'], val_path=tsv_paths['val'], test_path=tsv_paths['test'],
+                      **kwargs)
+
+def assert_same_batch(batch, expected):
+    assert batch.id == expected.id
+    assert torch.equal(batch.label, expected.label)
+    for x, y in zip(batch.tweet, expected.tweet):
+        assert x.dtype == y.dtype and torch.equal(x, y)
+
+@pytest.mark.parametrize('prefetch', [1, 3])
+def test_prefetched_batches_are_the_same(tokenizer, tsv_paths, prefetch):
+    data = build_test_data(tokenizer, tsv_paths)
+    prefetched = build_test_data(tokenizer, tsv_paths, prefetch=prefetch)
+    assert isinstance(prefetched.val_iter, PrefetchIterator)
+    for split in ('val', 'test'):
+        data_iter, prefetched_iter = getattr(data, f'{split}_iter'), getattr(prefetched, f'{split}_iter')
+        data_iter.repeat = prefetched_iter.repeat = False
+        n = 0
+        for batch, expected in zip(prefetched_iter, data_iter):
+            assert_same_batch(batch, expected)
+            n += len(batch.id)
+        assert n == len(getattr(data, split).examples)
+    # Training batches are repeated over epochs, in the same shuffled order
+    for batch, expected in islice(zip(prefetched.train_iter, data.train_iter), 20):
+        assert_same_batch(batch, expected)
+
+
+def test_cached_datasets_are_the_same_as_read(tokenizer, tsv_paths, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    data = build_test_data(tokenizer, tsv_paths)
+    build_test_data(tokenizer, tsv_paths, cache_dir=cache_dir, cache_config={'max_length': 509})
+    assert len(os.listdir(cache_dir)) == 3
+    monkeypatch.setattr(TransformersData, 'read_tsv', lambda self, path: pytest.fail(f'{path} is read'))
+    cached = build_test_data(tokenizer, tsv_paths, cache_dir=cache_dir, cache_config={'max_length': 509})
+    for split in ('train', 'val', 'test'):
+        examples, cached_examples = getattr(data, split).examples, getattr(cached, split).examples
+        assert len(examples) == len(cached_examples)
+        for ex, cached_ex in zip(examples, cached_examples):
+            assert ex.id == cached_ex.id and ex.label == cached_ex.label
+            assert np.array_equal(ex.tweet, cached_ex.tweet)
+    for batch, expected in zip(cached.val_iter, data.val_iter):
+        assert_same_batch(batch, expected)
+        break
+
+def test_cache_key_changes_with_preprocessing_and_tokenizer(tokenizer_dir, tsv_paths, tmp_path):
+    config = {'demojize': False, 'textify_emoji': False, 'mention_limit': 3, 'punc_limit': 3,
+              'lower_hashtag': False, 'segment_hashtag': False, 'add_cap_sign': False, 'max_length': 509}
+    assert set(config) == set(PREPROCESS_OPTIONS) | {'max_length'}
+    def key(config, name_or_path, **kwargs):
+        tokenizer = BertTokenizer.from_pretrained(name_or_path, **kwargs)  # without added tokens
+        return TokenCache(str(tmp_path / 'cache'), tokenizer, config).key(tsv_paths['train'])
+
+    base = key(config, tokenizer_dir)
+    copied_dir = shutil.copytree(tokenizer_dir, str(tmp_path / 'copied_tokenizer'))
+    assert key(dict(config), copied_dir) == base  # only the contents of tokenizer files count
+    for option, value in config.items():
+        changed = {**config, option: not value if isinstance(value, bool) else value + 1}
+        assert key(changed, tokenizer_dir) != base, option
+    assert key(config, tokenizer_dir, do_lower_case=False) != base
+
+
+class ReferenceField(Field):
+    """TransformersField as before, which encoded tokens of each example with the tokenizer and
+    padded them with Field.pad. encode raises on an empty list of tokens, which then has only
+    the special tokens."""
+    def __init__(self, tokenizer, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.numericalize_func = partial(tokenizer.encode, add_special_tokens=True)
+        self.empty_ids = tokenizer.build_inputs_with_special_tokens([])
+
+    def process(self, batch, device=None):
+        ids_list = [self.numericalize_func(ex) if ex else self.empty_ids for ex in batch]
+        padded, lengths = self.pad(ids_list)
+        return torch.tensor(padded, device=device), torch.tensor(lengths, device=device)
+
+TWEETS = ['', 'you are the best', '@USER @USER go home !!!', 'unknownword ça LOL', '[CLS] so [SEP] much',
+          '#LoveWins ' * 30, 'a']
+
+@pytest.mark.parametrize('pad_to_multiple_of', [1, 8])
+@pytest.mark.parametrize('max_length', [509, 5])
+def test_field_makes_the_same_tensors_as_encode_and_pad(tokenizer, pad_to_multiple_of, max_length):
+    truncate = lambda x: x[:max_length]
+    field = build_tweet_field(tokenizer, truncate, pad_to_multiple_of)
+    reference = ReferenceField(tokenizer, include_lengths=True, use_vocab=False, batch_first=True,
+                               preprocessing=truncate, tokenize=tokenizer.tokenize,
+                               pad_token=tokenizer.pad_token_id)
+    for batch in (TWEETS, TWEETS[:1], TWEETS[1:3]):
+        x, length = field.process([field.preprocess(tweet) for tweet in batch])
+        expected_x, expected_length = reference.process([reference.preprocess(tweet) for tweet in batch])
+        padding = -expected_x.size(1) % pad_to_multiple_of
+        expected_x = torch.nn.functional.pad(expected_x, (0, padding), value=tokenizer.pad_token_id)
+        assert x.dtype == expected_x.dtype and torch.equal(x, expected_x)
+        assert length.dtype == expected_length.dtype and torch.equal(length, expected_length)
+        assert x.size(1) % pad_to_multiple_of == 0
+    assert field.preprocess('').tolist() == []
+
+
+def padded_tokens(examples, num_special_tokens, pad_to_multiple_of):
+    length = max(len(ex.tweet) for ex in examples) + num_special_tokens
+    return len(examples) * (length + -length % pad_to_multiple_of)
+
+@pytest.mark.parametrize('pad_to_multiple_of', [1, 8])
+@pytest.mark.parametrize('sort', [False, True])
+def test_token_batches_fit_the_budget(pad_to_multiple_of, sort):
+    rng = np.random.RandomState(0)
+    examples = [types.SimpleNamespace(i=i, tweet=np.zeros(n)) for i, n in enumerate(rng.randint(0, 120, 500))]
+    if sort:
+        examples.sort(key=lambda ex: len(ex.tweet))
+    max_tokens = 100
+    batches = list(batch(examples, max_tokens, token_batch_size_fn(max_tokens, 2, pad_to_multiple_of)))
+    for minibatch in batches:
+        assert len(minibatch) == 1 or padded_tokens(minibatch, 2, pad_to_multiple_of) <= max_tokens
+    assert [ex.i for minibatch in batches for ex in minibatch] == [ex.i for ex in examples]
+    # Batches are as full as the budget allows: the next example would not have fit
+    for minibatch, next_batch in zip(batches, batches[1:]):
+        assert padded_tokens(minibatch + next_batch[:1], 2, pad_to_multiple_of) > max_tokens
+
+def test_token_batches_of_data(tokenizer, tsv_paths):
+    data = build_test_data(tokenizer, tsv_paths, max_tokens=64)
+    for split in ('val', 'test'):
+        data_iter = getattr(data, f'{split}_iter')
+        data_iter.repeat = False
+        ids = []
+        for minibatch in data_iter:
+            x, length = minibatch.tweet
+            assert len(minibatch.id) == 1 or x.numel() <= 64
+            ids += minibatch.id
+        assert sorted(ids) == sorted(ex.id for ex in getattr(data, split).examples)
+
+
+class CountingDataset:
+    """Counts examples read from a streamed dataset"""
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.fields = dataset.fields
+        self.read = 0
+
+    def __iter__(self):
+        for ex in self.dataset:
+            self.read += 1
+            yield ex
+
+def build_streamed_data(tokenizer, tsv_paths, tmp_path, **kwargs):
+    tsv_paths = dict(tsv_paths, train=write_tsv(tmp_path / 'large.tsv', random_rows(500, seed=3)))
+    return build_test_data(tokenizer, tsv_paths, stream=True, shuffle_buffer=20, bucket_window=3, **kwargs)
+
+@pytest.mark.parametrize('max_tokens', [None, 64])
+def test_streamed_epoch_yields_every_row_once_with_bounded_memory(tokenizer, tsv_paths, tmp_path, max_tokens):
+    data = build_streamed_data(tokenizer, tsv_paths, tmp_path, max_tokens=max_tokens)
+    train_iter = data.train_iter
+    assert isinstance(train_iter, StreamingIterator)
+    train_iter.repeat = False
+    train_iter.dataset = dataset = CountingDataset(data.train)
+    batch_size = max_tokens or 8
+    ids, held = [], []
+    for minibatch in train_iter:
+        ids += minibatch.id
+        held.append(dataset.read - len(ids))
+    assert sorted(ids) == sorted(str(i) for i in range(500))
+    assert ids != [str(i) for i in range(500)]  # shuffled
+    # Examples read but not yet batched are those of the shuffle buffer and of a bucketing window,
+    # which has at most batch_size * bucket_window examples, also when batch_size is in tokens
+    assert max(held) <= 20 + batch_size * 3
+    assert max(held) >= 20
+
+def test_streamed_shards_partition_the_rows(tokenizer, tsv_paths, tmp_path):
+    data = build_streamed_data(tokenizer, tsv_paths, tmp_path)
+    shards = [StreamingTabularDataset(data.train.path, data.fields, rank=rank, world_size=3) for rank in range(3)]
+    ids = [ex.id for shard in shards for ex in shard]
+    assert sorted(ids) == sorted(str(i) for i in range(500))
+
+def test_streamed_training_data_is_not_cached(tokenizer, tsv_paths, tmp_path, caplog):
+    cache_dir = str(tmp_path / 'cache')
+    build_streamed_data(tokenizer, tsv_paths, tmp_path, cache_dir=cache_dir, cache_config={'max_length': 509})
+    assert len(os.listdir(cache_dir)) == 2
+    assert 'is not cached' in caplog.text
@@ -0,0 +1,89 @@
+import pytest
+import torch
+from transformers import BertConfig, BertModel
+
+from model import build_model, init_added_embeddings
+
+
+def tiny_bert(vocab_size=100, seed=0):
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=vocab_size, hidden_size=16, num_hidden_layers=12, num_attention_heads=2,
+                        intermediate_size=32)
+    return BertModel(config)
+
+def tiny_classifier(base_model, **kwargs):
+    kwargs = {'time_pooling': 'max_avg', 'layer_pooling': 'cat', 'layer': [12], **kwargs}
+    return build_model(model='mbert', new_num_tokens=base_model.config.vocab_size, device='cpu',
+                       base_model=base_model, **kwargs)
+
+def random_batch(vocab_size=100, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.randint(1, vocab_size, (4, 9), generator=generator)
+    length = torch.tensor([9, 5, 2, 7])
+    x[torch.arange(9) >= length[:, None]] = 0
+    return x, length
+
+
+def test_added_embeddings_are_the_same_across_runs():
+    fingerprints = []
+    for seed in (0, 1):
+        base_model = tiny_bert()
+        torch.manual_seed(seed)  # as if the global generator was used differently before resizing
+        base_model.resize_token_embeddings(110)
+        init_added_embeddings(base_model, 100)
+        model = tiny_classifier(base_model, cached_layers=3)
+        fingerprints.append(model.frozen_fingerprint())
+        assert torch.equal(model.model.embeddings.word_embeddings.weight[:100],
+                           tiny_bert().embeddings.word_embeddings.weight)
+    assert fingerprints[0] == fingerprints[1]
+
+def test_cached_frozen_features_give_the_same_logits():
+    base_model = tiny_bert()
+    x, length = random_batch()
+    for kwargs in [{}, {'layer': [5, 12], 'time_pooling': 'avg'}, {'time_pooling': 'cls'}]:
+        model = tiny_classifier(base_model, **kwargs).eval()
+        cached = tiny_classifier(base_model, cached_layers=4, **kwargs).eval()
+        cached.load_state_dict(model.state_dict())  # the same randomly initialized head
+        with torch.no_grad():
+            features = cached.frozen_features(x, length)
+            assert features.shape == (4, 9, 16)
+            assert torch.allclose(cached(features, length), model(x, length), atol=1e-5), kwargs
+
+
+def reference_logits(model, x, length):
+    """Logits from all hidden states of BertModel, as before layers were run by PoolClassifier"""
+    x_mask = (torch.arange(x.size(1)) < length[:, None]).float()
+    outputs = model.model(x, attention_mask=x_mask, output_hidden_states=True)
+    hidden_states, cls = outputs[2], outputs[1]
+    pooled = [model.time_pooling(cls, hidden_states[layer], length, x_mask) for layer in model.layer]
+    return hidden_states, model.out(pooled[0] if len(pooled) == 1 else model.layer_pooling(pooled))
+
+def test_truncated_encoder_matches_bert_model():
+    base_model = tiny_bert()
+    x, length = random_batch()
+    for kwargs in [{'layer': [11]}, {'layer': [12]}, {'layer': [9, 11], 'layer_pooling': 'max'},
+                   {'layer': [11], 'time_pooling': 'cls'}]:
+        model = tiny_classifier(base_model, **kwargs).eval()
+        with torch.no_grad():
+            hidden_states, logits = reference_logits(model, x, length)
+            x_mask = (torch.arange(x.size(1)) < length[:, None]).float()
+            cls, pooled_states = model.encode(x, x_mask)
+            assert set(pooled_states) == model.pooled_layers
+            for layer, hidden in pooled_states.items():
+                assert torch.allclose(hidden, hidden_states[layer], atol=1e-5), (kwargs, layer)
+            assert torch.allclose(model(x, length), logits, atol=1e-5), kwargs
+
+@pytest.mark.parametrize('pooling', [{}, {'time_pooling': 'avg', 'layer_pooling': 'avg', 'layer': [11, 12]},
+                                     {'time_pooling': 'cls'}])
+def test_bf16_forward_returns_float32_logits(pooling):
+    model = tiny_classifier(tiny_bert(), **pooling).eval()
+    bf16 = tiny_classifier(tiny_bert(), precision='bf16', **pooling).eval()
+    bf16.load_state_dict(model.state_dict())
+    x, length = random_batch()
+    logits = bf16(x, length)
+    assert logits.dtype == torch.float32
+    assert all(p.dtype == torch.float32 for p in bf16.parameters())
+    with torch.no_grad():
+        assert torch.allclose(logits, model(x, length), atol=0.05)
+    logits.sum().backward()
+    assert bf16.out.weight.grad.dtype == torch.float32
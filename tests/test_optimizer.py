@@ -0,0 +1,99 @@
+import copy
+
+import pytest
+import torch
+from transformers import AdamW, BertConfig, BertModel
+
+from model import build_model
+from optimizer import MultiTensorAdamW, build_optimizer_scheduler, apply_wd, apply_disc_lr, apply_layer_freeze
+
+HYPERPARAMS = dict(lr=0.001, betas=(0.9, 0.999), eps=1e-6)
+
+
+def reference_optimizer(model, lr, betas, eps, weight_decay, layer_decrease, freeze_upto):
+    """The previous optimizer, with a group per parameter, frozen ones included, and AdamW of transformers"""
+    grouped_params = {n: {'params': p, 'lr': lr} for n, p in model.named_parameters()}
+    if weight_decay != 0.0:
+        grouped_params, _ = apply_wd(grouped_params, model, weight_decay)
+    if layer_decrease != 1.0:
+        grouped_params, _ = apply_disc_lr(grouped_params, model, lr, layer_decrease)
+    if freeze_upto != -1:
+        grouped_params, _ = apply_layer_freeze(grouped_params, model, freeze_upto)
+    return AdamW(list(grouped_params.values()), lr, eps=eps, betas=betas, correct_bias=False)
+
+def set_grads(model, seed):
+    """Random gradients of trainable parameters, except the pooler which gets none as when
+    it is not used"""
+    generator = torch.Generator().manual_seed(seed)
+    for n, p in model.named_parameters():
+        p.grad = torch.randn(p.shape, generator=generator) if p.requires_grad and 'pooler' not in n else None
+
+def tiny_bert():
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=100, hidden_size=16, num_hidden_layers=12, num_attention_heads=2,
+                        intermediate_size=32)
+    return build_model(model='mbert', time_pooling='max_avg', layer_pooling='cat', layer=[12],
+                       new_num_tokens=100, device='cpu', base_model=BertModel(config))
+
+def assert_same_params(params, reference_params):
+    for (n, p), (_, q) in zip(params, reference_params):
+        assert torch.allclose(p, q, rtol=1e-5, atol=1e-7), f'Mismatch of {n}'
+
+
+# weight decay, layer-wise lr decrease, and layers frozen up to
+@pytest.mark.parametrize('weight_decay, layer_decrease, freeze_upto',
+                         [(0.0, 1.0, -1), (0.01, 1.0, -1), (0.01, 0.95, -1), (0.01, 0.95, 5)])
+def test_same_updates_as_a_group_per_parameter(weight_decay, layer_decrease, freeze_upto):
+    model = tiny_bert()
+    reference_model = copy.deepcopy(model)
+    kwargs = dict(weight_decay=weight_decay, layer_decrease=layer_decrease, freeze_upto=freeze_upto,
+                  **HYPERPARAMS)
+    optimizer, _ = build_optimizer_scheduler(model=model, warmup_ratio=0.0, train_step=5, **kwargs)
+    reference = reference_optimizer(reference_model, **kwargs)
+    assert len(optimizer.param_groups) < len(reference.param_groups)
+    for step in range(5):
+        set_grads(model, step)
+        set_grads(reference_model, step)
+        optimizer.step()
+        reference.step()
+    assert_same_params(model.named_parameters(), reference_model.named_parameters())
+
+
+def random_params(sizes, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.nn.Parameter(torch.randn(size, generator=generator)) for size in sizes]
+
+def step_both(sizes, steps=3, **kwargs):
+    params = random_params(sizes)
+    reference_params = [torch.nn.Parameter(p.detach().clone()) for p in params]
+    optimizer = MultiTensorAdamW(params, **HYPERPARAMS, **kwargs)
+    reference = AdamW(reference_params, **HYPERPARAMS, **kwargs)
+    for step in range(steps):
+        generator = torch.Generator().manual_seed(step)
+        for p, q in zip(params, reference_params):
+            p.grad = torch.randn(p.shape, generator=generator)
+            q.grad = p.grad.clone()
+        optimizer.step()
+        reference.step()
+    assert_same_params(enumerate(params), enumerate(reference_params))
+    return optimizer
+
+@pytest.mark.parametrize('correct_bias', [True, False])
+@pytest.mark.parametrize('weight_decay', [0.0, 0.01])
+def test_same_updates_as_transformers_adamw(correct_bias, weight_decay):
+    step_both([(30, 20), (20,), (7, 3, 5)], correct_bias=correct_bias, weight_decay=weight_decay)
+
+def test_cpu_chunks_across_chunk_size():
+    chunk_numel = MultiTensorAdamW.cpu_chunk_numel
+    sizes = [(chunk_numel + 1,), (100,), (chunk_numel - 100,), (chunk_numel - 99,), (chunk_numel,), (5,)]
+    optimizer = step_both(sizes, correct_bias=True, weight_decay=0.01)
+    chunks = optimizer.chunks(optimizer.param_groups[0]['params'])
+    assert [[p.numel() for p in chunk] for chunk in chunks] == \
+        [[chunk_numel + 1], [100, chunk_numel - 100], [chunk_numel - 99], [chunk_numel], [5]]
+
+def test_small_cpu_chunks(monkeypatch):
+    monkeypatch.setattr(MultiTensorAdamW, 'cpu_chunk_numel', 64)
+    optimizer = step_both([(8, 8), (3,), (61,), (10, 10), (2,), (2, 3)], correct_bias=True, weight_decay=0.01)
+    chunks = optimizer.chunks(optimizer.param_groups[0]['params'])
+    assert len(chunks) == 4
+    assert all(sum(p.numel() for p in chunk) <= 64 or len(chunk) == 1 for chunk in chunks)
@@ -0,0 +1,109 @@
+from functools import partial
+from itertools import product
+
+import pytest
+
+import preprocessing
+from preprocessing import (SegmentCache, compose, replace_urls, replace_emojis, textify_emojis, limit_mentions,
+                           limit_punctuations, lower_hashtags, segment_hashtags, add_capital_signs,
+                           build_preprocess, PREPROCESS_OPTIONS)
+
+TWEETS = [
+    '',
+    'plain lower case tweet',
+    '@USER @USER @USER @USER @USER you are WRONG',
+    '@USER@USER@USER@USER hello',
+    '@USER  @USER\t@USER @USER',
+    'What?!?!?! No way!!!!!! ok... fine.... ??',
+    'Go to URL now!! URLs are URL-ish',
+    '#MakeAmericaGreatAgain is trending #MAGA #maga',
+    'HELLO#World #hashTag! (#inParens) ##double #',
+    'I love it 😂😂 🔥 so much ❤️',
+    'Caps Lock IS ON and MiXeD CaSe too',
+    ':smiling_face: :not-an-emoji :a_b-c: words',
+    '@USER #StopTheHate!!!! 😡 THIS IS URL... @USER @USER @USER @USER',
+    '  leading and trailing spaces  \n newline',
+]
+
+
+def reference_preprocess(demojize, textify_emoji, mention_limit, punc_limit, lower_hashtag,
+                         segment_hashtag, add_cap_sign):
+    """The preprocessing functions chained one by one, as before Normalizer"""
+    funcs = [replace_urls]
+    if demojize:
+        funcs.append(replace_emojis)
+    if textify_emoji:
+        funcs.append(textify_emojis)
+    if mention_limit > 0:
+        funcs.append(partial(limit_mentions, keep_num=mention_limit))
+    if punc_limit > 0:
+        funcs.append(partial(limit_punctuations, keep_num=punc_limit))
+    if lower_hashtag:
+        funcs.append(lower_hashtags)
+    if segment_hashtag:
+        funcs.append(segment_hashtags)
+    if add_cap_sign:
+        funcs.append(add_capital_signs)
+    return compose(*funcs)
+
+def all_configs():
+    values = {'demojize': [False, True], 'textify_emoji': [False, True], 'mention_limit': [0, 1, 3],
+              'punc_limit': [0, 1, 3], 'lower_hashtag': [False, True], 'segment_hashtag': [False, True],
+              'add_cap_sign': [False, True]}
+    assert set(values) == set(PREPROCESS_OPTIONS)
+    for combination in product(*values.values()):
+        config = dict(zip(values, combination))
+        if config['textify_emoji'] and not config['demojize']:
+            continue
+        yield config
+
+
+@pytest.mark.parametrize('config', list(all_configs()),
+                         ids=lambda config: '-'.join(f'{k}={v}' for k, v in config.items()))
+def test_normalizer_matches_chained_functions(config):
+    normalizer = build_preprocess(**config)
+    reference = reference_preprocess(**config)
+    for tweet in TWEETS:
+        assert normalizer(tweet) == reference(tweet), tweet
+
+def test_textify_emoji_needs_demojize():
+    with pytest.raises(Exception):
+        build_preprocess(demojize=False, textify_emoji=True, mention_limit=0, punc_limit=0,
+                         lower_hashtag=False, segment_hashtag=False, add_cap_sign=False)
+
+
+def test_segment_cache_evicts_least_recently_used():
+    cache = SegmentCache(maxsize=2)
+    assert cache('#LoveWins') == 'love wins'
+    cache('#FakeNews')
+    cache('#LoveWins')
+    cache('#StopTheHate')
+    assert list(cache.cache) == ['#LoveWins', '#StopTheHate']
+    assert cache.info() == {'hits': 1, 'misses': 3, 'size': 2, 'maxsize': 2}
+    cache.configure(maxsize=1)
+    assert list(cache.cache) == ['#StopTheHate']
+
+def test_segment_cache_is_saved_and_loaded(tmp_path, monkeypatch):
+    path = str(tmp_path / 'segments.json')
+    cache = SegmentCache(path=path)
+    cache.save()
+    assert not (tmp_path / 'segments.json').exists()  # nothing new to save
+    segmented = [cache(hashtag) for hashtag in ('#LoveWins', '#MakeAmericaGreatAgain')]
+    cache.save()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['segments.json']
+
+    monkeypatch.setattr(preprocessing, 'segment', lambda hashtag: pytest.fail('segmented again'))
+    loaded = SegmentCache(path=path)
+    assert [loaded(hashtag) for hashtag in ('#LoveWins', '#MakeAmericaGreatAgain')] == segmented
+    assert loaded.info()['hits'] == 2
+
+def test_segment_cache_merges_updates_of_another_process():
+    worker, parent = SegmentCache(maxsize=3), SegmentCache(maxsize=3)
+    parent('#FakeNews')
+    worker.track()
+    worker('#LoveWins')
+    worker('#LoveWins')
+    parent.merge(worker.take_updates())
+    assert parent.cache == {'#FakeNews': 'fake news', '#LoveWins': 'love wins'}
+    assert (parent.hits, parent.misses) == (1, 2)
+    assert worker.take_updates() == ({}, 0, 0)
@@ -0,0 +1,44 @@
+import json
+import os
+
+import numpy as np
+
+from probe import NpyWriter, add_probe_args, load_meta, probe_meta
+from train import build_parser
+
+
+def test_npy_writer_counts_rows(tmp_path):
+    file_name = str(tmp_path / 'train_avg.npy')
+    batches = [np.random.rand(n, 3, 4).astype(np.float32) for n in (5, 1, 7)]
+    writer = NpyWriter(file_name, (3, 4), np.float32)
+    for batch in batches:
+        writer.append(batch)
+    writer.close()
+    assert writer.rows == 13
+    assert np.array_equal(np.load(file_name, mmap_mode='r'), np.concatenate(batches))
+    assert os.listdir(tmp_path) == ['train_avg.npy']
+
+def test_npy_writer_without_rows(tmp_path):
+    file_name = str(tmp_path / 'test_labels.npy')
+    writer = NpyWriter(file_name, (), np.int64)
+    writer.close()
+    assert np.load(file_name).shape == (0,)
+
+def test_meta_is_reused_only_for_the_same_options(tmp_path):
+    parser = add_probe_args(build_parser())
+    args = parser.parse_args([])
+    meta_file = str(tmp_path / 'meta.json')
+    assert load_meta(meta_file, args) is None
+    with open(meta_file, 'w') as f:
+        json.dump({'sizes': {'train': 3, 'val': 2}, **probe_meta(args)}, f)
+    assert load_meta(meta_file, args) == {'train': 3, 'val': 2}
+    for changed in (['--demojize'], ['--mention_limit', '1'], ['--precision', 'bf16'], ['--test_path', 'x.tsv']):
+        assert load_meta(meta_file, parser.parse_args(changed)) is None, changed
+
+def test_meta_without_options_is_not_reused(tmp_path):
+    args = add_probe_args(build_parser()).parse_args([])
+    meta_file = str(tmp_path / 'meta.json')
+    with open(meta_file, 'w') as f:
+        json.dump({'sizes': {'train': 3}, 'model': args.model, 'train_path': args.train_path,
+                   'val_path': args.val_path, 'test_path': args.test_path}, f)
+    assert load_meta(meta_file, args) is None
@@ -0,0 +1,58 @@
+import time
+import asyncio
+
+from serve import Metrics, MicroBatcher
+
+
+class Predict:
+    """Upper-cases tweets, and records the batches it is given"""
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+
+    def __call__(self, tweets):
+        self.batches.append(list(tweets))
+        if self.fail:
+            raise RuntimeError('Model error')
+        return [tweet.upper() for tweet in tweets]
+
+def run_requests(batcher, *requests):
+    """Runs the batcher while the requests, which are coroutines of submit, are awaited together"""
+    async def main():
+        runner = asyncio.ensure_future(batcher.run())
+        try:
+            return await asyncio.gather(*requests, return_exceptions=True)
+        finally:
+            runner.cancel()
+    return asyncio.run(main())
+
+def test_requests_get_their_own_results_in_full_batches():
+    predict, metrics = Predict(), Metrics(100)
+    batcher = MicroBatcher(predict, max_batch_size=4, max_wait=0.5, metrics=metrics)
+    tweets = [f'tweet {i}' for i in range(10)]
+    start = time.time()
+    results = run_requests(batcher, *[batcher.submit(tweet) for tweet in tweets])
+    assert results == [tweet.upper() for tweet in tweets]
+    assert predict.batches == [tweets[:4], tweets[4:8], tweets[8:]]
+    assert metrics.batches == 3 and list(metrics.batch_sizes) == [4, 4, 2]
+    assert time.time() - start < 1.5  # full batches do not wait, only the last one waits max_wait
+
+def test_a_batch_is_run_max_wait_after_its_first_request():
+    predict = Predict()
+    batcher = MicroBatcher(predict, max_batch_size=4, max_wait=0.2, metrics=Metrics(100))
+
+    async def submit_later(tweet, delay):
+        await asyncio.sleep(delay)
+        start = time.time()
+        return await batcher.submit(tweet), time.time() - start
+
+    (a, a_latency), (b, _), (c, _) = run_requests(
+        batcher, submit_later('a', 0), submit_later('b', 0.05), submit_later('c', 0.5))
+    assert (a, b, c) == ('A', 'B', 'C')
+    assert predict.batches == [['a', 'b'], ['c']]  # c comes after the deadline of the first batch
+    assert 0.15 <= a_latency < 0.45
+
+def test_errors_are_given_to_every_request_of_the_batch():
+    batcher = MicroBatcher(Predict(fail=True), max_batch_size=4, max_wait=0.05, metrics=Metrics(100))
+    results = run_requests(batcher, batcher.submit('a'), batcher.submit('b'))
+    assert [type(result) for result in results] == [RuntimeError, RuntimeError]
@@ -0,0 +1,243 @@
+import os
+import types
+
+import pytest
+from sklearn.metrics import f1_score
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+import trainer as trainer_module
+from trainer import build_trainer, evaluate_all, EarlyStopping, StageTimer
+
+
+class BagOfTokens(nn.Module):
+    def __init__(self, vocab_size=20, n_class=2):
+        super().__init__()
+        self.embedding = nn.EmbeddingBag(vocab_size, 8)
+        self.out = nn.Linear(8, n_class)
+
+    def forward(self, x, length):
+        return self.out(self.embedding(x))
+
+class Batches:
+    """Fixed batches of random token ids, repeated while `repeat` is set as by BucketIterator"""
+    def __init__(self, n, batch_size=4, seq_len=6, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        batch_sizes = batch_size if isinstance(batch_size, list) else [batch_size] * n
+        self.batches = [types.SimpleNamespace(
+            tweet=(torch.randint(1, 20, (size, seq_len), generator=generator), torch.full((size,), seq_len)),
+            label=torch.randint(0, 2, (size,), generator=generator)) for size in batch_sizes]
+        self.repeat = True
+
+    def __iter__(self):
+        while True:
+            yield from self.batches
+            if not self.repeat:
+                return
+
+def make_trainer(tmp_path, monkeypatch, **kwargs):
+    monkeypatch.chdir(tmp_path)
+    torch.manual_seed(0)
+    model = BagOfTokens()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0)
+    data = types.SimpleNamespace(train_iter=Batches(5), val_iter=Batches(2, seed=1), test_iter=None)
+    trainer = build_trainer(model=model, data=data, optimizer=optimizer, scheduler=scheduler,
+                            max_grad_norm=1.0, patience=100, exp_name='test', checkpoint='memory', **kwargs)
+    trainer.verbose = False
+    return trainer
+
+
+def test_train_eval_every_is_independent_of_record_every(tmp_path, monkeypatch):
+    trainer = make_trainer(tmp_path, monkeypatch, record_every=2, train_eval_every=3)
+    recorded = []
+    record = trainer.record
+    def record_kind(kind, step, *args, **kwargs):
+        recorded.append((kind, step))
+        return record(kind, step, *args, **kwargs)
+    trainer.record = record_kind
+    trainer.train(12)
+    assert [step for kind, step in recorded if kind == 'train_full'] == [3, 6, 9, 12]
+    assert [step for kind, step in recorded if kind == 'val'] == [2, 4, 6, 8, 10, 12]
+
+
+def test_curve_rows_are_cumulative(tmp_path, monkeypatch):
+    trainer = make_trainer(tmp_path, monkeypatch, record_every=2, accumulation_steps=2)
+    trainer.train(10)
+    with open(os.path.join(trainer.exp_dir, 'curve.tsv')) as f:
+        header, *rows = [line.rstrip('\n').split('\t') for line in f]
+    assert header == ['step', 'seconds', 'train_seconds', 'examples', 'tokens', 'val_f1', 'test_f1']
+    rows = [dict(zip(header, row)) for row in rows]
+    assert [int(row['step']) for row in rows] == [2, 4, 6, 8, 10]
+    # Batches of 4 examples of 6 tokens, of which each step takes accumulation_steps
+    assert [int(row['examples']) for row in rows] == [16, 32, 48, 64, 80]
+    assert [int(row['tokens']) for row in rows] == [96, 192, 288, 384, 480]
+    seconds = [float(row['seconds']) for row in rows]
+    train_seconds = [float(row['train_seconds']) for row in rows]
+    assert seconds == sorted(seconds) and train_seconds == sorted(train_seconds)
+    assert all(t <= s for t, s in zip(train_seconds, seconds))
+    assert [row['test_f1'] for row in rows] == [''] * 5
+
+def set_weights(model, value):
+    with torch.no_grad():
+        for p in model.parameters():
+            p.fill_(value)
+
+@pytest.mark.parametrize('checkpoint', ['disk', 'memory', 'async'])
+def test_early_stopping_restores_the_best_weights(tmp_path, checkpoint):
+    model = BagOfTokens()
+    stopper = EarlyStopping(model, patience=5, savedir=str(tmp_path), checkpoint=checkpoint)
+    for step, (value, score) in enumerate([(1.0, 0.5), (2.0, 0.7), (3.0, 0.6)]):
+        set_weights(model, value)
+        stopper(step, score)
+    assert stopper.best_step == 1
+    stopper.load_best()
+    assert all((p == 2.0).all() for p in model.parameters())
+    stopper.wait_for_write()
+    assert not os.path.exists(stopper.savedir + '.tmp')
+    if checkpoint == 'memory':
+        assert not os.path.exists(stopper.savedir)
+    else:  # the file that is left is complete
+        loaded = BagOfTokens()
+        loaded.load_state_dict(torch.load(stopper.savedir))
+        assert all((p == 2.0).all() for p in loaded.parameters())
+
+def test_async_snapshot_is_not_changed_by_training(tmp_path):
+    """Later updates of the weights do not reach the snapshot or the file being written"""
+    model = BagOfTokens()
+    stopper = EarlyStopping(model, patience=5, savedir=str(tmp_path), checkpoint='async')
+    set_weights(model, 1.0)
+    stopper(0, 0.5)
+    set_weights(model, 4.0)
+    stopper.wait_for_write()
+    assert all((v == 1.0).all() for v in torch.load(stopper.savedir).values())
+    stopper.load_best()
+    assert all((p == 1.0).all() for p in model.parameters())
+    stopper.delete_checkpoint()
+    assert not os.path.exists(stopper.savedir)
+
+
+class FakeEvent:
+    """Stands in for torch.cuda.Event, with a clock that advances by a second per recorded event"""
+    clock = 0
+    synchronized = 0
+
+    def __init__(self, enable_timing=False):
+        self.time = None
+
+    def record(self):
+        FakeEvent.clock += 1
+        self.time = FakeEvent.clock
+
+    def synchronize(self):
+        FakeEvent.synchronized += 1
+
+    def elapsed_time(self, end):
+        return (end.time - self.time) * 1e3
+
+def fake_cuda(monkeypatch):
+    syncs = []
+    monkeypatch.setattr(torch.cuda, 'Event', FakeEvent)
+    monkeypatch.setattr(torch.cuda, 'synchronize', lambda: syncs.append(1))
+    FakeEvent.clock = FakeEvent.synchronized = 0
+    return syncs
+
+def test_stage_timer_uses_cuda_events_without_synchronizing(monkeypatch):
+    syncs = fake_cuda(monkeypatch)
+    timer = StageTimer(cuda=True)
+    for _ in range(3):
+        for name in ('forward', 'backward'):
+            with timer.stage(name):
+                pass
+    assert not syncs and FakeEvent.synchronized == 0
+    assert dict(timer.times) == {'forward': 3.0, 'backward': 3.0}
+    assert FakeEvent.synchronized == 1  # once for all stages read
+    timer.reset()
+    with timer.stage('forward'):
+        pass
+    assert dict(timer.times) == {'forward': 1.0}
+    assert dict(timer.totals) == {'forward': 4.0, 'backward': 3.0}
+
+@pytest.mark.parametrize('sync_cuda, profiling', [(True, False), (False, True)])
+def test_stage_timer_synchronizes_when_asked_or_profiling(monkeypatch, sync_cuda, profiling):
+    syncs = fake_cuda(monkeypatch)
+    timer = StageTimer(cuda=True, sync_cuda=sync_cuda)
+    timer.profiling = profiling
+    with timer.stage('forward'):
+        pass
+    assert len(syncs) == 2 and FakeEvent.clock == 0
+    assert list(timer.times) == ['forward']
+
+
+
+def straightforward_evaluation(model, batches):
+    """Predictions, probabilities, macro F1 and the loss averaged over examples, batch by batch"""
+    logits = torch.cat([model(*batch.tweet) for batch in batches])
+    golds = torch.cat([batch.label for batch in batches])
+    return (logits.argmax(1).tolist(), logits.softmax(1).tolist(),
+            f1_score(golds.tolist(), logits.argmax(1).tolist(), average='macro'),
+            nn.functional.cross_entropy(logits, golds, reduction='sum').item() / len(golds))
+
+def test_evaluate_all_in_a_single_pass():
+    torch.manual_seed(0)
+    model = BagOfTokens()
+    data_iter = Batches(4, batch_size=[7, 1, 3, 5])
+    with torch.no_grad():
+        predictions, probs, f1, loss = straightforward_evaluation(model, data_iter.batches)
+    result = evaluate_all(model, data_iter, nn.CrossEntropyLoss())
+    assert result.preds == predictions
+    assert torch.allclose(torch.tensor(result.probs), torch.tensor(probs))
+    assert result.f1 == pytest.approx(f1)
+    assert result.loss == pytest.approx(loss)  # not the mean of the means of batches of different sizes
+    assert data_iter.repeat
+    assert evaluate_all(model, data_iter).loss is None
+
+def test_evaluate_all_splits_batches_between_processes(monkeypatch):
+    """Each of 2 processes evaluates every other batch, and gets results of both"""
+    torch.manual_seed(0)
+    model = BagOfTokens()
+    sizes = [7, 1, 3, 5, 2]
+    data_iter = Batches(5, batch_size=sizes)
+    single = evaluate_all(model, data_iter, nn.CrossEntropyLoss())
+
+    gathered = {}
+    def all_gather_object(output, obj):
+        gathered[rank] = obj
+        output[:] = [gathered.get(r, obj) for r in range(2)]
+    monkeypatch.setattr(trainer_module.dist, 'all_gather_object', all_gather_object)
+    for rank in (0, 1, 0):  # the first pass of rank 0 only gives its own results
+        monkeypatch.setattr(trainer_module, 'distributed_info', lambda: (rank, 2))
+        result = evaluate_all(model, data_iter, nn.CrossEntropyLoss())
+    assert [len(gathered[rank][0]) for rank in (0, 1)] == [7 + 3 + 2, 1 + 5]
+    starts = [sum(sizes[:i]) for i in range(len(sizes))]
+    rank_order = [0, 2, 4, 1, 3]  # batches of rank 0, then of rank 1
+    assert result.preds == sum((single.preds[starts[i]:starts[i] + sizes[i]] for i in rank_order), [])
+    assert result[:5] == pytest.approx(single[:5])
+
+SIZES = [7, 1, 3, 5, 2]
+
+def evaluate_in_process(rank, init_file, results_dir):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=2)
+    try:
+        torch.manual_seed(0)
+        result = evaluate_all(BagOfTokens(), Batches(5, batch_size=SIZES), nn.CrossEntropyLoss())
+        torch.save(tuple(result), os.path.join(results_dir, f'{rank}.pt'))
+    finally:
+        dist.destroy_process_group()
+
+@pytest.mark.skipif(not dist.is_available(), reason='needs torch.distributed')
+def test_evaluate_all_over_two_processes_is_the_same_as_in_one(tmp_path):
+    torch.manual_seed(0)
+    single = evaluate_all(BagOfTokens(), Batches(5, batch_size=SIZES), nn.CrossEntropyLoss())
+    mp.spawn(evaluate_in_process, args=(str(tmp_path / 'init'), str(tmp_path)), nprocs=2)
+    results = [torch.load(tmp_path / f'{rank}.pt') for rank in (0, 1)]
+    assert results[0] == results[1]
+    result = trainer_module.EvalResult(*results[0])
+    assert result[:5] == pytest.approx(single[:5])
+    starts = [sum(SIZES[:i]) for i in range(len(SIZES))]
+    rank_order = [0, 2, 4, 1, 3]  # batches of rank 0, then of rank 1
+    order = [j for i in rank_order for j in range(starts[i], starts[i] + SIZES[i])]
+    assert result.preds == [single.preds[j] for j in order]
+    assert torch.allclose(torch.tensor(result.probs), torch.tensor(single.probs)[order])
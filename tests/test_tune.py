@@ -0,0 +1,24 @@
+from tune import MedianPruner
+
+
+def test_median_pruner_compares_best_scores_at_the_same_step():
+    curves = [(0, 100, 0.6), (1, 100, 0.5), (2, 100, 0.7), (1, 200, 0.9)]
+    pruner = MedianPruner(trial=3, curves=curves, min_trials=3)
+    assert pruner(100, 0.55)  # below the median 0.6
+    assert not pruner(100, 0.6)  # not below it
+    assert not pruner(200, 0.1)  # a single other trial reached step 200
+    assert curves[-3:] == [(3, 100, 0.55), (3, 100, 0.6), (3, 200, 0.6)]
+
+def test_median_pruner_uses_the_best_score_so_far():
+    curves = [(trial, step, 0.5) for trial in range(4) for step in (100, 200)]
+    pruner = MedianPruner(trial=4, curves=curves, min_trials=4)
+    assert not pruner(100, 0.8)
+    assert not pruner(200, 0.1)  # its best score 0.8 is above the median
+
+def test_median_pruner_waits_for_warmup_and_ignores_its_own_scores():
+    curves = [(0, 50, 0.9), (1, 50, 0.9)]
+    pruner = MedianPruner(trial=2, curves=curves, min_trials=2, warmup_steps=100)
+    assert not pruner(50, 0.1)
+    pruner = MedianPruner(trial=0, curves=[(0, 150, 0.1), (1, 150, 0.5), (2, 150, 0.3)],
+                          min_trials=2, warmup_steps=100)
+    assert pruner(150, 0.35)  # below the median 0.4 of others, not counting its own 0.1
@@ -0,0 +1,66 @@
+import types
+
+import numpy as np
+import pytest
+import torch
+
+from utils import write_pred_to_file
+
+
+class Logits(torch.nn.Module):
+    """Logits of the first two token ids, in `dtype`"""
+    def __init__(self, dtype):
+        super().__init__()
+        self.dtype = dtype
+
+    def forward(self, x, length):
+        return (x[:, :2].float() / 7).to(self.dtype)
+
+class Tokenizer:
+    def decode(self, ids, skip_special_tokens=False):
+        return ' '.join(map(str, ids))
+
+class Batches:
+    def __init__(self, fail=False):
+        self.repeat = True
+        self.fail = fail
+
+    def __iter__(self):
+        for i in range(2):
+            yield types.SimpleNamespace(id=[f'{i}a', f'{i}b'], label=torch.tensor([0, 1]),
+                                        tweet=(torch.tensor([[1, 5, 3], [9, 2, 0]]) + i, torch.tensor([3, 2])))
+        if self.fail:
+            raise RuntimeError('Data error')
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.bfloat16])
+def test_probabilities_are_written_in_the_dtype_of_the_model(tmp_path, dtype):
+    file_name, probs_file = str(tmp_path / 'prediction.tsv'), str(tmp_path / 'prediction.npz')
+    data_iter = Batches()
+    model = Logits(dtype)
+    calls = []
+    model.register_forward_hook(lambda module, inputs, output: calls.append(output))
+    preds, golds = write_pred_to_file(model, data_iter, Tokenizer(), file_name, probs_file)
+    assert data_iter.repeat
+    assert len(calls) == 2  # a single forward pass per batch
+
+    logits = torch.cat([Logits(dtype)(batch.tweet[0], None) for batch in Batches()])
+    with open(file_name) as f:
+        rows = [line.rstrip('\n').split('\t') for line in f]
+    assert rows[0] == ['id', 'tweet', 'pred', 'gold', 'prob']
+    assert [row[1] for row in rows[1:]] == ['1 5 3', '9 2', '2 6 4', '10 3']
+    assert [row[4] for row in rows[1:]] == [' '.join(map(str, p)) for p in logits.softmax(1).tolist()]
+    assert [int(row[2]) for row in rows[1:]] == logits.argmax(1).tolist()
+    assert preds == logits.argmax(1).tolist()
+    assert golds == [int(row[3]) for row in rows[1:]] == [0, 1, 0, 1]
+
+    saved = np.load(probs_file)
+    assert saved['prob'].dtype == np.float32
+    assert np.array_equal(saved['prob'], logits.softmax(1).float().numpy())
+    assert saved['id'].tolist() == [row[0] for row in rows[1:]]
+
+def test_repeat_is_restored_after_an_error(tmp_path):
+    data_iter = Batches(fail=True)
+    with pytest.raises(RuntimeError):
+        write_pred_to_file(Logits(torch.float32), data_iter, Tokenizer(), str(tmp_path / 'prediction.tsv'))
+    assert data_iter.repeat
@@ -0,0 +1,75 @@
+import os
+import glob
+import argparse
+
+from utils import write_to_file
+
+LANGS = ['ar', 'da', 'el', 'en', 'tr']
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Reports the wall time each run took to reach a target validation F1, '
+                    'from the curve.tsv that Trainer writes in runs/{note}_{lang}/{timestamp}. '
+                    'The first note is the baseline the others are compared to.')
+    parser.add_argument('notes', nargs='+', help='Note prefixes of runs, e.g. mBERT for runs/mBERT_ar')
+    parser.add_argument('--langs', nargs='+', default=LANGS)
+    parser.add_argument('--target_f1', nargs='+', default=[], metavar='LANG=F1',
+                        help='Target validation F1 of languages, e.g. da=0.75')
+    parser.add_argument('--target_fraction', type=float, default=0.95,
+                        help='Target of languages without --target_f1, as a fraction of the '
+                             'lowest best validation F1 among the runs, so that every run reaches it')
+    parser.add_argument('--results', default=os.path.join('runs', 'time_to_target.tsv'))
+    return parser.parse_args()
+
+def latest_run(note, lang):
+    """exp_dir of the latest run with the note, or None"""
+    curves = sorted(glob.glob(os.path.join('runs', f'{note}_{lang}', '*', 'curve.tsv')),
+                    key=os.path.getmtime)
+    return os.path.dirname(curves[-1]) if curves else None
+
+def read_curve(exp_dir):
+    with open(os.path.join(exp_dir, 'curve.tsv')) as f:
+        header = next(f).rstrip('\n').split('\t')
+        rows = [dict(zip(header, line.rstrip('\n').split('\t'))) for line in f]
+    return [{'step': int(r['step']), 'seconds': float(r['seconds']), 'examples': int(r['examples']),
+             'tokens': int(r['tokens']), 'val_f1': float(r['val_f1'])} for r in rows]
+
+def time_to_target(curve, target):
+    """The first record at which validation F1 reached target, or None"""
+    return next((row for row in curve if row['val_f1'] >= target), None)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    targets = {lang: float(f1) for lang, f1 in (t.split('=') for t in args.target_f1)}
+
+    results = []
+    for lang in args.langs:
+        runs = {note: latest_run(note, lang) for note in args.notes}
+        curves = {note: read_curve(exp_dir) for note, exp_dir in runs.items() if exp_dir is not None}
+        if not curves:
+            print(f'No runs for {lang}')
+            continue
+        target = targets.get(lang, args.target_fraction *
+                             min(max(r['val_f1'] for r in curve) for curve in curves.values()))
+        baseline = None
+        for note in args.notes:
+            reached = time_to_target(curves[note], target) if note in curves else None
+            result = {'lang': lang, 'note': note, 'target_f1': target, 'exp_dir': runs[note],
+                      **(reached or {'step': None, 'seconds': None, 'examples': None, 'tokens': None}),
+                      'speedup': None}
+            if note == args.notes[0]:
+                baseline = result['seconds']
+            elif baseline is not None and result['seconds']:
+                result['speedup'] = baseline / result['seconds']
+            results.append(result)
+
+    header = ['lang', 'note', 'target_f1', 'step', 'seconds', 'examples', 'tokens', 'speedup', 'exp_dir']
+    columns = [[f'{r[k]:.4f}' if isinstance(r[k], float) else '-' if r[k] is None else str(r[k])
+                for r in results] for k in header]
+    os.makedirs(os.path.dirname(args.results) or '.', exist_ok=True)
+    write_to_file(args.results, header, *columns)
+    print('\t'.join(header))
+    for line in zip(*columns):
+        print('\t'.join(line))
+    print(f'Results are written to {args.results}')
@@ -3,6 +3,8 @@ import argparse
 import logging
 
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from setproctitle import setproctitle
 
 from dataloading import build_data
@@ -10,7 +12,7 @@ from model import build_model
 from trainer import build_trainer
 from utils import *
 from optimizer import build_optimizer_scheduler
-from preprocessing import build_preprocess, build_tokenizer
+from preprocessing import build_preprocess, build_tokenizer, segment_cache, PREPROCESS_OPTIONS
 
 # torch.manual_seed(0)
 # torch.backends.cudnn.deterministic = True
@@ -20,12 +22,27 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
                     datefmt = '%m/%d/%Y %H:%M:%S', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def parse_args():
+def build_parser():
     parser = argparse.ArgumentParser()
     data = parser.add_argument_group('Data')
     data.add_argument('--train_path', default='../data/olid/da/offenseval-da-training-v1-train.tsv')
     data.add_argument('--val_path', default='../data/olid/da/offenseval-da-training-v1-test.tsv')
     data.add_argument('--test_path', default=None)
+    data.add_argument('--cache_dir', default=None,
+                      help='Directory to cache encoded datasets in, except streamed training data. '
+                           'Disabled if not given.')
+    data.add_argument('--num_workers', type=int, default=1,
+                      help='Number of processes to preprocess and tokenize datasets with')
+    data.add_argument('--stream', action='store_true',
+                      help='Read training data lazily with bounded memory, for very large files')
+    data.add_argument('--shuffle_buffer', type=int, default=10000,
+                      help='Number of examples to shuffle within in streaming mode')
+    data.add_argument('--bucket_window', type=int, default=100,
+                      help='Number of batches to bucket by length within in streaming mode')
+    data.add_argument('--prefetch', type=int, default=0,
+                      help='Number of batches to prepare in the background. Disabled if 0. '
+                           'On CPU, batches are padded in reused buffers, which hold a batch '
+                           'until accumulation_steps batches after it.')
 
     preprocess = parser.add_argument_group('Preprocessing options')
     preprocess.add_argument('--demojize', action='store_true')
@@ -35,6 +52,9 @@ def parse_args():
     preprocess.add_argument('--add_cap_sign', action='store_true')
     preprocess.add_argument('--mention_limit', type=int, default=3)
     preprocess.add_argument('--punc_limit', type=int, default=3)
+    preprocess.add_argument('--segment_cache_size', type=int, default=100000)
+    preprocess.add_argument('--segment_cache_path', default=None,
+                            help='File to persist hashtag segmentations in across runs')
 
     model = parser.add_argument_group('Model options')
     model.add_argument('--model', choices=['mbert', 'xlm'], default='mbert')
@@ -43,6 +63,8 @@ def parse_args():
     model.add_argument('--layer', type=int, choices=range(1, 13), nargs='+', default=[12])
     model.add_argument('--attention_probs_dropout_prob', type=float, default=0.1)
     model.add_argument('--hidden_dropout_prob', type=float, default=0.3)
+    model.add_argument('--gradient_checkpointing', action='store_true',
+                       help='Recompute encoder activations in the backward pass to save memory')
 
     optimizer_scheduler = parser.add_argument_group('Optimizer and scheduler options')
     optimizer_scheduler.add_argument('--lr', type=float, default=0.00002)
@@ -54,17 +76,58 @@ def parse_args():
     optimizer_scheduler.add_argument('--weight_decay', type=float, default=0.0)
     optimizer_scheduler.add_argument('--layer_decrease', type=float, default=1.0)
     optimizer_scheduler.add_argument('--freeze_upto', type=int, default=-1)
+    optimizer_scheduler.add_argument('--cache_frozen', action='store_true',
+                                     help='Compute the output of frozen layers once per example and '
+                                          'cache it in cache_dir, so that only upper layers are trained. '
+                                          'Frozen layers then run without dropout.')
 
     training = parser.add_argument_group('Training options')
     training.add_argument('--batch_size', type=int, default=32)
+    training.add_argument('--max_tokens', type=int, default=None,
+                          help='Batch by number of padded tokens instead of batch_size')
+    training.add_argument('--pad_to_multiple_of', type=int, default=1,
+                          help='Round up the padded length of batches, e.g. to 8')
     training.add_argument('--train_step', type=int, default=700)
+    training.add_argument('--accumulation_steps', type=int, default=1,
+                          help='Number of batches to accumulate gradients over per optimizer step. '
+                               'The effective batch size is batch_size * accumulation_steps.')
     training.add_argument('--record_every', type=int, default=10)
+    training.add_argument('--train_window', type=int, default=None,
+                          help='Number of recent batches to compute training metrics on. '
+                               'Defaults to record_every.')
+    training.add_argument('--train_eval_every', type=int, default=0,
+                          help='Evaluate on the entire training data every this many steps. '
+                               'Disabled if 0.')
     training.add_argument('--patience', type=int, default=20)
+    training.add_argument('--checkpoint', choices=['disk', 'memory', 'async'], default='disk',
+                          help='Where to keep the best model during training: saved to disk, '
+                               'in CPU memory, or in memory and saved on a background thread')
     training.add_argument('--cuda', type=int, default=0)
+    training.add_argument('--distributed', action='store_true',
+                          help='Train data-parallel in each of the processes started by '
+                               'torchrun, e.g. with scripts/run_distributed.sh. '
+                               'batch_size is per process.')
+    training.add_argument('--precision', choices=['fp32', 'bf16'], default='fp32',
+                          help='Compute forward passes and the loss in bfloat16 with autocast. '
+                               'Weights and optimizer states stay in float32.')
+    training.add_argument('--profile_steps', type=int, nargs=2, default=None, metavar=('START', 'END'),
+                          help='Run torch.profiler from step START to END, and save a Chrome trace '
+                               'to trace.json in the experiment directory')
+    training.add_argument('--sync_timing', action='store_true',
+                          help='Synchronize the GPU at the boundaries of the stages of training steps '
+                               'to time them by wall time, instead of with CUDA events. '
+                               'Always done while profiling.')
+    training.add_argument('--save_probs', action='store_true',
+                          help='Also save test predictions with float32 probabilities to prediction.npz')
     training.add_argument('--note', type=str, default='')
     parser.add_argument('--debug', action='store_true')
+    return parser
 
+def parse_args(parser=None):
+    parser = parser or build_parser()
     args = parser.parse_args()
+    if args.cache_frozen and (args.freeze_upto < 0 or args.cache_dir is None):
+        parser.error('--cache_frozen needs --freeze_upto and --cache_dir')
     # TODO: clean these hacks..
     args.device = torch.device(f'cuda:{args.cuda}') if torch.cuda.is_available() else torch.device('cpu')
     if args.debug:
@@ -108,30 +171,59 @@ def generate_exp_name(args, preprocessing=True, modeling=True, optim_schedule=Tr
     to_include.append('_'.join([args.note]))
     return '_'.join(to_include)
 
-if __name__ == "__main__":
-    args = parse_args()
-    exp_name = generate_exp_name(args)
-    setproctitle(args.note)
+def prepare_data(args, rank=0, world_size=1):
+    """Builds the tokenizer and the data, sharded for `rank` in distributed training"""
     preprocess = build_preprocess(demojize=args.demojize,
                                   textify_emoji=args.textify_emoji,
                                   mention_limit=args.mention_limit,
                                   punc_limit=args.punc_limit,
                                   lower_hashtag=args.lower_hashtag,
                                   segment_hashtag=args.segment_hashtag,
-                                  add_cap_sign=args.add_cap_sign)
+                                  add_cap_sign=args.add_cap_sign,
+                                  segment_cache_size=args.segment_cache_size,
+                                  segment_cache_path=args.segment_cache_path)
     tokenizer = build_tokenizer(model=args.model,
                                 add_cap_sign=args.add_cap_sign,
                                 textify_emoji=args.textify_emoji,
                                 segment_hashtag=args.segment_hashtag,
                                 preprocess=preprocess)
-    preproc = lambda x: x[:509]
+    max_length = 509
+    preproc = lambda x: x[:max_length]
+    cache_config = {opt: getattr(args, opt) for opt in PREPROCESS_OPTIONS}
+    cache_config['max_length'] = max_length
     olid_data = build_data(train_path=args.train_path,
                            val_path=args.val_path,
                            test_path=args.test_path,
                            preprocessing=preproc,
                            tokenizer=tokenizer,
                            batch_size=args.batch_size,
-                           device=args.device)
+                           device=args.device,
+                           cache_dir=args.cache_dir,
+                           cache_config=cache_config,
+                           num_workers=args.num_workers,
+                           stream=args.stream,
+                           shuffle_buffer=args.shuffle_buffer,
+                           bucket_window=args.bucket_window,
+                           max_tokens=args.max_tokens,
+                           pad_to_multiple_of=args.pad_to_multiple_of,
+                           prefetch=args.prefetch,
+                           batches_in_use=args.accumulation_steps,
+                           rank=rank,
+                           world_size=world_size)
+    if args.segment_hashtag:
+        logger.info(f'Hashtag segmentation cache: {segment_cache.info()}')
+    return tokenizer, olid_data
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.distributed:
+        dist.init_process_group('gloo')
+        if args.device.type == 'cuda':
+            args.device = torch.device(f"cuda:{os.environ.get('LOCAL_RANK', 0)}")
+    rank, world_size = distributed_info()
+    exp_name = generate_exp_name(args)
+    setproctitle(args.note)
+    tokenizer, olid_data = prepare_data(args, rank, world_size)
     model = build_model(model=args.model,
                         time_pooling=args.time_pooling,
                         layer_pooling=args.layer_pooling,
@@ -139,7 +231,21 @@ if __name__ == "__main__":
                         new_num_tokens=len(tokenizer),
                         hidden_dropout_prob=args.hidden_dropout_prob,
                         attention_probs_dropout_prob=args.attention_probs_dropout_prob,
-                        device=args.device)
+                        device=args.device,
+                        precision=args.precision,
+                        gradient_checkpointing=args.gradient_checkpointing,
+                        cached_layers=args.freeze_upto + 1 if args.cache_frozen else 0)
+    if args.cache_frozen:
+        if args.distributed:
+            # Features of rank 0's weights, which DistributedDataParallel would broadcast later.
+            # Other ranks wait for rank 0 to cache the shared validation and test data,
+            # and then only cache their own shard of the training data.
+            broadcast_state(model)
+            if rank != 0:
+                dist.barrier()
+        olid_data.cache_features(model)
+        if args.distributed and rank == 0:
+            dist.barrier()
     optimizer, scheduler = build_optimizer_scheduler(model=model,
                                                      lr=args.lr,
                                                      betas=(args.beta1, args.beta2),
@@ -149,6 +255,11 @@ if __name__ == "__main__":
                                                      layer_decrease=args.layer_decrease,
                                                      freeze_upto=args.freeze_upto,
                                                      train_step=args.train_step)
+    if args.distributed:
+        # Wrapped after freezing layers, which then are not synchronized.
+        # Unused parameters are those of pooler and layers above args.layer
+        model = DistributedDataParallel(model, find_unused_parameters=True,
+                                        device_ids=[args.device] if args.device.type == 'cuda' else None)
     trainer = build_trainer(model=model,
                             data=olid_data,
                             optimizer=optimizer,
@@ -156,10 +267,21 @@ if __name__ == "__main__":
                             max_grad_norm=args.max_grad_norm,
                             patience=args.patience,
                             record_every=args.record_every,
-                            exp_name=exp_name)
+                            exp_name=exp_name,
+                            train_window=args.train_window,
+                            train_eval_every=args.train_eval_every,
+                            checkpoint=args.checkpoint,
+                            precision=args.precision,
+                            accumulation_steps=args.accumulation_steps,
+                            profile_steps=args.profile_steps,
+                            sync_timing=args.sync_timing)
 
     logger.info(f'Training logs are in {exp_name}')
     trained_model, summary = trainer.train(args.train_step)
+    if args.distributed:
+        dist.destroy_process_group()
+    if rank != 0:  # only the main process has the best model
+        raise SystemExit
 
     best_model_file = os.path.join(trainer.exp_dir, 'best_model.pt')
     pred_file = os.path.join(trainer.exp_dir, 'prediction.tsv')
@@ -167,13 +289,14 @@ if __name__ == "__main__":
     args_file = os.path.join(trainer.exp_dir, 'args.bin')
     save_model(trained_model, best_model_file)
     save_tokenizer(tokenizer, trainer.exp_dir)
-    write_pred_to_file(trained_model, trainer.test_iter, tokenizer, pred_file)
+    save_labels(dict(olid_data.fields)['label'].vocab.itos, trainer.exp_dir)
+    probs_file = os.path.join(trainer.exp_dir, 'prediction.npz') if args.save_probs else None
+    write_pred_to_file(trained_model, trainer.test_iter, tokenizer, pred_file, probs_file)
     write_args_to_file(args, args_file)
     write_summary_to_file(summary, summary_file)
 
     print('\n******************* Training summary *******************')
     print(summary, end='\n\n')
-    print('Best model, tokenizer, prediction, args, summary are saved')
+    print('Best model, tokenizer, labels, prediction, args, summary are saved')
     print(f'Tensorboard exp_name: {exp_name}')
     print('********************************************************')
-
@@ -1,23 +1,44 @@
 import os
+import time
 import logging
+import resource
+import threading
+from itertools import islice
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict, deque, namedtuple
 
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from torch.profiler import profile, record_function, ProfilerActivity
 from torch.utils.tensorboard import SummaryWriter
 
 from utils import *
 
 logger = logging.getLogger(__name__)
 
+EvalResult = namedtuple('EvalResult', ['f1', 'prec', 'rec', 'acc', 'loss', 'preds', 'probs'])
+
 class EarlyStopping:
-    """Early stops the training if validation loss doesn't improve after a given patience."""
-    def __init__(self, model, patience, savedir, delta=0, mode='max', verbose=False):
+    """Early stops the training if validation loss doesn't improve after a given patience.
+    The best model is checkpointed according to `checkpoint`:
+        'disk': saved to `savedir` whenever it improves
+        'memory': kept as a snapshot on CPU memory only
+        'async': kept as a snapshot, which is also saved to `savedir` on a background thread
+    In distributed training, only the main process keeps the best model.
+    """
+    def __init__(self, model, patience, savedir, delta=0, mode='max', verbose=False,
+                 checkpoint='disk'):
+        assert checkpoint in {'disk', 'memory', 'async'}
         self.model = model
         self.patience = patience
         self.delta = delta
         self.mode = mode
         self.savedir = os.path.join(savedir, 'best_model_checkpoint.pt')
         self.verbose = verbose
+        self.checkpoint = checkpoint
+        self.snapshot = None
+        self.writer_thread = None
         self.counter = 0
         self.best_step = None
         self.best_score = None
@@ -46,22 +67,141 @@ class EarlyStopping:
     def save_checkpoint(self):
         '''Saves model when validation score improves.'''
         curr_score = -self.best_score if self.mode == 'min' else self.best_score
+        self.prev_best_score, prev_best_score = curr_score, self.prev_best_score
+        if not is_main_process():
+            return
         if self.verbose:
-            logger.info(f'Best score on validation improved ({self.prev_best_score:.6f} -->'
+            logger.info(f'Best score on validation improved ({prev_best_score:.6f} -->'
                   f'{curr_score:.6f}). Checkpoint model saved.')
-        torch.save(self.model.state_dict(), self.savedir)
-        self.prev_best_score = curr_score
+        if self.checkpoint == 'disk':
+            torch.save(self.model.state_dict(), self.savedir)
+        else:
+            self.take_snapshot()
+            if self.checkpoint == 'async':
+                self.writer_thread = threading.Thread(target=self.write_snapshot)
+                self.writer_thread.start()
+
+    def take_snapshot(self):
+        """Copies weights to CPU tensors, which are allocated once and reused"""
+        self.wait_for_write()  # the snapshot may still be being written
+        state_dict = self.model.state_dict()
+        if self.snapshot is None:
+            self.snapshot = {k: torch.empty_like(v, device='cpu') for k, v in state_dict.items()}
+        for k, v in state_dict.items():
+            self.snapshot[k].copy_(v)
+
+    def write_snapshot(self):
+        tmp_path = self.savedir + '.tmp'
+        torch.save(self.snapshot, tmp_path)
+        os.replace(tmp_path, self.savedir)  # atomic, so that a readable checkpoint always exists
+
+    def wait_for_write(self):
+        if self.writer_thread is not None:
+            self.writer_thread.join()
+            self.writer_thread = None
+
+    def load_best(self):
+        """Restores the best weights, from memory if a snapshot is kept"""
+        if not is_main_process():
+            return
+        if self.snapshot is not None:
+            self.model.load_state_dict(self.snapshot)
+        else:
+            self.model.load_state_dict(torch.load(self.savedir))
 
     def delete_checkpoint(self):
+        self.wait_for_write()
         if os.path.exists(self.savedir):
             os.remove(self.savedir)
 
 
+class StageTimer:
+    """Accumulates time of stages of training steps, since the last reset and in total.
+    On GPU, stages are timed with CUDA events, which are read along with the times. With `sync_cuda`
+    or while `profiling`, kernels are instead synchronized at stage boundaries, so that wall times
+    include them. Stages are also labeled in torch.profiler traces while `profiling`."""
+    def __init__(self, cuda=False, sync_cuda=False):
+        self.cuda = cuda
+        self.sync_cuda = sync_cuda
+        self.profiling = False
+        self.pending = []  # (name, start event, end event) of stages not read yet
+        self._times = defaultdict(float)
+        self._totals = defaultdict(float)
+
+    @property
+    def times(self):
+        self.read()
+        return self._times
+
+    @property
+    def totals(self):
+        self.read()
+        return self._totals
+
+    @contextmanager
+    def stage(self, name):
+        sync = self.cuda and (self.sync_cuda or self.profiling)
+        events = self.cuda and not sync
+        if sync:
+            torch.cuda.synchronize()
+        if events:
+            start = torch.cuda.Event(enable_timing=True)
+            start.record()
+        else:
+            start = time.time()
+        with record_function(name) if self.profiling else nullcontext():
+            yield
+            if sync:
+                torch.cuda.synchronize()
+        if events:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            self.pending.append((name, start, end))
+        else:
+            self.add(name, time.time() - start)
+
+    def read(self):
+        """Adds the times of stages timed with CUDA events, once the last of them has run"""
+        if self.pending:
+            self.pending[-1][2].synchronize()
+            for name, start, end in self.pending:
+                self.add(name, start.elapsed_time(end) / 1e3)
+            self.pending.clear()
+
+    def add(self, name, elapsed):
+        self._times[name] += elapsed
+        self._totals[name] += elapsed
+
+    def reset(self):
+        self.read()
+        self._times.clear()
+
+
+def peak_memory_mb(device):
+    """Peak memory allocated on GPU since the last reset, or peak resident memory of the process on CPU"""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10  # in KB on Linux
+
+
 class Trainer:
+    """Trains `model`, which may be wrapped in DistributedDataParallel. In distributed training,
+    every process evaluates part of the data and gets the metrics of all of it, while only the
+    main process writes TensorBoard logs and checkpoints."""
     def __init__(self, model, train_iter, val_iter, optimizer, scheduler,
                  max_grad_norm, patience, exp_name, record_every=100,
-                 verbose=True, test_iter=None):
+                 verbose=True, test_iter=None, train_window=None, train_eval_every=0,
+                 checkpoint='disk', precision='fp32', accumulation_steps=1, pruner=None,
+                 profile_steps=None, sync_timing=False):
         self.model = model
+        self.module = getattr(model, 'module', model)  # unwrapped from DistributedDataParallel
+        self.device = next(self.module.parameters()).device
+        self.timer = StageTimer(cuda=self.device.type == 'cuda', sync_cuda=sync_timing)
+        # torch.profiler runs from the first to the last step of `profile_steps` if given
+        self.profile_steps = profile_steps
+        self.profiler = None
+        self.accumulation_steps = accumulation_steps
+        self.precision = precision
         self.train_iter = train_iter
         self.val_iter = val_iter
         self.test_iter = test_iter
@@ -69,136 +209,317 @@ class Trainer:
         self.scheduler = scheduler
         self.max_grad_norm = max_grad_norm
         self.record_every = record_every
+        # Training metrics are computed over the last `train_window` (micro-)batches, and
+        # on the entire training data only every `train_eval_every` steps if given
+        self.train_window = deque(maxlen=train_window or record_every * accumulation_steps)
+        self.train_eval_every = train_eval_every
         self.criterion = nn.CrossEntropyLoss()
         self.exp_dir = rename_expname(exp_name)
-        self.early_stopper = EarlyStopping(model, patience, self.exp_dir, verbose=verbose)
-        self.writer = SummaryWriter(self.exp_dir)
-        self.verbose = verbose
+        self.early_stopper = EarlyStopping(self.module, patience, self.exp_dir, verbose=verbose,
+                                           checkpoint=checkpoint)
+        self.writer = SummaryWriter(self.exp_dir) if is_main_process() else NullWriter()
+        self.verbose = verbose and is_main_process()
+        self.best_results = {}  # evaluation results at the best step
+        # Called with the step and validation F1 at each record, returns whether to stop early
+        self.pruner = pruner
+        self.pruned = False
+        self.total_train_time = 0.0
+        self.total_examples = self.total_tokens = 0
+        self.total_steps = 0
+        # Cumulative wall time, examples and tokens at each record, with the F1 scores then
+        self.curve = []
+        self.train_start = None
+        self.reset_throughput()
+
+    def reset_throughput(self):
+        self.n_examples = self.n_tokens = self.n_padded_tokens = 0
+        self.throughput_start = time.time()
+
+    def count_tokens(self, batch):
+        x, length = batch.tweet
+        self.n_examples += x.size(0)
+        self.n_tokens += length.sum().item()
+        self.n_padded_tokens += x.numel()
+
+    def record_throughput(self, step):
+        """Training throughput since the last record, excluding evaluation,
+        summed over processes in distributed training"""
+        elapsed = time.time() - self.throughput_start
+        counts = torch.tensor([self.n_examples, self.n_tokens, self.n_padded_tokens],
+                              dtype=torch.float64)
+        if distributed_info()[1] > 1:
+            dist.all_reduce(counts)
+        n_examples, n_tokens, n_padded_tokens = counts.tolist()
+        self.total_train_time += elapsed
+        self.total_examples += n_examples
+        self.total_tokens += n_tokens
+        tokens_per_sec = n_tokens / elapsed
+        padding_ratio = 1 - n_tokens / max(n_padded_tokens, 1)
+        self.writer.add_scalar('Throughput/examples_per_sec', n_examples / elapsed, step)
+        self.writer.add_scalar('Throughput/tokens_per_sec', tokens_per_sec, step)
+        self.writer.add_scalar('Throughput/padding_ratio', padding_ratio, step)
+        return tokens_per_sec, padding_ratio
+
+    def record_curve(self, step, val_f1, test_f1=None):
+        """Appends a row to curve.tsv in exp_dir, which time_to_target.py reads.
+        seconds is the wall time since training started, including evaluation,
+        and train_seconds excludes it"""
+        self.curve.append([step, time.time() - self.train_start, self.total_train_time,
+                           self.total_examples, self.total_tokens, val_f1, test_f1])
+        if is_main_process():
+            os.makedirs(self.exp_dir, exist_ok=True)
+            header = ['step', 'seconds', 'train_seconds', 'examples', 'tokens', 'val_f1', 'test_f1']
+            columns = [[str(int(v)) if k in ('step', 'examples', 'tokens') else
+                        '' if v is None else f'{v:.4f}' for v in column]
+                       for k, column in zip(header, zip(*self.curve))]
+            write_to_file(os.path.join(self.exp_dir, 'curve.tsv'), header, *columns)
+
+    def record_stages(self, step):
+        """Seconds per step of each stage, averaged since the last record, and peak memory"""
+        for name, elapsed in self.timer.times.items():
+            self.writer.add_scalar(f'Time/{name}', elapsed / self.record_every, step)
+        self.writer.add_scalar('Memory/peak_mb', peak_memory_mb(self.device), step)
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.timer.reset()
+
+    def start_profiler(self):
+        activities = [ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(ProfilerActivity.CUDA)
+        self.profiler = profile(activities=activities, record_shapes=True, profile_memory=True)
+        self.profiler.start()
+        self.timer.profiling = True
+
+    def stop_profiler(self):
+        self.profiler.stop()
+        self.timer.profiling = False
+        if is_main_process():
+            os.makedirs(self.exp_dir, exist_ok=True)
+            trace_file = os.path.join(self.exp_dir, 'trace.json')
+            self.profiler.export_chrome_trace(trace_file)
+            logger.info(f'Profiler trace of steps {self.profile_steps} is saved in {trace_file}')
+        self.profiler = None
 
     def compute_loss(self, batch):
-        logits = self.model(*batch.tweet)
-        loss = self.criterion(logits, batch.label)
-        return loss
-
-    def compute_entire_loss(self, data_iter):
-        data_iter.repeat = False
-        with torch.no_grad():
-            losses = list(map(self.compute_loss, data_iter))
-            loss = sum(losses) / len(losses) # TODO: not exactly accurate
-        data_iter.repeat = True
-        return loss
+        logits = self.model(*model_inputs(batch))
+        with autocast(self.precision, logits.device):
+            loss = self.criterion(logits, batch.label)
+        return loss, logits
+
+    def update_train_window(self, loss, logits, batch):
+        self.train_window.append((logits.detach().argmax(1).tolist(),
+                                  batch.label.tolist(), loss.item()))
+
+    def train_window_metrics(self):
+        """Metrics and the mean loss over the batches in the training window"""
+        predictions, golds, loss = [], [], 0.0
+        for pred, gold, batch_loss in self.train_window:
+            predictions += pred
+            golds += gold
+            loss += batch_loss * len(gold)
+        metrics = (calc_f1(predictions, golds), calc_prec(predictions, golds),
+                   calc_rec(predictions, golds), calc_acc(predictions, golds))
+        return metrics, loss / len(golds)
+
+    def accumulated_batches(self, data_iter):
+        """Yields groups of `accumulation_steps` micro-batches, one group per optimizer step,
+        along with the time spent waiting for them"""
+        batches = iter(data_iter)
+        while True:
+            start = time.time()
+            group = list(islice(batches, self.accumulation_steps))
+            if len(group) < self.accumulation_steps:
+                return
+            yield group, time.time() - start
 
     def train(self, train_step):
-        for step, batch in enumerate(self.train_iter, 1):
+        self.train_start = time.time()
+        for step, (micro_batches, data_wait) in enumerate(self.accumulated_batches(self.train_iter), 1):
+            self.timer.add('data_wait', data_wait)
+            self.total_steps = step
+            if self.profile_steps is not None and step == self.profile_steps[0]:
+                self.start_profiler()
             self.model.train()
-            loss = self.compute_loss(batch)
 
             self.optimizer.zero_grad()
-            loss.backward()
-            nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
-            self.optimizer.step()
-            self.scheduler.step()
+            for i, batch in enumerate(micro_batches, 1):
+                # Gradients are synchronized across processes only on the last micro-batch
+                sync = i == len(micro_batches) or not hasattr(self.model, 'no_sync')
+                with nullcontext() if sync else self.model.no_sync():
+                    with self.timer.stage('forward'):
+                        loss, logits = self.compute_loss(batch)
+                    with self.timer.stage('backward'):
+                        (loss / self.accumulation_steps).backward()
+                self.count_tokens(batch)
+                self.update_train_window(loss, logits, batch)
+            with self.timer.stage('clip'):
+                nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
+            with self.timer.stage('optimizer'):
+                self.optimizer.step()
+                self.scheduler.step()  # once per optimizer step, not per micro-batch
+            if self.profiler is not None and step == self.profile_steps[1]:
+                self.stop_profiler()
 
             if step % self.record_every == 0:
-                val_loss = self.compute_entire_loss(self.val_iter)
-                val_metrics = self.evaluate(self.val_iter)
-                train_metrics = self.evaluate(self.train_iter) # optional
-                self.record('val', step, *val_metrics, loss=val_loss)
-                self.record('train', step, *train_metrics, loss=loss)
+                tokens_per_sec, padding_ratio = self.record_throughput(step)
+                with self.timer.stage('eval'):
+                    val_result = self.evaluate(self.val_iter)
+                train_metrics, train_loss = self.train_window_metrics()
+                self.record('val', step, *val_result[:4], loss=val_result.loss)
+                self.record('train', step, *train_metrics, loss=train_loss)
                 if self.test_iter is not None:
-                    test_loss = self.compute_entire_loss(self.test_iter)
-                    test_metrics = self.evaluate(self.test_iter)
-                    self.record('test', step, *test_metrics, loss=test_loss)
+                    with self.timer.stage('eval'):
+                        test_result = self.evaluate(self.test_iter)
+                    self.record('test', step, *test_result[:4], loss=test_result.loss)
+                self.record_curve(step, val_result.f1,
+                                  test_result.f1 if self.test_iter is not None else None)
                 self.writer.add_scalar('Learning_rate', self.scheduler.get_lr()[0], step)
 
                 if self.verbose:
                     print(f'At step: {step}')
-                    self.report('train', *train_metrics, loss=loss)
-                    self.report('val', *val_metrics, loss=val_loss)
+                    self.report('train', *train_metrics, loss=train_loss)
+                    self.report('val', *val_result[:4], loss=val_result.loss)
                     if self.test_iter is not None:
-                        self.report('test', *test_metrics)
+                        self.report('test', *test_result[:4])
+                    print(f'\ttokens/sec: {tokens_per_sec:.1f}, padding ratio: {padding_ratio:.4f}')
 
-                val_f1 = val_metrics[0]
-                self.early_stopper(step, val_f1)
+                with self.timer.stage('checkpoint'):
+                    self.early_stopper(step, val_result.f1)
+                self.record_stages(step)
+                if self.early_stopper.best_step == step:
+                    self.best_results = {'val': val_result}
+                    if self.test_iter is not None:
+                        self.best_results['test'] = test_result
+                if self.pruner is not None and self.pruner(step, val_result.f1):
+                    logger.info(f'..... Pruned at step {step}, terminating training .....')
+                    self.pruned = True
+                    return self.finish_training()
                 if self.early_stopper.early_stop:
                     logger.info(f'..... Early stopping patience reached at step {step}, terminating training .....')
                     return self.finish_training()
+                self.reset_throughput()
+
+            if self.train_eval_every and step % self.train_eval_every == 0:
+                start = time.time()
+                with self.timer.stage('eval'):
+                    full_train_result = self.evaluate(self.train_iter)
+                self.throughput_start += time.time() - start  # not counted as training time
+                self.record('train_full', step, *full_train_result[:4], loss=full_train_result.loss)
+                if self.verbose:
+                    if step % self.record_every != 0:
+                        print(f'At step: {step}')
+                    self.report('train_full', *full_train_result[:4])
 
             if step == train_step:
                 logger.info(f'\n..... Max train step({train_step}) reached, terminating training .....\n')
                 return self.finish_training()
 
     def finish_training(self):
-        self.model.load_state_dict(torch.load(self.early_stopper.savedir))
+        if self.profiler is not None:  # stopped before the end of the profiled steps
+            self.stop_profiler()
+        self.early_stopper.load_best()
         summary = self.summarize_training()
         self.writer.add_text('Summary', summary)
         self.early_stopper.delete_checkpoint()
         self.writer.close()
-        return self.model, summary
+        return self.module, summary
 
     def summarize_training(self):
+        """Summarizes results of the best model, which were computed when it was found"""
+        if 'val' not in self.best_results:
+            self.best_results['val'] = self.evaluate(self.val_iter)
+        if self.test_iter is not None and 'test' not in self.best_results:
+            self.best_results['test'] = self.evaluate(self.test_iter)
+
         summary = f'Best model was found at step: {self.early_stopper.best_step}\n'
         summary += 'On validation data:\n'
-        f1, prec, rec, acc = self.evaluate(self.val_iter)
-        summary += f'accuracy-{acc:.4f}, precision-{prec:.4f}, recall-{rec:.4f}, f1-{f1:.4f}\n'
-        if self.test_iter is not None:
-            summary += 'On test data:\n'
-            f1, prec, rec, acc = self.evaluate(self.test_iter)
+        f1, prec, rec, acc = self.best_results['val'][:4]
         summary += f'accuracy-{acc:.4f}, precision-{prec:.4f}, recall-{rec:.4f}, f1-{f1:.4f}'
+        if self.test_iter is not None:
+            summary += '\nOn test data:\n'
+            f1, prec, rec, acc = self.best_results['test'][:4]
+            summary += f'accuracy-{acc:.4f}, precision-{prec:.4f}, recall-{rec:.4f}, f1-{f1:.4f}'
+        if self.total_train_time > 0:
+            summary += f'\nTraining throughput in {self.precision}: ' \
+                       f'{self.total_examples / self.total_train_time:.1f} examples/sec, ' \
+                       f'{self.total_tokens / self.total_train_time:.1f} tokens/sec'
+        if self.total_steps > 0:
+            summary += '\nTime per step: ' + ', '.join(
+                f'{name} {elapsed / self.total_steps:.4f}s' for name, elapsed in self.timer.totals.items())
         return summary
 
     def record(self, kind, step, f1, prec, rec, acc, loss=None):
-        assert kind in {'train', 'val', 'test'}
+        assert kind in {'train', 'train_full', 'val', 'test'}
         self.writer.add_scalar(f'F1/{kind}', f1, step)
         self.writer.add_scalar(f'Precision/{kind}', prec, step)
         self.writer.add_scalar(f'Recall/{kind}', rec, step)
         self.writer.add_scalar(f'Acc/{kind}', acc, step)
         if loss is not None:
-            self.writer.add_scalar(f'Loss/{kind}', loss.item(), step) # batch loss
+            self.writer.add_scalar(f'Loss/{kind}', float(loss), step)
 
     def report(self, kind, f1, prec, rec, acc, loss=None):
-        assert kind in {'train', 'val', 'test'}
+        assert kind in {'train', 'train_full', 'val', 'test'}
         if loss is not None:
-            print(f'\t{kind} loss: {loss.item():.6f}')
+            print(f'\t{kind} loss: {float(loss):.6f}')
         print(f'\t{kind} F1: {f1:.6f}')
 
     def evaluate(self, data_iter):
-        self.model.eval()
-        data_iter.repeat = False
-        predictions, golds = [], []
-        with torch.no_grad():
-            for batch in data_iter:
-                pred = self.model.predict(*batch.tweet)
-                predictions += pred.tolist()
-                golds += batch.label.tolist()
-        f1 = calc_f1(predictions, golds)
-        prec = calc_prec(predictions, golds)
-        rec = calc_rec(predictions, golds)
-        acc = calc_acc(predictions, golds)
-        data_iter.repeat = True
-        return f1, prec, rec, acc
+        # The training data is sharded already, the others are split by batch
+        return evaluate_all(self.module, data_iter, self.criterion,
+                            split_batches=data_iter is not self.train_iter)
 
-def evaluate(model, data_iter):
+def evaluate_all(model, data_iter, criterion=None, split_batches=True):
+    """Computes metrics, the loss averaged over examples, predictions and
+    probabilities from a single forward pass over data_iter.
+    In distributed training, results are gathered from all processes, each of which
+    evaluates every world_size-th batch if `split_batches`."""
     model.eval()
     data_iter.repeat = False
-    predictions, golds = [], []
+    rank, world_size = distributed_info()
+    predictions, golds, probs = [], [], []
+    total_loss = 0.0
     with torch.no_grad():
-        for batch in data_iter:
-            pred = model.predict(*batch.tweet)
-            predictions += pred.tolist()
+        for i, batch in enumerate(data_iter):
+            if split_batches and i % world_size != rank:
+                continue
+            logits = model(*model_inputs(batch))
+            if criterion is not None:
+                total_loss += criterion(logits, batch.label).item() * batch.label.size(0)
+            predictions += logits.argmax(1).tolist()
+            probs += logits.softmax(1).tolist()
             golds += batch.label.tolist()
+    if world_size > 1:
+        gathered = [None] * world_size
+        dist.all_gather_object(gathered, (predictions, golds, probs, total_loss))
+        predictions, golds, probs, total_loss = [], [], [], 0.0
+        for rank_predictions, rank_golds, rank_probs, rank_loss in gathered:
+            predictions += rank_predictions
+            golds += rank_golds
+            probs += rank_probs
+            total_loss += rank_loss
     f1 = calc_f1(predictions, golds)
     prec = calc_prec(predictions, golds)
     rec = calc_rec(predictions, golds)
     acc = calc_acc(predictions, golds)
+    loss = total_loss / len(golds) if criterion is not None else None
     data_iter.repeat = True
-    return f1, prec, rec, acc
+    return EvalResult(f1, prec, rec, acc, loss, predictions, probs)
+
+def evaluate(model, data_iter):
+    return evaluate_all(model, data_iter)[:4]
 
 
 # TODO: make verbose an option
 def build_trainer(model, data, optimizer, scheduler, max_grad_norm,
-                  record_every, patience, exp_name):
+                  record_every, patience, exp_name, train_window=None,
+                  train_eval_every=0, checkpoint='disk', precision='fp32',
+                  accumulation_steps=1, pruner=None, profile_steps=None, sync_timing=False):
     trainer = Trainer(model, data.train_iter, data.val_iter, optimizer,
                       scheduler, max_grad_norm, patience, exp_name,
-                      record_every, verbose=True, test_iter=data.test_iter)
+                      record_every, verbose=True, test_iter=data.test_iter,
+                      train_window=train_window, train_eval_every=train_eval_every,
+                      checkpoint=checkpoint, precision=precision,
+                      accumulation_steps=accumulation_steps, pruner=pruner,
+                      profile_steps=profile_steps, sync_timing=sync_timing)
     return trainer
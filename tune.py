@@ -0,0 +1,169 @@
+import os
+import time
+import random
+import logging
+import statistics
+import multiprocessing
+
+import torch
+from setproctitle import setproctitle
+
+from model import build_model, load_pretrained
+from trainer import build_trainer
+from utils import *
+from optimizer import build_optimizer_scheduler
+from train import build_parser, parse_args, prepare_data
+
+logger = logging.getLogger(__name__)
+
+def add_sweep_args(parser):
+    sweep = parser.add_argument_group('Sweep options')
+    sweep.add_argument('--trials', type=int, default=10,
+                       help='Number of configurations sampled from the grids below')
+    sweep.add_argument('--concurrent_trials', type=int, default=1)
+    sweep.add_argument('--layers', type=int, choices=range(1, 13), nargs='+', default=[11, 12])
+    sweep.add_argument('--lrs', type=float, nargs='+', default=[0.00005, 0.00001, 0.0005])
+    sweep.add_argument('--warmup_ratios', type=float, nargs='+', default=[0, 0.1])
+    sweep.add_argument('--seed', type=int, default=0)
+    sweep.add_argument('--no_prune', action='store_true')
+    sweep.add_argument('--prune_min_trials', type=int, default=4,
+                       help='Number of other trials which must have reached a step to prune at it')
+    sweep.add_argument('--prune_warmup_steps', type=int, default=100,
+                       help='Trials are not pruned before this step')
+    sweep.add_argument('--results', default=None,
+                       help='Table of results. Defaults to runs/{note}_sweep.tsv')
+    return parser
+
+
+class MedianPruner:
+    """Prunes a trial whose best validation F1 so far is below the median of those of
+    other trials at the same step. `curves` is shared by all trials of a sweep."""
+    def __init__(self, trial, curves, min_trials=4, warmup_steps=0):
+        self.trial = trial
+        self.curves = curves
+        self.min_trials = min_trials
+        self.warmup_steps = warmup_steps
+        self.best_score = float('-inf')
+
+    def __call__(self, step, score):
+        self.best_score = max(self.best_score, score)
+        self.curves.append((self.trial, step, self.best_score))
+        if step < self.warmup_steps:
+            return False
+        others = [best_score for trial, s, best_score in self.curves[:]
+                  if s == step and trial != self.trial]
+        if len(others) < self.min_trials:
+            return False
+        return self.best_score < statistics.median(others)
+
+
+def sample_configs(args):
+    rng = random.Random(args.seed)
+    return [{'layer': rng.choice(args.layers),
+             'lr': rng.choice(args.lrs),
+             'warmup_ratio': rng.choice(args.warmup_ratios)}
+            for _ in range(args.trials)]
+
+# Set before forking trial processes, which inherit the data and pretrained weights loaded once
+_sweep = None
+
+def init_trial_process(num_threads):
+    """Sets the threads of a trial, whose thread pool is started after it is forked"""
+    torch.set_num_threads(num_threads)
+
+def run_trial(trial_config):
+    trial, config = trial_config
+    args, data, base_model, curves = _sweep
+    setproctitle(f'{args.note}_trial{trial}')
+    torch.manual_seed(args.seed + trial)
+    start = time.time()
+
+    model = build_model(model=args.model,
+                        time_pooling=args.time_pooling,
+                        layer_pooling=args.layer_pooling,
+                        layer=[config['layer']],
+                        new_num_tokens=base_model.config.vocab_size,
+                        device=args.device,
+                        precision=args.precision,
+                        gradient_checkpointing=args.gradient_checkpointing,
+                        base_model=base_model,
+                        cached_layers=args.freeze_upto + 1 if args.cache_frozen else 0)
+    if args.cache_frozen:  # computed by the first trials, and loaded by later ones
+        data.cache_features(model)
+    optimizer, scheduler = build_optimizer_scheduler(model=model,
+                                                     lr=config['lr'],
+                                                     betas=(args.beta1, args.beta2),
+                                                     eps=args.eps,
+                                                     warmup_ratio=config['warmup_ratio'],
+                                                     weight_decay=args.weight_decay,
+                                                     layer_decrease=args.layer_decrease,
+                                                     freeze_upto=args.freeze_upto,
+                                                     train_step=args.train_step)
+    pruner = None if args.no_prune else MedianPruner(trial, curves, args.prune_min_trials,
+                                                     args.prune_warmup_steps)
+    trainer = build_trainer(model=model,
+                            data=data,
+                            optimizer=optimizer,
+                            scheduler=scheduler,
+                            max_grad_norm=args.max_grad_norm,
+                            patience=args.patience,
+                            record_every=args.record_every,
+                            exp_name=f'{args.note}_trial{trial}',
+                            train_window=args.train_window,
+                            train_eval_every=args.train_eval_every,
+                            checkpoint=args.checkpoint,
+                            precision=args.precision,
+                            accumulation_steps=args.accumulation_steps,
+                            pruner=pruner)
+    _, summary = trainer.train(args.train_step)
+    write_summary_to_file(summary, os.path.join(trainer.exp_dir, 'summary.txt'))
+
+    result = {'trial': trial, **config,
+              'status': 'pruned' if trainer.pruned else 'complete',
+              'best_step': trainer.early_stopper.best_step,
+              'val_f1': trainer.best_results['val'].f1,
+              'test_f1': trainer.best_results['test'].f1 if 'test' in trainer.best_results else None,
+              'minutes': (time.time() - start) / 60,
+              'exp_dir': trainer.exp_dir}
+    logger.info(f'Trial {trial} {result["status"]}: {result}')
+    return result
+
+def write_results(results, file_name):
+    header = ['trial', 'layer', 'lr', 'warmup_ratio', 'status', 'best_step',
+              'val_f1', 'test_f1', 'minutes', 'exp_dir']
+    results = sorted(results, key=lambda r: r['val_f1'], reverse=True)
+    columns = [[f'{r[k]:.4f}' if isinstance(r[k], float) and k.endswith(('f1', 'minutes'))
+                else str(r[k]) for r in results] for k in header]
+    write_to_file(file_name, header, *columns)
+
+
+if __name__ == "__main__":
+    args = parse_args(add_sweep_args(build_parser()))
+    setproctitle(args.note)
+    # The parent runs single-threaded, as an OpenMP thread pool started before forking
+    # would deadlock trials which use it
+    num_threads = max(1, torch.get_num_threads() // args.concurrent_trials)
+    torch.set_num_threads(1)
+
+    # Loaded once, and shared by all trials
+    tokenizer, olid_data = prepare_data(args)
+    base_model = load_pretrained(args.model, len(tokenizer),
+                                 hidden_dropout_prob=args.hidden_dropout_prob,
+                                 attention_probs_dropout_prob=args.attention_probs_dropout_prob)
+    manager = multiprocessing.Manager()
+    curves = manager.list()
+    _sweep = (args, olid_data, base_model, curves)
+
+    configs = sample_configs(args)
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(args.concurrent_trials, initializer=init_trial_process,
+                  initargs=(num_threads,), maxtasksperchild=1) as pool:
+        results = list(pool.imap_unordered(run_trial, enumerate(configs)))
+
+    results_file = args.results or os.path.join('runs', f'{args.note}_sweep.tsv')
+    os.makedirs(os.path.dirname(results_file) or '.', exist_ok=True)
+    write_results(results, results_file)
+    best = max(results, key=lambda r: r['val_f1'])
+    print(f'{len(results)} trials, {sum(r["status"] == "pruned" for r in results)} pruned')
+    print(f'Best trial: {best}')
+    print(f'Results are written to {results_file}')
@@ -1,7 +1,10 @@
 import os
+import json
 from datetime import datetime
 
+import numpy as np
 import torch
+import torch.distributed as dist
 from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score, confusion_matrix
 
 # Decorator to print lines before and after function execution
@@ -13,10 +16,13 @@ def lines(func):
         return ret
     return wrapper
 
-def sequence_mask(lengths, pad=0, dtype=torch.bool):
+def sequence_mask(lengths, pad=0, dtype=torch.bool, max_len=None):
     # make a mask matrix corresponding to given length
     # from https://github.com/tensorflow/tensorflow/blob/r1.12/tensorflow/python/ops/array_ops.py
-    row_vector = torch.arange(0, max(lengths), device=lengths.device) # (L,)
+    # max_len defaults to max(lengths), and is larger when batches are padded further
+    if max_len is None:
+        max_len = max(lengths)
+    row_vector = torch.arange(0, max_len, device=lengths.device) # (L,)
     matrix = lengths.unsqueeze(-1) # (B, 1)
     if pad == 1:
         result = row_vector >= matrix # 1 for pad tokens
@@ -26,6 +32,39 @@ def sequence_mask(lengths, pad=0, dtype=torch.bool):
         result = result.float()
     return result # (B, L)
 
+def autocast(precision, device):
+    """Runs ops in bfloat16 where it is safe if precision is 'bf16', otherwise in float32.
+    Weights stay in float32 either way."""
+    device_type = device.type if isinstance(device, torch.device) else torch.device(device).type
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16,
+                          enabled=precision == 'bf16')
+
+def distributed_info():
+    """Rank of this process and the number of processes, which are (0, 1) unless
+    torch.distributed is initialized"""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+def broadcast_state(model, src=0):
+    """Copies parameters and buffers of `model` on process `src` to all processes"""
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, src)
+
+def is_main_process():
+    return distributed_info()[0] == 0
+
+class NullWriter:
+    """Stands in for SummaryWriter on processes other than the main one"""
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+def model_inputs(batch):
+    """Token ids and lengths of a batch, or cached frozen-layer features in place of ids if it has them"""
+    if hasattr(batch, 'features'):
+        return batch.features, batch.tweet[1]
+    return batch.tweet
+
 def calc_acc(pred, gold):
     """
     Calculates accuracy between prediction and gold label.
@@ -64,28 +103,42 @@ def conf_matrix(pred, gold, labels=None):
     """
     return confusion_matrix(y_true=gold, y_pred=pred, labels=labels)
 
-def write_pred_to_file(model, data_iter, tokenizer, file_name):
+def write_pred_to_file(model, data_iter, tokenizer, file_name, probs_file=None):
+    """Writes predictions with one forward pass per batch, and the rows of each batch as it is done.
+    Probabilities in the file are in the dtype of the model output. If probs_file is given,
+    also saves ids, predictions, golds and probabilities cast to float32 to it with np.savez.
+    Returns lists of predictions and golds, to compute metrics from without another pass."""
+    sep = format_to_sep[os.path.splitext(file_name)[1]]
     model.eval()
-    data_iter.repeat = False
-    ids, tweets, preds, golds, probs = [], [], [], [], []
-    with torch.no_grad():
-        for batch in data_iter:
-            id_ = batch.id
-            tweet = [tokenizer.decode(tweet.tolist(), skip_special_tokens=True)\
-                      for tweet in batch.tweet[0]]
-            pred = model.predict(*batch.tweet).tolist()
-            gold = batch.label.tolist()
-            prob = model(*batch.tweet).softmax(1).tolist()
-
-            ids += id_
-            tweets += tweet
-            preds += map(str, pred)
-            golds += map(str, gold)
-            probs += [' '.join(map(str, p)) for p in prob]
-    header = ['id', 'tweet', 'pred', 'gold', 'prob']
-    to_write = [header, ids, tweets, preds, golds, probs]
-    file_name = write_to_file(file_name, *to_write )
-    return file_name
+    repeat, data_iter.repeat = data_iter.repeat, False
+    preds, golds = [], []
+    arrays = {'id': [], 'pred': [], 'gold': [], 'prob': []}
+    try:
+        with open(file_name, 'w') as f, torch.no_grad():
+            print(sep.join(['id', 'tweet', 'pred', 'gold', 'prob']), file=f)
+            for batch in data_iter:
+                x, length = batch.tweet
+                logits = model(*model_inputs(batch))
+                pred = logits.argmax(1)
+                prob = logits.softmax(1)
+                tweets = [tokenizer.decode(ids[:n].tolist(), skip_special_tokens=True)
+                          for ids, n in zip(x, length.tolist())]
+                for id_, tweet, p, gold, probs in zip(batch.id, tweets, pred.tolist(),
+                                                      batch.label.tolist(), prob.tolist()):
+                    print(sep.join([str(id_), tweet, str(p), str(gold), ' '.join(map(str, probs))]), file=f)
+                preds += pred.tolist()
+                golds += batch.label.tolist()
+                if probs_file is not None:
+                    arrays['id'] += batch.id
+                    arrays['pred'].append(pred.cpu().numpy())
+                    arrays['gold'].append(batch.label.cpu().numpy())
+                    arrays['prob'].append(prob.float().cpu().numpy())
+    finally:
+        data_iter.repeat = repeat
+    if probs_file is not None:
+        np.savez(probs_file, id=np.array(arrays['id']), pred=np.concatenate(arrays['pred']),
+                 gold=np.concatenate(arrays['gold']), prob=np.concatenate(arrays['prob']))
+    return preds, golds
 
 def rename_expname(exp_name):
     """Each of multiple runs with same exp_name will be saved in
@@ -123,6 +176,8 @@ def load_model(model, exp_note, file_name='best_model.pt'):
     return model
 
 def find_exp(exp_note, run_num=0):
+    if os.path.isdir(exp_note):  # a run directory, e.g. runs/{note}/{timestamp}
+        return exp_note
     exp_dir = 'runs/'
     exp_paths = listdir_fullpath(exp_dir)
     exp_notes = ['_'.join(d.split('_')[16:]) for d in exp_paths]
@@ -146,3 +201,13 @@ def save_tokenizer(tokenizer, dir_name):
     """This writes `added_tokens.json`, `special_tokens_map.json`,
     `vocab.txt`, `tokenizer_config.json` to the directory"""
     tokenizer.save_pretrained(dir_name)
+
+def save_labels(labels, dir_name, file_name='labels.json'):
+    """Writes label names in the order of the classes of the model"""
+    with open(os.path.join(dir_name, file_name), 'w') as f:
+        json.dump(labels, f)
+
+def load_labels(exp_note, file_name='labels.json'):
+    exp_path = find_exp(exp_note)
+    with open(os.path.join(exp_path, file_name)) as f:
+        return json.load(f)